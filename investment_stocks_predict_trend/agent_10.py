@@ -4,6 +4,9 @@ import chainer
 import chainerrl
 import matplotlib.pyplot as plt
 
+import agent_env
+import agent_replay_buffer
+
 
 def execute(experiment=None, max_episode=500):
     df = preprocessing()
@@ -32,6 +35,34 @@ def execute(experiment=None, max_episode=500):
             build_figure_result(df_result, i, experiment)
 
 
+def execute_batch(experiment=None, max_episode=500, windows=((18000, 18750),)):
+    # One agent trained on several (start id, end id) windows at once
+    df = preprocessing()
+    print(df)
+
+    train_env = agent_env.BatchEnv([LearnEnv(df, start_id, end_id) for start_id, end_id in windows])
+    test_env = LearnEnv(df, 18750, 19000)
+
+    agent = build_agent(train_env, experiment)
+
+    for i, env_index in enumerate(agent_env.train_batch(train_env, agent, max_episode), 1):
+        print("*** episode: "+str(i)+" ***")
+        df_result, metrics = build_result(train_env.envs[env_index], agent)
+        if experiment is not None:
+            experiment.log_asset_data(df_result.to_csv(), file_name="train_result."+str(i)+".csv")
+            experiment.log_metrics(metrics, step=i)
+
+        if i % 100 == 0:
+            print("episode: " + str(i))
+            print(metrics)
+
+            df_result, metrics = simulate_agent(test_env, agent)
+            if experiment is not None:
+                experiment.log_asset_data(df_result.to_csv(), file_name="test_result."+str(i)+".csv")
+
+            build_figure_result(df_result, i, experiment)
+
+
 def preprocessing():
     df_csv = pd.read_csv("local/nikkei_averages.csv", index_col=0)
 
@@ -49,10 +80,15 @@ def preprocessing():
 
 
 class LearnEnv():
+    INITIAL_STATE = {"total_reward": 0.0, "funds": 0.0, "assets": 0.0, "buy_price": 0.0, "win": 0, "lose": 0}
+    PRICE_COLUMNS = ["opening_price", "close_price"]
+
     def __init__(self, df, start_id, end_id):
         self.DF = df.copy()
         self.START_ID = start_id
         self.END_ID = end_id
+        self.OBSERVATIONS = agent_env.build_observations(self.DF, self.START_ID, self.END_ID, [("change", -i) for i in range(1, 21)])
+        self.episode = agent_env.EpisodeLog(self.DF, self.START_ID, self.END_ID, {"reward": 0., "assets": 0., "funds": 0., "buy": 0, "sell": 0, "win": 0, "lose": 0})
 
         self.reset()
 
@@ -61,23 +97,12 @@ class LearnEnv():
         self.observation_size = len(self.observe())
 
     def reset(self):
-        self.total_reward = 0.0
-        self.funds = 0.0
-        self.assets = 0.0
+        for name, value in self.INITIAL_STATE.items():
+            setattr(self, name, value)
         self.current_id = self.START_ID
-        self.buy_price = 0.0
         self.done = False
-        self.win = 0
-        self.lose = 0
-
-        self.df_action = self.DF.copy()
-        self.df_action = self.df_action.assign(reward=0.)
-        self.df_action = self.df_action.assign(assets=0.)
-        self.df_action = self.df_action.assign(funds=0.)
-        self.df_action = self.df_action.assign(buy=0)
-        self.df_action = self.df_action.assign(sell=0)
-        self.df_action = self.df_action.assign(win=0)
-        self.df_action = self.df_action.assign(lose=0)
+
+        self.episode.reset()
 
         return self.observe()
 
@@ -86,14 +111,14 @@ class LearnEnv():
             reward = 0.0
         elif self.buy_price == 0.0:
             # buy
-            self.buy_price = self.df_action.at[self.current_id, "opening_price"]
+            self.buy_price = self.DF.at[self.current_id, "opening_price"]
             self.funds -= self.buy_price
             reward = 0.0
 
-            self.df_action.at[self.current_id, "buy"] = 1
+            self.episode.record(self.current_id, buy=1)
         elif self.buy_price != 0.0:
             # sell
-            sell_price = self.df_action.at[self.current_id, "close_price"]
+            sell_price = self.DF.at[self.current_id, "close_price"]
             self.funds += sell_price
             reward = sell_price - self.buy_price
             self.total_reward += reward
@@ -104,18 +129,21 @@ class LearnEnv():
             else:
                 self.lose += 1
 
-            self.df_action.at[self.current_id, "sell"] = 1
+            self.episode.record(self.current_id, sell=1)
 
         if self.buy_price == 0.0:
             self.assets = self.funds
         else:
-            self.assets = self.funds + self.df_action.at[self.current_id, "close_price"]
-
-        self.df_action.at[self.current_id, "reward"] = self.total_reward
-        self.df_action.at[self.current_id, "funds"] = self.funds
-        self.df_action.at[self.current_id, "assets"] = self.assets
-        self.df_action.at[self.current_id, "win"] = self.win
-        self.df_action.at[self.current_id, "lose"] = self.lose
+            self.assets = self.funds + self.DF.at[self.current_id, "close_price"]
+
+        self.episode.record(
+            self.current_id,
+            reward=self.total_reward,
+            funds=self.funds,
+            assets=self.assets,
+            win=self.win,
+            lose=self.lose
+        )
 
         self.current_id += 1
         if self.current_id >= self.END_ID:
@@ -123,6 +151,33 @@ class LearnEnv():
 
         return self.observe(), reward, self.done, {}
 
+    @staticmethod
+    def batch_step(state, prices, actions):
+        # step() for the rows of BatchEnv, buying and selling are exclusive per row
+        buy = (actions != 0) & (state["buy_price"] == 0.0)
+        sell = (actions != 0) & (state["buy_price"] != 0.0)
+
+        rewards = np.where(sell, prices["close_price"] - state["buy_price"], 0.0)
+
+        state["total_reward"] += rewards
+        state["funds"] += np.where(sell, prices["close_price"], 0.0) - np.where(buy, prices["opening_price"], 0.0)
+        state["buy_price"] = np.where(buy, prices["opening_price"], np.where(sell, 0.0, state["buy_price"]))
+        state["win"] += sell & (rewards > 0)
+        state["lose"] += sell & (rewards <= 0)
+        state["assets"] = np.where(state["buy_price"] == 0.0, state["funds"], state["funds"] + prices["close_price"])
+
+        values = {
+            "reward": state["total_reward"],
+            "funds": state["funds"],
+            "assets": state["assets"],
+            "buy": buy,
+            "sell": sell,
+            "win": state["win"],
+            "lose": state["lose"]
+        }
+
+        return rewards, values
+
     def render(self):
         print("id: "+str(self.current_id))
         print("total_reward: "+str(self.total_reward) +
@@ -134,12 +189,7 @@ class LearnEnv():
         print(self.observe())
 
     def observe(self):
-        obs = np.array(
-            [self.df_action.at[self.current_id-i, "change"] for i in range(1, 21)],
-            dtype=np.float32
-        )
-
-        return obs
+        return self.OBSERVATIONS[self.current_id - self.START_ID]
 
     def random_action(self):
         return np.random.randint(0, 2)
@@ -182,7 +232,7 @@ def build_agent(env, experiment=None):
         random_action_func=env.random_action
     )
 
-    replay_buffer = chainerrl.replay_buffer.ReplayBuffer(capacity=hyper_params["replay_buffer_capacity"])
+    replay_buffer = agent_replay_buffer.CompactReplayBuffer(hyper_params["replay_buffer_capacity"], hyper_params["obs_size"])
 
     agent = chainerrl.agents.DoubleDQN(
         q_func,
@@ -213,18 +263,7 @@ def train_agent(env, agent):
 
     agent.stop_episode_and_train(obs, reward, done)
 
-    metrics = {
-        "reward": env.total_reward,
-        "epsilon": agent.explorer.epsilon,
-        "win": env.win,
-        "lose": env.lose,
-        "funds": env.funds,
-        "assets": env.assets
-    }
-
-    df_result = env.df_action.query(str(env.START_ID) + " <= id <= "+str(env.END_ID)).copy()
-
-    return df_result, metrics
+    return build_result(env, agent)
 
 
 def simulate_agent(env, agent):
@@ -241,6 +280,10 @@ def simulate_agent(env, agent):
 
     agent.stop_episode()
 
+    return build_result(env, agent)
+
+
+def build_result(env, agent):
     metrics = {
         "reward": env.total_reward,
         "epsilon": agent.explorer.epsilon,
@@ -250,7 +293,7 @@ def simulate_agent(env, agent):
         "assets": env.assets
     }
 
-    df_result = env.df_action.query(str(env.START_ID) + " <= id <= " + str(env.END_ID)).copy()
+    df_result = env.episode.to_dataframe()
 
     return df_result, metrics
 
@@ -4,6 +4,8 @@ import chainer
 import chainerrl
 import matplotlib.pyplot as plt
 
+import agent_env
+
 
 def execute(experiment=None, max_episode=500):
     df = preprocessing()
@@ -53,6 +55,8 @@ class LearnEnv():
         self.DF = df.copy()
         self.START_ID = start_id
         self.END_ID = end_id
+        self.OBSERVATIONS = agent_env.build_observations(self.DF, self.START_ID, self.END_ID, [("diff", -i) for i in range(1, 21)])
+        self.episode = agent_env.EpisodeLog(self.DF, self.START_ID, self.END_ID, {"reward": 0., "funds": 0., "assets": 0., "action": 0, "win": 0, "lose": 0})
 
         self.reset()
 
@@ -69,13 +73,7 @@ class LearnEnv():
         self.win = 0
         self.lose = 0
 
-        self.df_action = self.DF.copy()
-        self.df_action = self.df_action.assign(reward=0.)
-        self.df_action = self.df_action.assign(funds=0.)
-        self.df_action = self.df_action.assign(assets=0.)
-        self.df_action = self.df_action.assign(action=0)
-        self.df_action = self.df_action.assign(win=0)
-        self.df_action = self.df_action.assign(lose=0)
+        self.episode.reset()
 
         return self.observe()
 
@@ -83,7 +81,7 @@ class LearnEnv():
         if action == 0:
             reward = 0.0
         else:
-            reward = self.df_action.at[self.current_id, "diff"]
+            reward = self.DF.at[self.current_id, "diff"]
             self.funds += reward
             self.assets = self.funds
             self.total_reward += reward
@@ -93,13 +91,16 @@ class LearnEnv():
             else:
                 self.lose += 1
 
-            self.df_action.at[self.current_id, "action"] = 1
+            self.episode.record(self.current_id, action=1)
 
-        self.df_action.at[self.current_id, "reward"] = self.total_reward
-        self.df_action.at[self.current_id, "funds"] = self.funds
-        self.df_action.at[self.current_id, "assets"] = self.assets
-        self.df_action.at[self.current_id, "win"] = self.win
-        self.df_action.at[self.current_id, "lose"] = self.lose
+        self.episode.record(
+            self.current_id,
+            reward=self.total_reward,
+            funds=self.funds,
+            assets=self.assets,
+            win=self.win,
+            lose=self.lose
+        )
 
         self.current_id += 1
         if self.current_id >= self.END_ID:
@@ -118,12 +119,7 @@ class LearnEnv():
         print(self.observe())
 
     def observe(self):
-        obs = np.array(
-            [self.df_action.at[self.current_id-i, "diff"] for i in range(1, 21)],
-            dtype=np.float32
-        )
-
-        return obs
+        return self.OBSERVATIONS[self.current_id - self.START_ID]
 
     def random_action(self):
         return np.random.randint(0, 2)
@@ -206,7 +202,7 @@ def train_agent(env, agent):
         "assets": env.assets
     }
 
-    df_result = env.df_action.query(str(env.START_ID)+" <= id <= "+str(env.END_ID)).copy()
+    df_result = env.episode.to_dataframe()
 
     return df_result, metrics
 
@@ -234,7 +230,7 @@ def simulate_agent(env, agent):
         "assets": env.assets
     }
 
-    df_result = env.df_action.query(str(env.START_ID) + " <= id <= " + str(env.END_ID)).copy()
+    df_result = env.episode.to_dataframe()
 
     return df_result, metrics
 
@@ -4,6 +4,8 @@ import chainer
 import chainerrl
 import matplotlib.pyplot as plt
 
+import agent_env
+
 
 def execute(experiment=None, max_episode=500):
     TICKER_SYMBOL = "5610"
@@ -50,6 +52,8 @@ class TrainEnv():
         self.DF = df.copy()
         self.START_ID = start_id
         self.END_ID = end_id
+        self.OBSERVATIONS = agent_env.build_observations(self.DF, self.START_ID, self.END_ID, [("adjusted_close_price", -i) for i in range(1, 21)])
+        self.episode = agent_env.EpisodeLog(self.DF, self.START_ID, self.END_ID, {"total_reward": np.nan, "funds": np.nan, "assets": np.nan, "buy_price": np.nan, "buy_stocks": np.nan, "win": np.nan, "lose": np.nan})
 
         self.reset()
 
@@ -68,7 +72,7 @@ class TrainEnv():
         self.win = 0
         self.lose = 0
 
-        self.df_result = self.DF.copy()
+        self.episode.reset()
 
         return self.observe()
 
@@ -77,14 +81,14 @@ class TrainEnv():
             reward = 0.0
         elif self.buy_stocks == 0:
             # buy
-            self.buy_price = self.df_result.at[self.current_id, "close_price"]
+            self.buy_price = self.DF.at[self.current_id, "close_price"]
             self.buy_stocks = (self.funds * 0.5) // (self.buy_price * 100) * 100
             self.funds -= self.buy_price * self.buy_stocks
 
             reward = 0.0
         else:
             # sell
-            sell_price = self.df_result.at[self.current_id, "close_price"]
+            sell_price = self.DF.at[self.current_id, "close_price"]
             reward = sell_price - self.buy_price
             self.total_reward += reward
 
@@ -97,15 +101,18 @@ class TrainEnv():
             else:
                 self.lose += 1
 
-        self.assets = self.funds + self.df_result.at[self.current_id, "close_price"] * self.buy_stocks
-
-        self.df_result.at[self.current_id, "total_reward"] = self.total_reward
-        self.df_result.at[self.current_id, "funds"] = self.funds
-        self.df_result.at[self.current_id, "assets"] = self.assets
-        self.df_result.at[self.current_id, "buy_price"] = self.buy_price
-        self.df_result.at[self.current_id, "buy_stocks"] = self.buy_stocks
-        self.df_result.at[self.current_id, "win"] = self.win
-        self.df_result.at[self.current_id, "lose"] = self.lose
+        self.assets = self.funds + self.DF.at[self.current_id, "close_price"] * self.buy_stocks
+
+        self.episode.record(
+            self.current_id,
+            total_reward=self.total_reward,
+            funds=self.funds,
+            assets=self.assets,
+            buy_price=self.buy_price,
+            buy_stocks=self.buy_stocks,
+            win=self.win,
+            lose=self.lose
+        )
 
         self.current_id += 1
         if self.current_id >= self.END_ID:
@@ -115,16 +122,11 @@ class TrainEnv():
 
     def render(self):
         print(f"id: {self.current_id}")
-        print(self.df_result[self.current_id, self.current_id+1])
+        print(self.episode.to_dataframe(slice(self.current_id, self.current_id+1)))
         print(f"observe: {self.observe()}")
 
     def observe(self):
-        obs = np.array(
-            [self.df_result.at[self.current_id-i, "adjusted_close_price"] for i in range(1, 21)],
-            dtype=np.float32
-        )
-
-        return obs
+        return self.OBSERVATIONS[self.current_id - self.START_ID]
 
     def random_action(self):
         return np.random.randint(0, 2)
@@ -207,7 +209,7 @@ def train_agent(env, agent):
         "assets": env.assets
     }
 
-    df_result = env.df_result.query(f"{env.START_ID} <= id <= {env.END_ID}").copy()
+    df_result = env.episode.to_dataframe()
 
     return df_result, metrics
 
@@ -235,7 +237,7 @@ def simulate_agent(env, agent):
         "assets": env.assets
     }
 
-    df_result = env.df_result.query(f"{env.START_ID} <= id <= {env.END_ID}").copy()
+    df_result = env.episode.to_dataframe()
 
     return df_result, metrics
 
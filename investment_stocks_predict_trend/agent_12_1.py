@@ -1,9 +1,20 @@
+import argparse
+import itertools
+import json
+import os
+
 import pandas as pd
 import numpy as np
 import chainer
 import chainerrl
 import matplotlib.pyplot as plt
 
+import agent_env
+import agent_replay_buffer
+import app_parallel
+from app_logging import get_app_logger
+from trade_metrics import calc_asset_metrics
+
 
 def execute(experiment=None, max_episode=500):
     TICKER_SYMBOL = "5610"
@@ -33,6 +44,132 @@ def execute(experiment=None, max_episode=500):
             build_figure_result(df_result, experiment)
 
 
+def execute_batch(experiment=None, max_episode=500, windows=(("5610", 5881, 7057),)):
+    # One agent trained on several (ticker, start id, end id) windows at once
+    TICKER_SYMBOL = "5610"
+
+    ticker_symbols = set([TICKER_SYMBOL] + [ticker_symbol for ticker_symbol, _, _ in windows])
+    dfs = {ticker_symbol: load_data(ticker_symbol) for ticker_symbol in ticker_symbols}
+
+    train_env = agent_env.BatchEnv([TrainEnv(dfs[ticker_symbol], start_id, end_id) for ticker_symbol, start_id, end_id in windows])
+    test_env = TrainEnv(dfs[TICKER_SYMBOL], 7057, 7750)
+
+    agent = build_agent(train_env, experiment)
+
+    for i, env_index in enumerate(agent_env.train_batch(train_env, agent, max_episode), 1):
+        print("*** episode: "+str(i)+" ***")
+        df_result, metrics = build_result(train_env.envs[env_index], agent)
+        if experiment is not None:
+            experiment.log_metrics(metrics, step=i)
+
+        if i % 100 == 0:
+            print("episode: "+str(i))
+            print(metrics)
+
+            df_result, metrics = simulate_agent(test_env, agent)
+            if experiment is not None:
+                experiment.log_asset_data(df_result.to_csv(), file_name="test_result."+str(i)+".csv")
+
+            build_figure_result(df_result, experiment)
+
+
+def execute_all(ticker_symbols, seeds=(0,), hyper_params_list=({},), train_start_date="2008-01-01", train_end_date="2017-12-31", test_start_date="2018-01-01", test_end_date="2018-12-31", max_episode=500, n_jobs=-1, output_path="local/agent_12_1/report.csv"):
+    # One training per (ticker, seed, hyper params), each in its own process
+    L = get_app_logger()
+    L.info("start")
+
+    if max_episode < 1:
+        raise Exception(f"max_episode must be 1 or more: {max_episode}")
+
+    # Trainings of an interrupted run are not executed again
+    checkpoint = app_parallel.checkpoint_path(output_path)
+    checkpoint_records = app_parallel.read_checkpoint(checkpoint)
+    done = set((record["ticker_symbol"], record["seed"], record["hyper_params"]) for record in checkpoint_records)
+
+    args_list = [(ticker_symbol, seed, hyper_params, train_start_date, train_end_date, test_start_date, test_end_date, max_episode) for ticker_symbol, seed, hyper_params in itertools.product(ticker_symbols, seeds, hyper_params_list) if (ticker_symbol, seed, json.dumps(hyper_params, sort_keys=True)) not in done]
+
+    results = app_parallel.imap_unordered(execute_impl, args_list, n_jobs=n_jobs)
+    records = app_parallel.collect_results(results, checkpoint, checkpoint_records)
+
+    df_report = pd.DataFrame.from_records(records)
+
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    df_report.to_csv(output_path, index=False)
+    app_parallel.clear_checkpoint(checkpoint)
+
+    L.info("finish")
+
+    return df_report
+
+
+def execute_impl(ticker_symbol, seed, hyper_params, train_start_date, train_end_date, test_start_date, test_end_date, max_episode):
+    L = get_app_logger(f"agent_12_1.{ticker_symbol}")
+    L.info(f"execute: ticker_symbol={ticker_symbol}, seed={seed}, hyper_params={hyper_params}")
+
+    result = {
+        "ticker_symbol": ticker_symbol,
+        "seed": seed,
+        "hyper_params": json.dumps(hyper_params, sort_keys=True),
+        **{f"param_{k}": v for k, v in hyper_params.items()},
+        "exception": None
+    }
+
+    try:
+        if max_episode < 1:
+            raise Exception(f"max_episode must be 1 or more: {max_episode}")
+
+        chainerrl.misc.set_random_seed(seed)
+
+        df = load_data(ticker_symbol)
+
+        train_env = TrainEnv(df, *window_ids(df, train_start_date, train_end_date))
+        test_env = TrainEnv(df, *window_ids(df, test_start_date, test_end_date))
+
+        agent = build_agent(train_env, params=hyper_params)
+
+        for _ in range(max_episode):
+            _, metrics = train_agent(train_env, agent)
+        result.update({f"train_{k}": v for k, v in metrics.items()})
+
+        _, metrics = simulate_agent(test_env, agent)
+        result.update({f"test_{k}": v for k, v in metrics.items()})
+    except Exception as err:
+        L.exception(f"ticker_symbol={ticker_symbol}, seed={seed}, {err}")
+        result["exception"] = err
+
+    return result
+
+
+def window_ids(df, start_date, end_date):
+    # First and last id between the dates, leaving 20 days of history to observe
+    ids = df.query(f"'{start_date}' <= date <= '{end_date}'").index
+
+    if len(ids) == 0:
+        raise Exception(f"no data: start_date={start_date}, end_date={end_date}")
+
+    return max(ids.min(), 20), ids.max()
+
+
+def benchmark(max_episode=3):
+    TICKER_SYMBOL = "5610"
+
+    df = load_data(TICKER_SYMBOL)
+
+    train_env = TrainEnv(df, 5881, 7057)
+
+    print(f"steps/sec: {agent_env.measure_steps_per_second(train_env, max_episode)}")
+
+
+def benchmark_replay_buffer(n_transitions=100000):
+    obs_size = 40
+
+    for name, build_replay_buffer in [
+        ("chainerrl", lambda capacity: chainerrl.replay_buffer.ReplayBuffer(capacity=capacity)),
+        ("compact", lambda capacity: agent_replay_buffer.CompactReplayBuffer(capacity, obs_size))
+    ]:
+        print(f"{name}: {agent_replay_buffer.measure_replay_buffer(build_replay_buffer, obs_size, n_transitions)}")
+
+
 def load_data(ticker_symbol):
     df = pd.read_csv(f"local/stock_prices/stock_prices.{ticker_symbol}.csv")
 
@@ -46,10 +183,15 @@ def load_data(ticker_symbol):
 
 
 class TrainEnv():
+    INITIAL_STATE = {"total_reward": 0.0, "funds": 1000000.0, "assets": 1000000.0, "buy_price": 0.0, "buy_stocks": 0.0, "win": 0, "lose": 0}
+    PRICE_COLUMNS = ["close_price"]
+
     def __init__(self, df, start_id, end_id):
         self.DF = df.copy()
         self.START_ID = start_id
         self.END_ID = end_id
+        self.OBSERVATIONS = agent_env.build_observations(self.DF, self.START_ID, self.END_ID, [("adjusted_close_price", -i) for i in range(1, 21)] + [("volume", -i) for i in range(1, 21)])
+        self.episode = agent_env.EpisodeLog(self.DF, self.START_ID, self.END_ID, {"total_reward": np.nan, "funds": np.nan, "assets": np.nan, "buy_price": np.nan, "buy_stocks": np.nan, "win": np.nan, "lose": np.nan})
 
         self.reset()
 
@@ -58,17 +200,12 @@ class TrainEnv():
         self.observation_size = len(self.observe())
 
     def reset(self):
-        self.total_reward = 0.0
-        self.funds = 1000000
-        self.assets = self.funds
-        self.buy_price = 0.0
-        self.buy_stocks = 0
+        for name, value in self.INITIAL_STATE.items():
+            setattr(self, name, value)
         self.current_id = self.START_ID
         self.done = False
-        self.win = 0
-        self.lose = 0
 
-        self.df_result = self.DF.copy()
+        self.episode.reset()
 
         return self.observe()
 
@@ -77,14 +214,14 @@ class TrainEnv():
             reward = 0.0
         elif self.buy_stocks == 0:
             # buy
-            self.buy_price = self.df_result.at[self.current_id, "close_price"]
+            self.buy_price = self.DF.at[self.current_id, "close_price"]
             self.buy_stocks = (self.funds * 0.5) // (self.buy_price * 100) * 100
             self.funds -= self.buy_price * self.buy_stocks
 
             reward = 0.0
         else:
             # sell
-            sell_price = self.df_result.at[self.current_id, "close_price"]
+            sell_price = self.DF.at[self.current_id, "close_price"]
             reward = sell_price - self.buy_price
             self.total_reward += reward
 
@@ -97,15 +234,18 @@ class TrainEnv():
             else:
                 self.lose += 1
 
-        self.assets = self.funds + self.df_result.at[self.current_id, "close_price"] * self.buy_stocks
-
-        self.df_result.at[self.current_id, "total_reward"] = self.total_reward
-        self.df_result.at[self.current_id, "funds"] = self.funds
-        self.df_result.at[self.current_id, "assets"] = self.assets
-        self.df_result.at[self.current_id, "buy_price"] = self.buy_price
-        self.df_result.at[self.current_id, "buy_stocks"] = self.buy_stocks
-        self.df_result.at[self.current_id, "win"] = self.win
-        self.df_result.at[self.current_id, "lose"] = self.lose
+        self.assets = self.funds + self.DF.at[self.current_id, "close_price"] * self.buy_stocks
+
+        self.episode.record(
+            self.current_id,
+            total_reward=self.total_reward,
+            funds=self.funds,
+            assets=self.assets,
+            buy_price=self.buy_price,
+            buy_stocks=self.buy_stocks,
+            win=self.win,
+            lose=self.lose
+        )
 
         self.current_id += 1
         if self.current_id >= self.END_ID:
@@ -113,28 +253,39 @@ class TrainEnv():
 
         return self.observe(), reward, self.done, {}
 
+    @staticmethod
+    def batch_step(state, prices, actions):
+        # step() for the rows of BatchEnv, buying and selling are exclusive per row
+        close_price = prices["close_price"]
+        buy = (actions != 0) & (state["buy_stocks"] == 0)
+        sell = (actions != 0) & (state["buy_stocks"] != 0)
+
+        buy_stocks = np.where(buy, (state["funds"] * 0.5) // (close_price * 100) * 100, 0.0)
+        rewards = np.where(sell, close_price - state["buy_price"], 0.0)
+
+        state["total_reward"] += rewards
+        state["funds"] += np.where(sell, close_price * state["buy_stocks"], 0.0) - close_price * buy_stocks
+        state["buy_price"] = np.where(buy, close_price, np.where(sell, 0.0, state["buy_price"]))
+        state["buy_stocks"] = np.where(buy, buy_stocks, np.where(sell, 0.0, state["buy_stocks"]))
+        state["win"] += sell & (rewards > 0)
+        state["lose"] += sell & (rewards <= 0)
+        state["assets"] = state["funds"] + close_price * state["buy_stocks"]
+
+        return rewards, state
+
     def render(self):
         print(f"id: {self.current_id}")
-        print(self.df_result[self.current_id, self.current_id+1])
+        print(self.episode.to_dataframe(slice(self.current_id, self.current_id+1)))
         print(f"observe: {self.observe()}")
 
     def observe(self):
-        obs = np.array(
-            [self.df_result.at[self.current_id-i, "adjusted_close_price"] for i in range(1, 21)],
-            dtype=np.float32
-        )
-        obs = np.append(obs, np.array(
-            [self.df_result.at[self.current_id-i, "volume"] for i in range(1, 21)],
-            dtype=np.float32
-        ))
-
-        return obs
+        return self.OBSERVATIONS[self.current_id - self.START_ID]
 
     def random_action(self):
         return np.random.randint(0, 2)
 
 
-def build_agent(env, experiment=None):
+def build_agent(env, experiment=None, params=None):
     hyper_params = {
         "n_hidden_layers": 3,
         "obs_size": env.observation_size,
@@ -150,6 +301,8 @@ def build_agent(env, experiment=None):
         "ddqn_update_interval": 1,
         "ddqn_target_update_interval": 100
     }
+    if params is not None:
+        hyper_params.update(params)
     if experiment is not None:
         experiment.log_parameters(hyper_params)
 
@@ -171,7 +324,7 @@ def build_agent(env, experiment=None):
         random_action_func=env.random_action
     )
 
-    replay_buffer = chainerrl.replay_buffer.ReplayBuffer(capacity=hyper_params["replay_buffer_capacity"])
+    replay_buffer = agent_replay_buffer.CompactReplayBuffer(hyper_params["replay_buffer_capacity"], hyper_params["obs_size"])
 
     agent = chainerrl.agents.DoubleDQN(
         q_func,
@@ -202,18 +355,7 @@ def train_agent(env, agent):
 
     agent.stop_episode_and_train(obs, reward, done)
 
-    metrics = {
-        "reward": env.total_reward,
-        "epsilon": agent.explorer.epsilon,
-        "win": env.win,
-        "lose": env.lose,
-        "funds": env.funds,
-        "assets": env.assets
-    }
-
-    df_result = env.df_result.query(f"{env.START_ID} <= id <= {env.END_ID}").copy()
-
-    return df_result, metrics
+    return build_result(env, agent)
 
 
 def simulate_agent(env, agent):
@@ -230,6 +372,10 @@ def simulate_agent(env, agent):
 
     agent.stop_episode()
 
+    return build_result(env, agent)
+
+
+def build_result(env, agent):
     metrics = {
         "reward": env.total_reward,
         "epsilon": agent.explorer.epsilon,
@@ -239,7 +385,9 @@ def simulate_agent(env, agent):
         "assets": env.assets
     }
 
-    df_result = env.df_result.query(f"{env.START_ID} <= id <= {env.END_ID}").copy()
+    df_result = env.episode.to_dataframe()
+
+    metrics.update(calc_asset_metrics(df_result["assets"].values))
 
     return df_result, metrics
 
@@ -269,3 +417,39 @@ def build_figure_result(df_result, experiment=None):
 
     if experiment is not None:
         experiment.log_figure(figure_name="assets", figure=fig)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--task", help="execute_all, benchmark, or benchmark_replay_buffer")
+    parser.add_argument("--ticker-symbols", help="execute_all ticker symbols (comma separated, default: 5610)", default="5610")
+    parser.add_argument("--seeds", help="execute_all seeds (comma separated, default: 0)", default="0")
+    parser.add_argument("--hyper-params", help="execute_all hyper params list (json, default: [{}])", default="[{}]")
+    parser.add_argument("--train-start-date", help="train start date (default: 2008-01-01)", default="2008-01-01")
+    parser.add_argument("--train-end-date", help="train end date (default: 2017-12-31)", default="2017-12-31")
+    parser.add_argument("--test-start-date", help="test start date (default: 2018-01-01)", default="2018-01-01")
+    parser.add_argument("--test-end-date", help="test end date (default: 2018-12-31)", default="2018-12-31")
+    parser.add_argument("--max-episode", help="train episodes (default: 500, benchmark: 3)", default=None, type=int)
+    parser.add_argument("--n-jobs", help="execute_all processes (default: -1, every core)", default=-1, type=int)
+    parser.add_argument("--output-path", help="execute_all report (default: local/agent_12_1/report.csv)", default="local/agent_12_1/report.csv")
+    args = parser.parse_args()
+
+    if args.task == "execute_all":
+        execute_all(
+            ticker_symbols=args.ticker_symbols.split(","),
+            seeds=[int(seed) for seed in args.seeds.split(",")],
+            hyper_params_list=json.loads(args.hyper_params),
+            train_start_date=args.train_start_date,
+            train_end_date=args.train_end_date,
+            test_start_date=args.test_start_date,
+            test_end_date=args.test_end_date,
+            max_episode=args.max_episode if args.max_episode is not None else 500,
+            n_jobs=args.n_jobs,
+            output_path=args.output_path
+        )
+    elif args.task == "benchmark":
+        benchmark(args.max_episode if args.max_episode is not None else 3)
+    elif args.task == "benchmark_replay_buffer":
+        benchmark_replay_buffer()
+    else:
+        parser.print_help()
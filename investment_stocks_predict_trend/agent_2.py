@@ -4,6 +4,8 @@ import chainer
 import chainerrl
 import matplotlib.pyplot as plt
 
+import agent_env
+
 
 def execute(experiment):
     df = preprocessing()
@@ -41,6 +43,8 @@ class LearnEnv():
         self.DF = df_input.copy()
         self.START_ID = start_id
         self.END_ID = end_id
+        self.OBSERVATIONS = agent_env.build_observations(self.DF, self.START_ID, self.END_ID, [("rolling_5_mean", -i) for i in range(1, 11)])
+        self.episode = agent_env.EpisodeLog(self.DF, self.START_ID, self.END_ID, {"reward": 0., "funds": 0., "buy": 0, "sell": 0, "win": 0, "lose": 0})
 
         self.reset()
 
@@ -57,13 +61,7 @@ class LearnEnv():
         self.win = 0
         self.lose = 0
 
-        self.df_action = self.DF.copy()
-        self.df_action = self.df_action.assign(reward=0.)
-        self.df_action = self.df_action.assign(funds=0.)
-        self.df_action = self.df_action.assign(buy=0)
-        self.df_action = self.df_action.assign(sell=0)
-        self.df_action = self.df_action.assign(win=0)
-        self.df_action = self.df_action.assign(lose=0)
+        self.episode.reset()
 
         return self.observe()
 
@@ -72,14 +70,14 @@ class LearnEnv():
             reward = 0.0
         elif self.buy_price == 0.0:
             # buy
-            self.buy_price = self.df_action.at[self.current_id, "opening_price"]
+            self.buy_price = self.DF.at[self.current_id, "opening_price"]
             self.funds -= self.buy_price
             reward = 0.0
 
-            self.df_action.at[self.current_id, "buy"] = 1
+            self.episode.record(self.current_id, buy=1)
         elif self.buy_price != 0.0:
             # sell
-            sell_price = self.df_action.at[self.current_id, "close_price"]
+            sell_price = self.DF.at[self.current_id, "close_price"]
             self.funds += sell_price
             reward = sell_price - self.buy_price
             self.total_reward += reward
@@ -90,12 +88,15 @@ class LearnEnv():
             else:
                 self.lose += 1
 
-            self.df_action.at[self.current_id, "sell"] = 1
+            self.episode.record(self.current_id, sell=1)
 
-        self.df_action.at[self.current_id, "reward"] = self.total_reward
-        self.df_action.at[self.current_id, "funds"] = self.funds
-        self.df_action.at[self.current_id, "win"] = self.win
-        self.df_action.at[self.current_id, "lose"] = self.lose
+        self.episode.record(
+            self.current_id,
+            reward=self.total_reward,
+            funds=self.funds,
+            win=self.win,
+            lose=self.lose
+        )
 
         self.current_id += 1
         if self.current_id >= self.END_ID:
@@ -104,15 +105,10 @@ class LearnEnv():
         return self.observe(), reward, self.done, {}
 
     def render(self):
-        print(self.df_action.loc[self.current_id-1])
+        print(self.episode.row(self.current_id-1))
 
     def observe(self):
-        obs = np.array(
-            [self.df_action.at[self.current_id - i, "rolling_5_mean"] for i in range(1, 11)],
-            dtype=np.float32
-        )
-
-        return obs
+        return self.OBSERVATIONS[self.current_id - self.START_ID]
 
     def random_action(self):
         return np.random.randint(0, 2)
@@ -220,7 +216,7 @@ def simulate_agent(env, agent, experiment=None):
 
     agent.stop_episode()
 
-    df_result = env.df_action.query("18840 <= id <= 19090").copy()
+    df_result = env.episode.to_dataframe(slice(18840, 19090))
 
     if experiment is not None:
         experiment.log_asset_data(df_result.to_csv(), file_name="result.csv")
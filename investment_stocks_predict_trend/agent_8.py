@@ -10,6 +10,8 @@ import matplotlib.pyplot as plt
 import chainer
 import chainerrl
 
+import agent_env
+
 
 def execute(experiment):
     df = preprocessing()
@@ -182,6 +184,8 @@ class LearnEnv():
         self.DF = df.copy()
         self.START_ID = start_id
         self.END_ID = end_id
+        self.OBSERVATIONS = agent_env.build_observations(self.DF, self.START_ID, self.END_ID, [("opening_price", -i) for i in range(1, 4)] + [("predict_opening_price_"+str(i), -i) for i in range(0, 3)] + [("close_price", -i) for i in range(1, 4)] + [("predict_close_price_"+str(i), -i) for i in range(0, 3)])
+        self.episode = agent_env.EpisodeLog(self.DF, self.START_ID, self.END_ID, {"reward": 0., "funds": 0., "buy": 0, "sell": 0, "win": 0, "lose": 0})
 
         self.reset()
 
@@ -199,13 +203,7 @@ class LearnEnv():
         self.win = 0
         self.lose = 0
 
-        self.df_action = self.DF.copy()
-        self.df_action = self.df_action.assign(reward=0.)
-        self.df_action = self.df_action.assign(funds=0.)
-        self.df_action = self.df_action.assign(buy=0)
-        self.df_action = self.df_action.assign(sell=0)
-        self.df_action = self.df_action.assign(win=0)
-        self.df_action = self.df_action.assign(lose=0)
+        self.episode.reset()
 
         return self.observe()
 
@@ -214,15 +212,15 @@ class LearnEnv():
             reward = 0.0
         elif self.buy_price == 0.0:
             # buy
-            self.buy_price = self.df_action.at[self.current_id, "scaled_opening_price"]
-            self.predict_buy_price = self.df_action.at[self.current_id-1, "predict_opening_price_1"]
+            self.buy_price = self.DF.at[self.current_id, "scaled_opening_price"]
+            self.predict_buy_price = self.DF.at[self.current_id-1, "predict_opening_price_1"]
             self.funds -= self.buy_price
             reward = 0.0
 
-            self.df_action.at[self.current_id, "buy"] = 1
+            self.episode.record(self.current_id, buy=1)
         elif self.buy_price != 0.0:
             # sell
-            sell_price = self.df_action.at[self.current_id, "scaled_close_price"]
+            sell_price = self.DF.at[self.current_id, "scaled_close_price"]
             self.funds += sell_price
             reward = sell_price - self.buy_price
             self.total_reward += reward
@@ -234,12 +232,15 @@ class LearnEnv():
             else:
                 self.lose += 1
 
-            self.df_action.at[self.current_id, "sell"] = 1
+            self.episode.record(self.current_id, sell=1)
 
-        self.df_action.at[self.current_id, "reward"] = self.total_reward
-        self.df_action.at[self.current_id, "funds"] = self.funds
-        self.df_action.at[self.current_id, "win"] = self.win
-        self.df_action.at[self.current_id, "lose"] = self.lose
+        self.episode.record(
+            self.current_id,
+            reward=self.total_reward,
+            funds=self.funds,
+            win=self.win,
+            lose=self.lose
+        )
 
         self.current_id += 1
         if self.current_id >= self.END_ID:
@@ -248,25 +249,10 @@ class LearnEnv():
         return self.observe(), reward, self.done, {}
 
     def render(self):
-        print(self.df_action.loc[self.current_id-1])
+        print(self.episode.row(self.current_id-1))
 
     def observe(self):
-        obs = np.array(
-            [self.df_action.at[self.current_id - i, "opening_price"] for i in range(1, 4)],
-            dtype=np.float32
-        )
-        obs = np.append(obs, np.array(
-            [self.df_action.at[self.current_id - i, "predict_opening_price_"+str(i)] for i in range(0, 3)],
-            dtype=np.float32
-        ))
-        obs = np.append(obs, np.array(
-            [self.df_action.at[self.current_id - i, "close_price"] for i in range(1, 4)],
-            dtype=np.float32
-        ))
-        obs = np.append(obs, np.array(
-            [self.df_action.at[self.current_id - i, "predict_close_price_"+str(i)] for i in range(0, 3)],
-            dtype=np.float32
-        ))
+        obs = self.OBSERVATIONS[self.current_id - self.START_ID]
         obs = np.append(obs, np.array(self.buy_price, dtype=np.float32))
         obs = np.append(obs, np.array(self.predict_buy_price, dtype=np.float32))
 
@@ -378,7 +364,7 @@ def simulate_agent(env, agent, experiment=None):
 
     agent.stop_episode()
 
-    df_result = env.df_action.query("7786 <= id").copy()
+    df_result = env.episode.to_dataframe(slice(7786, None))
 
     if experiment is not None:
         experiment.log_asset_data(df_result.to_csv(), file_name="result.csv")
@@ -0,0 +1,189 @@
+import time
+
+import numpy as np
+
+
+def build_observations(df, start_id, end_id, terms):
+    # Row i is the observation at id start_id + i, terms are (column, offset from the current id)
+    ids = np.arange(start_id, end_id + 1)
+    observations = np.empty((len(ids), len(terms)), dtype=np.float32)
+
+    for j, (column, offset) in enumerate(terms):
+        positions = df.index.get_indexer(ids + offset)
+        if (positions < 0).any():
+            raise Exception(f"observation out of range: column={column}, offset={offset}")
+
+        observations[:, j] = df[column].values[positions]
+
+    # observe() returns rows of this matrix as views, so nothing may write to it
+    observations.flags.writeable = False
+
+    return observations
+
+
+def measure_steps_per_second(env, max_episode=3, seed=0):
+    # Random actions, so that only the env is measured
+    np.random.seed(seed)
+
+    steps = 0
+    start_time = time.time()
+
+    for _ in range(max_episode):
+        env.reset()
+        done = False
+
+        while not done:
+            _, _, done, _ = env.step(env.random_action())
+            steps += 1
+
+    return steps / max(time.time() - start_time, 1e-6)
+
+
+class BatchEnv():
+    # Steps several envs in lockstep. The state of env i is row i of (n_envs, ...) arrays, and the env class
+    # steps all rows at once with batch_step(state, prices, actions) -> (rewards, recorded values).
+    # An env's attributes and episode log are filled from its row only when its episode ends.
+    def __init__(self, envs):
+        if len(set(env.observation_size for env in envs)) != 1:
+            raise Exception("observation sizes differ")
+        if len(set(type(env) for env in envs)) != 1:
+            raise Exception("env classes differ")
+
+        self.envs = envs
+        self.data_len = sum(env.data_len for env in envs) // len(envs)
+        self.action_size = envs[0].action_size
+        self.observation_size = envs[0].observation_size
+
+        self._batch_step = type(envs[0]).batch_step
+        self._initial_state = envs[0].INITIAL_STATE
+        self._fill_values = envs[0].episode._fill_values
+
+        # Rows are padded to the longest window, an env never reads past its own end
+        self._rows = np.arange(len(envs))
+        self._lengths = np.array([env.END_ID - env.START_ID for env in envs])
+        width = self._lengths.max() + 1
+
+        self._observations = np.zeros((len(envs), width, self.observation_size), dtype=np.float32)
+        for i, env in enumerate(envs):
+            self._observations[i, :len(env.OBSERVATIONS)] = env.OBSERVATIONS
+
+        self._prices = {}
+        for column in envs[0].PRICE_COLUMNS:
+            self._prices[column] = np.zeros((len(envs), width))
+            for i, env in enumerate(envs):
+                self._prices[column][i, :self._lengths[i] + 1] = env.DF.loc[env.START_ID:env.END_ID, column].values
+
+        self._state = {name: np.full(len(envs), value) for name, value in self._initial_state.items()}
+        self._log = {name: np.full((len(envs), width), fill_value) for name, fill_value in self._fill_values.items()}
+        self._positions = np.zeros(len(envs), dtype=np.int64)
+
+    def reset(self):
+        return self.reset_done(None, np.ones(len(self.envs), dtype=bool))
+
+    def step(self, actions):
+        rows, positions = self._rows, self._positions
+
+        prices = {column: values[rows, positions] for column, values in self._prices.items()}
+        rewards, values = self._batch_step(self._state, prices, np.asarray(actions))
+
+        for name, value in values.items():
+            self._log[name][rows, positions] = value
+
+        self._positions += 1
+        dones = self._positions >= self._lengths
+
+        for i in np.flatnonzero(dones):
+            self._sync(i)
+
+        # Fancy indexing copies, the agent keeps the observations it was given
+        obs = self._observations[rows, self._positions]
+
+        return obs, rewards.astype(np.float64), dones
+
+    def reset_done(self, obs, dones):
+        # Envs that are done start their next episode, after the agent has observed the last step
+        if not dones.any():
+            return obs
+
+        for name, value in self._initial_state.items():
+            self._state[name][dones] = value
+        for name, fill_value in self._fill_values.items():
+            self._log[name][dones] = fill_value
+        self._positions[dones] = 0
+
+        return self._observations[self._rows, self._positions]
+
+    def _sync(self, i):
+        env = self.envs[i]
+
+        for name in self._initial_state:
+            setattr(env, name, self._state[name][i].item())
+        for name, values in env.episode.values.items():
+            values[:] = self._log[name][i, :len(values)]
+
+        env.current_id = env.END_ID
+        env.done = True
+
+    def random_action(self):
+        return self.envs[0].random_action()
+
+
+def train_batch(batch_env, agent, max_episode):
+    # Yields the index of the env each time one finishes an episode, before it is reset
+    no_reset = np.zeros(len(batch_env.envs), dtype=bool)
+    episode = 0
+
+    obs = batch_env.reset()
+
+    while True:
+        actions = agent.batch_act_and_train(obs)
+        obs, rewards, dones = batch_env.step(actions)
+        agent.batch_observe_and_train(obs, rewards, dones, no_reset)
+
+        for i in np.flatnonzero(dones):
+            yield i
+
+            episode += 1
+            if episode >= max_episode:
+                return
+
+        obs = batch_env.reset_done(obs, dones)
+
+
+class EpisodeLog():
+    # Per-step values of one episode, in arrays sized to start_id..end_id instead of a copy of the prices
+    def __init__(self, df, start_id, end_id, fill_values):
+        self._df = df
+        self._start_id = start_id
+        self._end_id = end_id
+        self._fill_values = fill_values
+
+        self.values = {name: np.full(end_id - start_id + 1, fill_value) for name, fill_value in fill_values.items()}
+
+    def reset(self):
+        for name, values in self.values.items():
+            values.fill(self._fill_values[name])
+
+    def record(self, id, **values):
+        i = id - self._start_id
+
+        for name, value in values.items():
+            self.values[name][i] = value
+
+    def to_dataframe(self, ids=None):
+        # Prices joined with the episode, rows outside the episode keep the fill values
+        df = self._df.loc[slice(self._start_id, self._end_id) if ids is None else ids]
+
+        positions = df.index.values - self._start_id
+        inside = (positions >= 0) & (positions <= self._end_id - self._start_id)
+
+        columns = {}
+        for name, values in self.values.items():
+            column = np.full(len(df), self._fill_values[name], dtype=values.dtype)
+            column[inside] = values[positions[inside]]
+            columns[name] = column
+
+        return df.assign(**columns)
+
+    def row(self, id):
+        return self.to_dataframe(slice(id, id)).iloc[0]
@@ -0,0 +1,142 @@
+import pickle
+import random
+import time
+import tracemalloc
+
+import chainerrl
+import numpy as np
+
+
+class CompactReplayBuffer(chainerrl.replay_buffer.AbstractReplayBuffer):
+    # Ring buffer of arrays, one slot per transition.
+    # Arrays grow by doubling up to the capacity, so that a large capacity costs nothing before it is used.
+    INITIAL_SIZE = 1024
+
+    def __init__(self, capacity, obs_size):
+        self._capacity = capacity
+
+        size = min(capacity, self.INITIAL_SIZE)
+
+        self.state = np.empty((size, obs_size), dtype=np.float32)
+        self.action = np.empty(size, dtype=np.int32)
+        self.reward = np.empty(size, dtype=np.float32)
+        self.is_state_terminal = np.empty(size, dtype=bool)
+
+        # The next state is the state of the env's next transition, -1 while it is not known yet
+        self.next_index = np.empty(size, dtype=np.int64)
+
+        self._count = 0
+        self._next_states = {}
+        self._last_counts = {}
+
+    @property
+    def capacity(self):
+        return self._capacity
+
+    def append(self, state, action, reward, next_state=None, next_action=None, is_state_terminal=False, env_id=0, **kwargs):
+        i = self._count % self._capacity
+        if i >= len(self.action):
+            self._grow()
+
+        self._next_states.pop(i, None)
+
+        # Link the env's previous transition, whose next state is this state
+        last_count = self._last_counts.pop(env_id, None)
+        if last_count is not None and self._count - last_count < self._capacity:
+            j = last_count % self._capacity
+
+            if j in self._next_states and np.array_equal(self._next_states[j], state):
+                del self._next_states[j]
+                self.next_index[j] = i
+
+        self.state[i] = state
+        self.action[i] = action
+        self.reward[i] = reward
+        self.is_state_terminal[i] = is_state_terminal
+        self.next_index[i] = -1
+
+        # Kept aside until linked, for good at the end of an episode
+        self._next_states[i] = np.array(next_state, dtype=np.float32)
+
+        if not is_state_terminal:
+            self._last_counts[env_id] = self._count
+
+        self._count += 1
+
+    def _grow(self):
+        size = min(self._capacity, len(self.action) * 2)
+
+        for name in ["state", "action", "reward", "is_state_terminal", "next_index"]:
+            values = getattr(self, name)
+            grown = np.empty((size,) + values.shape[1:], dtype=values.dtype)
+            grown[:len(values)] = values
+            setattr(self, name, grown)
+
+    def stop_current_episode(self, env_id=0):
+        self._last_counts.pop(env_id, None)
+
+    def sample(self, n):
+        # Same shape as chainerrl's ReplayBuffer, a list of one-step transitions
+        return [[self._transition(i)] for i in random.sample(range(len(self)), n)]
+
+    def _transition(self, i):
+        j = self.next_index[i]
+
+        return {
+            "state": self.state[i],
+            "action": self.action[i],
+            "reward": self.reward[i],
+            "next_state": self.state[j] if j >= 0 else self._next_states[i],
+            "next_action": None,
+            "is_state_terminal": self.is_state_terminal[i]
+        }
+
+    def __len__(self):
+        return min(self._count, self._capacity)
+
+    def save(self, filename):
+        with open(filename, "wb") as f:
+            pickle.dump(self.__dict__, f)
+
+    def load(self, filename):
+        with open(filename, "rb") as f:
+            self.__dict__.update(pickle.load(f))
+
+
+def measure_replay_buffer(build_replay_buffer, obs_size, n_transitions=100000, episode_len=1000, batch_size=32, n_batches=1000, seed=0):
+    # Episodes of views into one observation matrix, as the envs observe them
+    rng = np.random.RandomState(seed)
+    observations = rng.rand(episode_len + 1, obs_size).astype(np.float32)
+    actions = rng.randint(0, 2, n_transitions)
+    rewards = rng.rand(n_transitions)
+
+    # The buffer is built while traced, so that preallocated arrays count
+    tracemalloc.start()
+
+    replay_buffer = build_replay_buffer(n_transitions)
+
+    for t in range(n_transitions):
+        k = t % episode_len
+        done = k == episode_len - 1
+
+        replay_buffer.append(state=observations[k], action=actions[t], reward=rewards[t], next_state=observations[k + 1], next_action=actions[(t + 1) % n_transitions], is_state_terminal=done)
+        if done:
+            replay_buffer.stop_current_episode()
+
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    random.seed(seed)
+    start_time = time.time()
+
+    for _ in range(n_batches):
+        replay_buffer.sample(batch_size)
+
+    sample_time = time.time() - start_time
+
+    return {
+        "transitions": len(replay_buffer),
+        "memory": memory,
+        "memory_per_transition": memory / n_transitions,
+        "samples_per_sec": n_batches * batch_size / max(sample_time, 1e-6)
+    }
@@ -0,0 +1,205 @@
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import numpy as np
+import pandas as pd
+
+from app_logging import get_app_logger
+
+
+THREAD_ENV_NAMES = ["OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS", "NUMEXPR_NUM_THREADS", "VECLIB_MAXIMUM_THREADS"]
+INNER_N_JOBS_ENV_NAME = "APP_PARALLEL_INNER_N_JOBS"
+
+
+def imap_unordered(func, args_list, n_jobs=-1, costs=None, memory=None, max_memory=None, threads_per_task=1):
+    L = get_app_logger("app_parallel")
+
+    args_list = list(args_list)
+    if len(args_list) == 0:
+        return
+
+    # Workers * threads per task never exceeds the cores
+    cpu_count = os.cpu_count()
+    threads_per_task = max(1, min(threads_per_task, cpu_count))
+    max_workers = cpu_count // threads_per_task if n_jobs == -1 else n_jobs
+    max_workers = max(1, min(max_workers, len(args_list)))
+
+    # Longest task first, so that a long ticker does not start last
+    order = list(range(len(args_list)))
+    if costs is not None:
+        order.sort(key=lambda i: costs[i], reverse=True)
+
+    memory = [0] * len(args_list) if memory is None else list(memory)
+
+    running = {}
+    running_memory = 0
+    peak_memory = 0
+    peak_running = 0
+    busy_time = 0.0
+    start_time = time.time()
+
+    with _thread_env(threads_per_task), ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+        while len(order) > 0 or len(running) > 0:
+            # Submit while a worker is free and memory fits, at least one task always runs
+            while len(order) > 0 and len(running) < max_workers:
+                i = order[0]
+                if max_memory is not None and len(running) > 0 and running_memory + memory[i] > max_memory:
+                    break
+
+                order.pop(0)
+                future = executor.submit(func, *args_list[i])
+                running[future] = (i, time.time())
+                running_memory += memory[i]
+
+            peak_memory = max(peak_memory, running_memory)
+            peak_running = max(peak_running, len(running))
+
+            done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+
+            for future in done:
+                i, submit_time = running.pop(future)
+                running_memory -= memory[i]
+                busy_time += time.time() - submit_time
+
+                yield future.result()
+
+    wall_time = time.time() - start_time
+    utilization = busy_time / (wall_time * max_workers) if wall_time > 0 else np.nan
+
+    L.info(f"parallel: func={getattr(func, '__name__', func)}, tasks={len(args_list)}, workers={max_workers}, threads_per_task={threads_per_task}, wall_time={wall_time:.1f}s, busy_time={busy_time:.1f}s, utilization={utilization:.3f}, peak_running={peak_running}, peak_memory={peak_memory / 1024 ** 2:.1f}MB")
+
+
+def inner_n_jobs():
+    return int(os.environ.get(INNER_N_JOBS_ENV_NAME, 1))
+
+
+class _thread_env():
+    # Spawned workers inherit these before numpy/BLAS is loaded
+    def __init__(self, threads):
+        self._env = {name: str(threads) for name in THREAD_ENV_NAMES + [INNER_N_JOBS_ENV_NAME]}
+        self._saved = {}
+
+    def __enter__(self):
+        for name, value in self._env.items():
+            self._saved[name] = os.environ.get(name)
+            os.environ[name] = value
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        for name, value in self._saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+
+def checkpoint_path(s3_key):
+    return f"local/checkpoint/{s3_key}.jsonl"
+
+
+def read_checkpoint(path):
+    # Records of a run that did not finish, a line cut off by a crash is dropped
+    records = []
+
+    if path is None or not os.path.exists(path):
+        return records
+
+    with open(path) as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                continue
+
+    return records
+
+
+def pending_keys(keys, records, name="ticker_symbol"):
+    done = set(record[name] for record in records)
+
+    return [key for key in keys if key not in done]
+
+
+def clear_checkpoint(path):
+    # Once the output is written, so that the next run starts over
+    if os.path.exists(path):
+        os.remove(path)
+
+
+class ResultWriter():
+    def __init__(self, path):
+        self._path = path
+        self._file = None
+
+    def __enter__(self):
+        if self._path is not None:
+            os.makedirs(os.path.dirname(self._path), exist_ok=True)
+
+            # A crash may have left a partial line, which read_checkpoint drops
+            partial = False
+            if os.path.exists(self._path) and os.path.getsize(self._path) > 0:
+                with open(self._path, "rb") as f:
+                    f.seek(-1, os.SEEK_END)
+                    partial = f.read(1) != b"\n"
+
+            self._file = open(self._path, "a")
+            if partial:
+                self._file.write("\n")
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def write(self, record):
+        if self._file is None:
+            return
+
+        self._file.write(json.dumps(record, default=_json_default, ensure_ascii=False) + "\n")
+        self._file.flush()
+
+
+def collect_results(results, path=None, records=None):
+    # records: already in the checkpoint, the new ones are appended after them
+    records = [] if records is None else list(records)
+
+    with ResultWriter(path) as writer:
+        for result in results:
+            if result["exception"] is not None:
+                continue
+
+            record = {k: v for k, v in result.items() if k != "exception"}
+
+            records.append(record)
+            writer.write(record)
+
+    return records
+
+
+def join_records(df_companies, records):
+    ticker_symbols = [record["ticker_symbol"] for record in records]
+
+    df_result = df_companies[df_companies.index.isin(ticker_symbols)]
+
+    if len(records) == 0:
+        return df_result
+
+    df_records = pd.DataFrame.from_records(records, index="ticker_symbol")
+
+    # Columns of this stage replace the ones from the input stage
+    df_result = df_result.drop(columns=[c for c in df_records.columns if c in df_result.columns])
+
+    return df_result.join(df_records)
+
+
+def _json_default(value):
+    if isinstance(value, np.generic):
+        return value.item()
+
+    return str(value)
@@ -3,6 +3,7 @@ import io
 import joblib
 import pandas as pd
 import boto3
+import botocore
 
 
 def get_client():
@@ -53,3 +54,37 @@ def read_sklearn_model(s3_bucket, s3_key):
         clf = joblib.load(buf)
 
     return clf
+
+
+def exists(s3_bucket, s3_key):
+    s3 = get_client()
+    try:
+        s3.head_object(Bucket=s3_bucket, Key=s3_key)
+    except botocore.exceptions.ClientError as err:
+        if err.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+            return False
+        raise
+
+    return True
+
+
+def upload_file(path, s3_bucket, s3_key):
+    s3 = get_client()
+    s3.upload_file(path, s3_bucket, s3_key)
+
+
+def download_file(s3_bucket, s3_key, path):
+    s3 = get_client()
+    s3.download_file(s3_bucket, s3_key, path)
+
+
+def get_etag(s3_bucket, s3_key):
+    s3 = get_client()
+    try:
+        obj = s3.head_object(Bucket=s3_bucket, Key=s3_key)
+    except botocore.exceptions.ClientError as err:
+        if err.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+            return None
+        raise
+
+    return obj["ETag"]
@@ -0,0 +1,127 @@
+import contextlib
+import os
+import sqlite3
+
+import pandas as pd
+
+
+DB_PATH = "local/company_summary.sqlite"
+
+STRATEGY_COLUMNS = [
+    "trade_count",
+    "win_count",
+    "win_rate",
+    "lose_count",
+    "lose_rate",
+    "expected_value",
+    "risk",
+    "profit_total",
+    "loss_total",
+    "profit_factor",
+    "profit_average",
+    "loss_average",
+    "payoff_ratio",
+    "sharpe_ratio",
+    "max_drawdown",
+    "max_consecutive_loss",
+    "exposure_count",
+    "exposure_rate"
+]
+
+OPERATORS = ["=", "!=", "<", "<=", ">", ">=", "like"]
+
+
+@contextlib.contextmanager
+def connect(path=DB_PATH):
+    # Commit on success, and always close
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    with contextlib.closing(sqlite3.connect(path)) as con:
+        with con:
+            yield con
+
+
+def write_companies(df_analysed, path=DB_PATH):
+    # Typed table rebuilt from the analysed companies, with an index on every column
+    df = df_analysed.reset_index(drop=True)
+
+    with connect(path) as con:
+        df.to_sql("companies", con, if_exists="replace", index=False)
+
+        con.execute("create unique index if not exists idx_companies_ticker_symbol on companies (ticker_symbol)")
+        for column in df.columns:
+            if column not in ("ticker_symbol", "name"):
+                con.execute(f'create index if not exists "idx_companies_{column}" on companies ("{column}")')
+
+
+def write_strategy_stats(df_report, strategy, path=DB_PATH):
+    # Trade stats of one backtest, replacing the previous rows of the strategy
+    df = df_report.reindex(columns=STRATEGY_COLUMNS)
+    df = df.assign(strategy=strategy, ticker_symbol=df_report.index.values)
+
+    with connect(path) as con:
+        con.execute(f"create table if not exists strategy_stats (strategy text, ticker_symbol integer, {', '.join(f'{column} real' for column in STRATEGY_COLUMNS)})")
+        con.execute("create unique index if not exists idx_strategy_stats_strategy_ticker_symbol on strategy_stats (strategy, ticker_symbol)")
+        for column in ["expected_value", "trade_count", "win_rate", "profit_factor", "risk"]:
+            con.execute(f"create index if not exists idx_strategy_stats_{column} on strategy_stats (strategy, {column})")
+
+        con.execute("delete from strategy_stats where strategy = ?", (strategy,))
+        df.to_sql("strategy_stats", con, if_exists="append", index=False)
+
+
+def query(conditions=(), columns=None, order_by=(), limit=None, strategy=None, path=DB_PATH):
+    # Screen companies, joined with the trade stats of a strategy when given.
+    # conditions are (column, operator, value), order_by are column names with an optional " desc".
+    # Only known column names and operators reach the SQL, every value is a parameter.
+    with connect(path) as con:
+        known_columns = table_columns(con, "companies")
+        if strategy is not None:
+            known_columns += table_columns(con, "strategy_stats")
+
+        sql = f"select {', '.join(_quote(column, known_columns) for column in columns) if columns is not None else '*'} from companies"
+        where = []
+        params = []
+
+        if strategy is not None:
+            sql += " join strategy_stats using (ticker_symbol)"
+            where.append("strategy = ?")
+            params.append(strategy)
+
+        for column, operator, value in conditions:
+            if operator not in OPERATORS:
+                raise Exception(f"unknown operator: {operator}")
+
+            where.append(f"{_quote(column, known_columns)} {operator} ?")
+            params.append(value)
+
+        if len(where) > 0:
+            sql += " where " + " and ".join(where)
+
+        if len(order_by) > 0:
+            sql += " order by " + ", ".join(_order(column, known_columns) for column in order_by)
+
+        if limit is not None:
+            sql += " limit ?"
+            params.append(int(limit))
+
+        return pd.read_sql(sql, con, params=params)
+
+
+def table_columns(con, table):
+    return [row[1] for row in con.execute(f'pragma table_info("{table}")')]
+
+
+def _quote(column, known_columns):
+    if column not in known_columns:
+        raise Exception(f"unknown column: {column}")
+
+    return f'"{column}"'
+
+
+def _order(order, known_columns):
+    column, _, direction = order.partition(" ")
+
+    if direction not in ("", "asc", "desc"):
+        raise Exception(f"unknown order: {order}")
+
+    return f"{_quote(column, known_columns)} {direction}".rstrip()
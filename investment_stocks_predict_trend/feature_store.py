@@ -0,0 +1,150 @@
+import hashlib
+import json
+import os
+import tempfile
+
+import joblib
+import numpy as np
+
+import app_s3
+
+
+PRICE_COLUMNS = [
+    "date",
+    "open_price",
+    "high_price",
+    "low_price",
+    "close_price",
+    "adjusted_close_price",
+    "volume"
+]
+
+FEATURE_COLUMNS = [
+    "sma_5_std",
+    "sma_10_std",
+    "sma_20_std",
+    "sma_40_std",
+    "sma_80_std",
+    "momentum_5_std",
+    "momentum_10_std",
+    "momentum_20_std",
+    "momentum_40_std",
+    "momentum_80_std",
+    "roc_5_std",
+    "roc_10_std",
+    "roc_20_std",
+    "roc_40_std",
+    "roc_80_std",
+    "rsi_5_std",
+    "rsi_10_std",
+    "rsi_14_std",
+    "rsi_20_std",
+    "rsi_40_std",
+    "stochastic_k_5_std",
+    "stochastic_d_5_std",
+    "stochastic_sd_5_std",
+    "stochastic_k_9_std",
+    "stochastic_d_9_std",
+    "stochastic_sd_9_std",
+    "stochastic_k_20_std",
+    "stochastic_d_20_std",
+    "stochastic_sd_20_std",
+    "stochastic_k_25_std",
+    "stochastic_d_25_std",
+    "stochastic_sd_25_std",
+    "stochastic_k_40_std",
+    "stochastic_d_40_std",
+    "stochastic_sd_40_std"
+]
+
+BASE_PATH = "ml-data/stocks/feature_store"
+LOCAL_DIR = "local/feature_store"
+
+# ETags checked by this process, a store is checked once per run instead of on every read
+_ETAGS = {}
+
+
+def input_versions(s3_bucket, preprocess_base_path, simulate_base_path):
+    # Both input stages rewrite companies.csv (with the per-ticker manifest) whenever they run
+    return {
+        "preprocess": app_s3.get_etag(s3_bucket, f"{preprocess_base_path}/companies.csv"),
+        "simulate": app_s3.get_etag(s3_bucket, f"{simulate_base_path}/companies.csv")
+    }
+
+
+def feature_key(preprocess_base_path, simulate_base_path, predict_target, columns=FEATURE_COLUMNS, versions=None):
+    source = json.dumps({
+        "preprocess": preprocess_base_path,
+        "simulate": simulate_base_path,
+        "predict_target": predict_target,
+        "columns": list(columns),
+        "versions": versions
+    }, sort_keys=True)
+
+    return hashlib.sha1(source.encode()).hexdigest()[:16]
+
+
+def get_base_path(s3_bucket, preprocess_base_path, simulate_base_path, predict_target, columns=FEATURE_COLUMNS):
+    # A rerun of an input stage gives a new store, instead of reusing the stale one
+    versions = input_versions(s3_bucket, preprocess_base_path, simulate_base_path)
+
+    return f"{BASE_PATH}/{feature_key(preprocess_base_path, simulate_base_path, predict_target, columns, versions)}"
+
+
+def build_matrix(df, columns=FEATURE_COLUMNS):
+    return {
+        "id": df.index.values.astype(np.int64),
+        "date": df["date"].values.astype(str),
+        "x": np.ascontiguousarray(df[columns].values, dtype=np.float64),
+        "y": df["predict_target"].values
+    }
+
+
+def write_features(df, s3_bucket, base_path, ticker_symbol, columns=FEATURE_COLUMNS):
+    # CSV for backtests and humans, joblib matrix for train
+    app_s3.write_dataframe(df, s3_bucket, f"{base_path}/stock_prices.{ticker_symbol}.csv")
+
+    write_matrix(build_matrix(df, columns), s3_bucket, f"{base_path}/stock_prices.{ticker_symbol}.joblib")
+
+
+def write_matrix(matrix, s3_bucket, s3_key):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, os.path.basename(s3_key))
+        joblib.dump(matrix, path)
+        app_s3.upload_file(path, s3_bucket, s3_key)
+
+    _ETAGS.pop((s3_bucket, s3_key), None)
+
+
+def read_features(s3_bucket, base_path, ticker_symbol):
+    # Local copy is reused while its ETag matches S3, as a store can be rewritten in place
+    s3_key = f"{base_path}/stock_prices.{ticker_symbol}.joblib"
+
+    if (s3_bucket, s3_key) not in _ETAGS:
+        _ETAGS[(s3_bucket, s3_key)] = app_s3.get_etag(s3_bucket, s3_key)
+
+    etag = _ETAGS[(s3_bucket, s3_key)]
+    if etag is None:
+        del _ETAGS[(s3_bucket, s3_key)]
+        raise Exception(f"features not found: {s3_key}")
+
+    local_path = os.path.join(LOCAL_DIR, base_path, f"stock_prices.{ticker_symbol}.joblib")
+    etag_path = f"{local_path}.etag"
+
+    if not os.path.exists(local_path) or _local_etag(etag_path) != etag:
+        os.makedirs(os.path.dirname(local_path), exist_ok=True)
+        app_s3.download_file(s3_bucket, s3_key, f"{local_path}.{os.getpid()}.tmp")
+        os.replace(f"{local_path}.{os.getpid()}.tmp", local_path)
+
+        with open(etag_path, "w") as f:
+            f.write(etag)
+
+    return joblib.load(local_path, mmap_mode="r")
+
+
+def _local_etag(etag_path):
+    if not os.path.exists(etag_path):
+        return None
+
+    with open(etag_path) as f:
+        return f.read()
@@ -0,0 +1,40 @@
+import pandas as pd
+
+from app_logging import get_app_logger
+
+
+def build_manifest(df):
+    # Per ticker summary written into companies.csv, so that downstream stages can filter tickers without reading data
+    return {
+        "data_size": len(df),
+        "first_date": df["date"].min() if len(df) > 0 else None,
+        "last_date": df["date"].max() if len(df) > 0 else None,
+        "null_count": int(df.isnull().values.sum())
+    }
+
+
+def join_manifest(df_companies, manifests):
+    # Manifest of this stage replaces the one from the input stage
+    df_manifest = pd.DataFrame.from_dict(manifests, orient="index")
+
+    return df_companies.drop(columns=[c for c in df_manifest.columns if c in df_companies.columns]).join(df_manifest)
+
+
+def filter_covering(df_companies, start_date, end_date=None):
+    # Same condition as "little data", companies.csv without manifest is returned as is
+    if "first_date" not in df_companies.columns or "last_date" not in df_companies.columns:
+        return df_companies
+
+    L = get_app_logger("manifest")
+
+    covering = df_companies["first_date"].astype(str) < start_date
+    if end_date is not None:
+        covering &= df_companies["last_date"].astype(str) > end_date
+    else:
+        covering &= df_companies["last_date"].astype(str) >= start_date
+
+    covering &= df_companies["first_date"].notnull()
+
+    L.info(f"filter_covering: start_date={start_date}, end_date={end_date}, {covering.sum()}/{len(df_companies)} tickers")
+
+    return df_companies[covering]
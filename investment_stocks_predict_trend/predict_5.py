@@ -1,19 +1,42 @@
 import argparse
+import json
 
 from sklearn.svm import SVC
+import walk_forward
 from predict_base import PredictClassificationBase
 
 
 class PredictClassification_5(PredictClassificationBase):
-    def model_fit(self, x_train, y_train):
-        return SVC(gamma="scale").fit(x_train, y_train)
+    PARAM_DISTRIBUTIONS = {
+        "C": [0.1, 0.3, 1.0, 3.0, 10.0],
+        "gamma": ["scale", 0.001, 0.01, 0.1],
+        "class_weight": [None, "balanced"]
+    }
+
+    def build_model(self, **params):
+        return SVC(**{"gamma": "scale", **params})
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument("--task", help="preprocess, or train")
+    parser.add_argument("--task", help="preprocess, train, train_walk_forward, train_pooled, train_incremental, search, or materialize_split")
     parser.add_argument("--simulate-group", help="simulate trade group")
     parser.add_argument("--suffix", help="folder name suffix (default: test)", default="test")
+    parser.add_argument("--save-split-data", help="save train/test split data (default: False)", action="store_true")
+    parser.add_argument("--ticker-symbol", help="materialize_split target ticker symbol")
+    parser.add_argument("--first-test-year", help="walk forward first test year (default: 2015)", default=2015, type=int)
+    parser.add_argument("--last-test-year", help="walk forward last test year (default: 2018)", default=2018, type=int)
+    parser.add_argument("--train-years", help="walk forward train years (default: 7)", default=7, type=int)
+    parser.add_argument("--ticker-feature", help="train_pooled uses ticker symbol as a feature (default: False)", action="store_true")
+    parser.add_argument("--market-feature", help="train_pooled uses market as a feature (default: False)", action="store_true")
+    parser.add_argument("--batch-size", help="train_pooled tickers per batch (default: 100)", default=100, type=int)
+    parser.add_argument("--max-train-rows", help="train_pooled rows sampled across tickers, unless the model has partial_fit (default: 1000000)", default=1000000, type=int)
+    parser.add_argument("--model-params", help="model parameters (json, default: {})", default="{}")
+    parser.add_argument("--n-candidates", help="search candidates (default: 27)", default=27, type=int)
+    parser.add_argument("--n-tickers", help="search tickers at the last rung (default: 81)", default=81, type=int)
+    parser.add_argument("--base-suffix", help="train_incremental previous model folder name suffix (default: same as --suffix)", default=None)
+    parser.add_argument("--max-memory", help="train memory limit in MB (default: no limit)", default=None, type=int)
+    parser.add_argument("--train-threads", help="threads per train task (default: 1)", default=1, type=int)
     args = parser.parse_args()
 
     pred = PredictClassification_5(
@@ -24,12 +47,26 @@ if __name__ == "__main__":
         s3_bucket="u6k",
         input_preprocess_base_path=f"ml-data/stocks/preprocess_2.{args.suffix}",
         input_simulate_base_path=f"ml-data/stocks/simulate_trade_{args.simulate_group}.{args.suffix}",
-        output_base_path=f"ml-data/stocks/predict_5.simulate_trade_{args.simulate_group}.{args.suffix}"
+        output_base_path=f"ml-data/stocks/predict_5.simulate_trade_{args.simulate_group}.{args.suffix}",
+        save_split_data=args.save_split_data,
+        max_memory=args.max_memory * 1024 ** 2 if args.max_memory is not None else None,
+        train_threads=args.train_threads,
+        model_params=json.loads(args.model_params)
     )
 
     if args.task == "preprocess":
         pred.preprocess()
     elif args.task == "train":
         pred.train()
+    elif args.task == "train_walk_forward":
+        pred.train_walk_forward(walk_forward.build_windows(args.first_test_year, args.last_test_year, args.train_years))
+    elif args.task == "train_pooled":
+        pred.train_pooled(args.ticker_feature, args.market_feature, args.batch_size, args.max_train_rows)
+    elif args.task == "train_incremental":
+        pred.train_incremental(f"ml-data/stocks/predict_5.simulate_trade_{args.simulate_group}.{args.base_suffix}" if args.base_suffix is not None else None)
+    elif args.task == "search":
+        pred.search(n_candidates=args.n_candidates, n_tickers=args.n_tickers)
+    elif args.task == "materialize_split":
+        pred.materialize_split(args.ticker_symbol)
     else:
         parser.print_help()
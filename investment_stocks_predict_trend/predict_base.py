@@ -1,13 +1,28 @@
-import joblib
+import json
+
 import numpy as np
 import pandas as pd
+from sklearn.base import is_classifier
 from sklearn.metrics import mean_squared_error, r2_score
+from sklearn.model_selection import ParameterSampler
 
 from app_logging import get_app_logger
+import app_parallel
 import app_s3
+import feature_store
+import manifest
+import predict_metrics
+import walk_forward
 
 
 class PredictClassificationBase():
+    PREDICT_TARGET = "updown"
+    TRAIN_THREADS = 1
+    TRAIN_MEMORY_PER_ROW = len(feature_store.FEATURE_COLUMNS) * 8 * 4
+    INCREMENTAL_MIN_ROWS = 20
+    WARM_START_ESTIMATORS = 10
+    PARAM_DISTRIBUTIONS = {}
+
     def __init__(self, **kwargs):
         self._train_start_date = kwargs["train_start_date"]
         self._train_end_date = kwargs["train_end_date"]
@@ -17,24 +32,42 @@ class PredictClassificationBase():
         self._input_preprocess_base_path = kwargs["input_preprocess_base_path"]
         self._input_simulate_base_path = kwargs["input_simulate_base_path"]
         self._output_base_path = kwargs["output_base_path"]
+        self._save_split_data = kwargs.get("save_split_data", False)
+        self._max_memory = kwargs.get("max_memory", None)
+        self._train_threads = kwargs.get("train_threads", self.TRAIN_THREADS)
+        self._model_params = kwargs.get("model_params", {})
+        self._resolved_feature_base_path = None
+
+    @property
+    def _feature_base_path(self):
+        # Resolved on first use, as it reads the input ETags from S3
+        if self._resolved_feature_base_path is None:
+            self._resolved_feature_base_path = feature_store.get_base_path(self._s3_bucket, self._input_preprocess_base_path, self._input_simulate_base_path, self.PREDICT_TARGET)
+
+        return self._resolved_feature_base_path
 
     def preprocess(self):
         L = get_app_logger()
         L.info("start")
 
+        # Feature matrix is shared by every model with the same input
+        if app_s3.exists(self._s3_bucket, f"{self._feature_base_path}/companies.csv"):
+            L.info(f"skip preprocess: feature store exists: {self._feature_base_path}")
+            return
+
         df_companies = app_s3.read_dataframe(self._s3_bucket, f"{self._input_preprocess_base_path}/companies.csv", index_col=0)
-        df_result = pd.DataFrame(columns=df_companies.columns)
 
-        results = joblib.Parallel(n_jobs=-1)([joblib.delayed(self.preprocess_impl)(ticker_symbol) for ticker_symbol in df_companies.index])
+        # Tickers of an interrupted run are not computed again
+        checkpoint = app_parallel.checkpoint_path(f"{self._feature_base_path}/companies.csv")
+        checkpoint_records = app_parallel.read_checkpoint(checkpoint)
 
-        for result in results:
-            if result["exception"] is not None:
-                continue
+        results = app_parallel.imap_unordered(self.preprocess_impl, [(ticker_symbol,) for ticker_symbol in app_parallel.pending_keys(df_companies.index, checkpoint_records)])
+        records = app_parallel.collect_results(results, checkpoint, checkpoint_records)
 
-            ticker_symbol = result["ticker_symbol"]
-            df_result.loc[ticker_symbol] = df_companies.loc[ticker_symbol]
+        df_result = app_parallel.join_records(df_companies, records)
 
-        app_s3.write_dataframe(df_result, self._s3_bucket, f"{self._output_base_path}/companies.csv")
+        app_s3.write_dataframe(df_result, self._s3_bucket, f"{self._feature_base_path}/companies.csv")
+        app_parallel.clear_checkpoint(checkpoint)
 
         L.info("finish")
 
@@ -53,87 +86,75 @@ class PredictClassificationBase():
             df_simulate = app_s3.read_dataframe(self._s3_bucket, f"{self._input_simulate_base_path}/stock_prices.{ticker_symbol}.csv", index_col=0)
 
             # Preprocess
-            df = df_preprocess[[
-                "date",
-                "open_price",
-                "high_price",
-                "low_price",
-                "close_price",
-                "adjusted_close_price",
-                "volume",
-                "sma_5_std",
-                "sma_10_std",
-                "sma_20_std",
-                "sma_40_std",
-                "sma_80_std",
-                "momentum_5_std",
-                "momentum_10_std",
-                "momentum_20_std",
-                "momentum_40_std",
-                "momentum_80_std",
-                "roc_5_std",
-                "roc_10_std",
-                "roc_20_std",
-                "roc_40_std",
-                "roc_80_std",
-                "rsi_5_std",
-                "rsi_10_std",
-                "rsi_14_std",
-                "rsi_20_std",
-                "rsi_40_std",
-                "stochastic_k_5_std",
-                "stochastic_d_5_std",
-                "stochastic_sd_5_std",
-                "stochastic_k_9_std",
-                "stochastic_d_9_std",
-                "stochastic_sd_9_std",
-                "stochastic_k_20_std",
-                "stochastic_d_20_std",
-                "stochastic_sd_20_std",
-                "stochastic_k_25_std",
-                "stochastic_d_25_std",
-                "stochastic_sd_25_std",
-                "stochastic_k_40_std",
-                "stochastic_d_40_std",
-                "stochastic_sd_40_std"
-            ]].copy()
-
-            df["predict_target"] = df_simulate["profit_rate"].shift(-1).apply(lambda v: 1 if v > 0.0 else 0)
+            df = df_preprocess[feature_store.PRICE_COLUMNS + feature_store.FEATURE_COLUMNS].copy()
+
+            df["predict_target"] = self.predict_target(df_simulate)
 
             df = df.dropna()
 
             # Save data
-            app_s3.write_dataframe(df, self._s3_bucket, f"{self._output_base_path}/stock_prices.{ticker_symbol}.csv")
+            feature_store.write_features(df, self._s3_bucket, self._feature_base_path, ticker_symbol)
+
+            result.update(manifest.build_manifest(df))
         except Exception as err:
             L.exception(f"ticker_symbol={ticker_symbol}, {err}")
             result["exception"] = err
 
         return result
 
+    def predict_target(self, df_simulate):
+        return df_simulate["profit_rate"].shift(-1).apply(lambda v: 1 if v > 0.0 else 0)
+
     def train(self):
         L = get_app_logger()
         L.info("start")
 
-        df_companies = app_s3.read_dataframe(self._s3_bucket, f"{self._input_preprocess_base_path}/companies.csv", index_col=0)
-        df_result = pd.DataFrame(columns=df_companies.columns)
+        df_companies = self.read_companies(self._train_start_date, self._test_end_date)
 
-        results = joblib.Parallel(n_jobs=-1)([joblib.delayed(self.train_impl)(ticker_symbol) for ticker_symbol in df_companies.index])
-
-        for result in results:
-            if result["exception"] is not None:
-                continue
+        # Tickers of an interrupted run are not trained again
+        checkpoint = app_parallel.checkpoint_path(f"{self._output_base_path}/report.csv")
+        checkpoint_records = app_parallel.read_checkpoint(checkpoint)
+        pending_companies = df_companies.loc[app_parallel.pending_keys(df_companies.index, checkpoint_records)]
 
-            ticker_symbol = result["ticker_symbol"]
-            scores = result["scores"]
+        results = app_parallel.imap_unordered(self.train_impl, [(ticker_symbol,) for ticker_symbol in pending_companies.index], **self.train_schedule(pending_companies))
+        records = app_parallel.collect_results(self._flatten_scores(results), checkpoint, checkpoint_records)
 
-            df_result.loc[ticker_symbol] = df_companies.loc[ticker_symbol]
-            for key in scores.keys():
-                df_result.at[ticker_symbol, key] = scores[key]
+        df_result = app_parallel.join_records(df_companies, records)
 
         app_s3.write_dataframe(df_result, self._s3_bucket, f"{self._output_base_path}/report.csv")
+        app_parallel.clear_checkpoint(checkpoint)
 
         L.info("finish")
 
+    def read_companies(self, train_start_date, test_end_date):
+        # Tickers whose history does not cover the window are dropped before scheduling
+        df_companies = app_s3.read_dataframe(self._s3_bucket, f"{self._feature_base_path}/companies.csv", index_col=0)
+
+        return manifest.filter_covering(df_companies, train_start_date, test_end_date)
+
+    def train_schedule(self, df_companies):
+        schedule = {
+            "max_memory": self._max_memory,
+            "threads_per_task": self._train_threads
+        }
+
+        # Cost and memory grow with history length
+        if "data_size" in df_companies.columns:
+            data_size = df_companies["data_size"].fillna(0).values
+            schedule["costs"] = data_size
+            schedule["memory"] = data_size * self.TRAIN_MEMORY_PER_ROW
+
+        return schedule
+
+    def _flatten_scores(self, results):
+        for result in results:
+            scores = result.pop("scores")
+
+            if scores is not None:
+                result.update(scores)
+
+            yield result
+
     def train_impl(self, ticker_symbol):
         L = get_app_logger(ticker_symbol)
         L.info(f"train: {ticker_symbol}")
@@ -145,157 +166,586 @@ class PredictClassificationBase():
         }
 
         try:
-            x_train, x_test, y_train, y_test = self.train_test_split(ticker_symbol)
+            # Split train/test
+            data = self.load_train_data(ticker_symbol)
+            train, test = self.split_train_test(data, self._train_start_date, self._train_end_date, self._test_start_date, self._test_end_date)
+
+            if self._save_split_data:
+                self.save_split_data(ticker_symbol, data, train, test)
 
-            clf = self.model_fit(x_train, y_train)
+            # Train
+            clf = self.model_fit(data["x"][train], data["y"][train])
             app_s3.write_sklearn_model(clf, self._s3_bucket, f"{self._output_base_path}/model.{ticker_symbol}.joblib")
+            self.write_predictions(clf, data["x"], data, self._output_base_path, ticker_symbol)
 
-            result["scores"] = self.model_score(clf, x_test, y_test)
+            result["scores"] = {**self.split_boundaries(data, train, test), **self.model_score(clf, data["x"][test], data["y"][test])}
         except Exception as err:
             L.exception(f"ticker_symbol={ticker_symbol}, {err}")
             result["exception"] = err
 
         return result
 
-    def train_test_split(self, ticker_symbol):
-        # Load data
-        df = app_s3.read_dataframe(self._s3_bucket, f"{self._output_base_path}/stock_prices.{ticker_symbol}.csv", index_col=0)
+    def train_incremental(self, base_model_path=None):
+        L = get_app_logger()
+        L.info("start")
+
+        # Fail before any work, instead of once per ticker
+        self.check_incremental()
+
+        # Models and train_last_date of the previous run, which may be under another suffix
+        base_model_path = base_model_path if base_model_path is not None else self._output_base_path
+
+        df_report = app_s3.read_dataframe(self._s3_bucket, f"{base_model_path}/report.csv", index_col=0)
+        if "train_last_date" not in df_report.columns:
+            raise Exception("no train_last_date in report")
+
+        df_companies = app_s3.read_dataframe(self._s3_bucket, f"{self._feature_base_path}/companies.csv", index_col=0)
+        df_companies = df_companies[df_companies.index.isin(df_report.index)]
+
+        # Tickers of an interrupted run are not trained again, apart from the checkpoint of a full train
+        checkpoint = app_parallel.checkpoint_path(f"{self._output_base_path}/report.incremental.csv")
+        checkpoint_records = app_parallel.read_checkpoint(checkpoint)
+        pending_companies = df_companies.loc[app_parallel.pending_keys(df_companies.index, checkpoint_records)]
+
+        results = app_parallel.imap_unordered(self.train_incremental_impl, [(ticker_symbol, df_report.at[ticker_symbol, "train_last_date"], base_model_path) for ticker_symbol in pending_companies.index], **self.train_schedule(pending_companies))
+        records = app_parallel.collect_results(results, checkpoint, checkpoint_records)
+
+        # Every ticker of the previous report is kept, the ones not updated as they were
+        df_result = df_report.copy()
+        df_result["incremental_rows"] = 0
+        if "scores_stale" not in df_result.columns:
+            df_result["scores_stale"] = False
+
+        if len(records) > 0:
+            df_records = pd.DataFrame.from_records(records, index="ticker_symbol")
+            df_result.loc[df_records.index, "train_last_date"] = df_records["train_last_date"]
+            df_result.loc[df_records.index, "incremental_rows"] = df_records["incremental_rows"]
+
+            # Scores of the full train no longer describe a model that trained on more rows
+            df_result.loc[df_records.index[df_records["incremental_rows"] > 0], "scores_stale"] = True
+
+        app_s3.write_dataframe(df_result, self._s3_bucket, f"{self._output_base_path}/report.csv")
+        app_parallel.clear_checkpoint(checkpoint)
+
+        L.info("finish")
+
+    def check_incremental(self):
+        clf = self.build_model(**self._model_params)
+
+        if not hasattr(clf, "partial_fit") and not (hasattr(clf, "warm_start") and hasattr(clf, "n_estimators")):
+            raise Exception(f"incremental train not supported: {type(clf).__name__}")
+
+    def train_incremental_impl(self, ticker_symbol, train_last_date, base_model_path):
+        L = get_app_logger(ticker_symbol)
+        L.info(f"train_incremental: {ticker_symbol}")
+
+        result = {
+            "ticker_symbol": ticker_symbol,
+            "exception": None,
+            "train_last_date": train_last_date,
+            "incremental_rows": 0
+        }
+
+        try:
+            data = self.load_train_data(ticker_symbol)
+            clf = app_s3.read_sklearn_model(self._s3_bucket, f"{base_model_path}/model.{ticker_symbol}.joblib")
+
+            # Only rows after the last trained date
+            new_rows = slice(np.searchsorted(data["date"], train_last_date, side="right"), len(data["date"]))
+
+            if new_rows.stop - new_rows.start < self.INCREMENTAL_MIN_ROWS:
+                L.info(f"skip: ticker_symbol={ticker_symbol}, new rows={new_rows.stop - new_rows.start}")
+            else:
+                clf = self.model_update(clf, data["x"][new_rows], data["y"][new_rows])
+
+                result["train_last_date"] = data["date"][new_rows.stop - 1]
+                result["incremental_rows"] = new_rows.stop - new_rows.start
+
+            app_s3.write_sklearn_model(clf, self._s3_bucket, f"{self._output_base_path}/model.{ticker_symbol}.joblib")
+            self.write_predictions(clf, data["x"], data, self._output_base_path, ticker_symbol)
+        except Exception as err:
+            L.exception(f"ticker_symbol={ticker_symbol}, {err}")
+            result["exception"] = err
+
+        return result
+
+    def model_update(self, clf, x_new, y_new):
+        # Linear models with partial_fit
+        if hasattr(clf, "partial_fit"):
+            return clf.partial_fit(x_new, y_new)
+
+        # Forests add trees fitted on the new rows
+        if hasattr(clf, "warm_start") and hasattr(clf, "n_estimators"):
+            if hasattr(clf, "classes_") and not np.array_equal(np.unique(y_new), clf.classes_):
+                raise Exception("new rows do not have every class")
+
+            clf.set_params(warm_start=True, n_estimators=clf.n_estimators + self.WARM_START_ESTIMATORS)
+            return clf.fit(x_new, y_new)
+
+        raise Exception(f"incremental train not supported: {type(clf).__name__}")
+
+    def split_boundaries(self, data, train, test):
+        return {
+            "train_start_id": data["id"][train.start],
+            "train_end_id": data["id"][train.stop - 1],
+            "test_start_id": data["id"][test.start],
+            "test_end_id": data["id"][test.stop - 1],
+            "train_last_date": data["date"][train.stop - 1]
+        }
+
+    def save_split_data(self, ticker_symbol, data, train, test):
+        for name, rows in (("train", train), ("test", test)):
+            index = pd.Index(data["id"][rows], name="id")
+
+            df_data = pd.DataFrame(data["x"][rows], index=index, columns=feature_store.FEATURE_COLUMNS)
+            df_target = pd.DataFrame({"predict_target": data["y"][rows]}, index=index)
+
+            app_s3.write_dataframe(df_data, self._s3_bucket, f"{self._output_base_path}/stock_prices.{ticker_symbol}.data_{name}.csv")
+            app_s3.write_dataframe(df_target, self._s3_bucket, f"{self._output_base_path}/stock_prices.{ticker_symbol}.target_{name}.csv")
+
+    def materialize_split(self, ticker_symbol):
+        L = get_app_logger(ticker_symbol)
+        L.info(f"materialize_split: {ticker_symbol}")
+
+        # Load split boundaries from the train report
+        df_report = app_s3.read_dataframe(self._s3_bucket, f"{self._output_base_path}/report.csv", index_col=0)
+        df_report.index = df_report.index.astype(str)
+        boundaries = df_report.loc[str(ticker_symbol)]
+
+        # Split data by id range
+        data = self.load_train_data(ticker_symbol)
+
+        train = slice(*np.searchsorted(data["id"], [int(boundaries["train_start_id"]), int(boundaries["train_end_id"]) + 1]))
+        test = slice(*np.searchsorted(data["id"], [int(boundaries["test_start_id"]), int(boundaries["test_end_id"]) + 1]))
+
+        self.save_split_data(ticker_symbol, data, train, test)
+
+    def load_train_data(self, ticker_symbol):
+        return feature_store.read_features(self._s3_bucket, self._feature_base_path, ticker_symbol)
+
+    def split_train_test(self, data, train_start_date, train_end_date, test_start_date, test_end_date):
+        dates = data["date"]
 
         # Check data size
-        if len(df.query(f"date < '{self._train_start_date}'")) == 0 or len(df.query(f"date > '{self._test_end_date}'")) == 0:
+        if len(dates) == 0 or dates[0] >= train_start_date or dates[-1] <= test_end_date:
             raise Exception("little data")
 
-        # Split train/test
-        train_start_id = df.query(f"'{self._train_start_date}' <= date <= '{self._train_end_date}'").index[0]
-        train_end_id = df.query(f"'{self._train_start_date}' <= date <= '{self._train_end_date}'").index[-1]
-        test_start_id = df.query(f"'{self._test_start_date}' <= date <= '{self._test_end_date}'").index[0]
-        test_end_id = df.query(f"'{self._test_start_date}' <= date <= '{self._test_end_date}'").index[-1]
+        # Split train/test, dates are sorted
+        train = slice(np.searchsorted(dates, train_start_date, side="left"), np.searchsorted(dates, train_end_date, side="right"))
+        test = slice(np.searchsorted(dates, test_start_date, side="left"), np.searchsorted(dates, test_end_date, side="right"))
 
-        df_data_train = df.loc[train_start_id: train_end_id].drop(["date", "open_price", "high_price", "low_price", "close_price", "adjusted_close_price", "volume", "predict_target"], axis=1)
-        df_data_test = df.loc[test_start_id: test_end_id].drop(["date", "open_price", "high_price", "low_price", "close_price", "adjusted_close_price", "volume", "predict_target"], axis=1)
-        df_target_train = df.loc[train_start_id: train_end_id][["predict_target"]]
-        df_target_test = df.loc[test_start_id: test_end_id][["predict_target"]]
+        if train.start == train.stop or test.start == test.stop:
+            raise Exception("little data")
 
-        # Save data
-        app_s3.write_dataframe(df_data_train, self._s3_bucket, f"{self._output_base_path}/stock_prices.{ticker_symbol}.data_train.csv")
-        app_s3.write_dataframe(df_data_test, self._s3_bucket, f"{self._output_base_path}/stock_prices.{ticker_symbol}.data_test.csv")
-        app_s3.write_dataframe(df_target_train, self._s3_bucket, f"{self._output_base_path}/stock_prices.{ticker_symbol}.target_train.csv")
-        app_s3.write_dataframe(df_target_test, self._s3_bucket, f"{self._output_base_path}/stock_prices.{ticker_symbol}.target_test.csv")
+        return train, test
 
-        # Transform x, y
-        x_train = df_data_train.values
-        x_test = df_data_test.values
-        y_train = df_target_train.values.flatten()
-        y_test = df_target_test.values.flatten()
+    def train_walk_forward(self, windows):
+        L = get_app_logger()
+        L.info("start")
 
-        return x_train, x_test, y_train, y_test
+        df_companies = self.read_companies(min(window["train_start_date"] for window in windows), min(window["test_end_date"] for window in windows))
 
-    def model_fit(self, x_train, y_train):
-        raise Exception("Not implemented.")
+        # Only windows without a report are computed
+        df_reports = {}
+        for window in windows:
+            name = walk_forward.window_name(window)
+            report_key = f"{self._output_base_path}/walk_forward/{name}/report.csv"
 
-    def model_score(self, clf, x, y):
-        totals = {}
-        counts = {}
+            if app_s3.exists(self._s3_bucket, report_key):
+                L.info(f"skip window: {name}")
+                df_reports[name] = app_s3.read_dataframe(self._s3_bucket, report_key, index_col=0)
 
-        labels = np.unique(y)
+        pending_windows = [window for window in windows if walk_forward.window_name(window) not in df_reports]
 
-        for label in labels:
-            totals[label] = 0
-            counts[label] = 0
+        if len(pending_windows) > 0:
+            # Tickers of an interrupted run are not trained again, a ticker's records are written together
+            checkpoint = app_parallel.checkpoint_path(f"{self._output_base_path}/walk_forward/report.csv")
+            pending_names = [walk_forward.window_name(window) for window in pending_windows]
+            checkpoint_records = [record for record in app_parallel.read_checkpoint(checkpoint) if record["window"] in pending_names]
+            pending_companies = df_companies.loc[app_parallel.pending_keys(df_companies.index, checkpoint_records)]
 
-        y_pred = clf.predict(x)
+            results = app_parallel.imap_unordered(self.train_walk_forward_impl, [(ticker_symbol, pending_windows) for ticker_symbol in pending_companies.index], **self.train_schedule(pending_companies))
+            records = app_parallel.collect_results(self._flatten_windows(results), checkpoint, checkpoint_records)
 
-        for i in range(len(y)):
-            totals[y[i]] += 1
-            if y[i] == y_pred[i]:
-                counts[y[i]] += 1
+            for window in pending_windows:
+                name = walk_forward.window_name(window)
+                window_records = [{k: v for k, v in record.items() if k != "window"} for record in records if record["window"] == name]
 
-        scores = {}
-        for label in labels:
-            scores[f"score_{label}_total"] = totals[label]
-            scores[f"score_{label}_count"] = counts[label]
-            scores[f"score_{label}"] = counts[label] / totals[label]
+                df_reports[name] = app_parallel.join_records(df_companies, window_records)
+                app_s3.write_dataframe(df_reports[name], self._s3_bucket, f"{self._output_base_path}/walk_forward/{name}/report.csv")
 
-        return scores
+        df_result = pd.concat([df_reports[walk_forward.window_name(window)].assign(window=walk_forward.window_name(window)) for window in windows], sort=False)
+        app_s3.write_dataframe(df_result, self._s3_bucket, f"{self._output_base_path}/walk_forward/report.csv")
+        app_parallel.clear_checkpoint(app_parallel.checkpoint_path(f"{self._output_base_path}/walk_forward/report.csv"))
 
+        L.info("finish")
 
-class PredictRegressionBase(PredictClassificationBase):
-    def preprocess_impl(self, ticker_symbol):
-        L = get_app_logger(f"preprocess.{ticker_symbol}")
-        L.info(f"predict preprocess: {ticker_symbol}")
+    def _flatten_windows(self, results):
+        for result in results:
+            if result["exception"] is not None:
+                yield result
+                continue
+
+            for window_result in result["windows"]:
+                yield {"ticker_symbol": result["ticker_symbol"], "exception": None, **window_result}
+
+    def train_walk_forward_impl(self, ticker_symbol, windows):
+        L = get_app_logger(ticker_symbol)
+        L.info(f"train_walk_forward: {ticker_symbol}")
 
         result = {
             "ticker_symbol": ticker_symbol,
-            "exception": None
+            "exception": None,
+            "windows": []
         }
 
         try:
-            # Load data
-            df_preprocess = app_s3.read_dataframe(self._s3_bucket, f"{self._input_preprocess_base_path}/stock_prices.{ticker_symbol}.csv", index_col=0)
-            df_simulate = app_s3.read_dataframe(self._s3_bucket, f"{self._input_simulate_base_path}/stock_prices.{ticker_symbol}.csv", index_col=0)
+            # Load data once, and reuse it for every window
+            data = self.load_train_data(ticker_symbol)
+
+            for window in windows:
+                name = walk_forward.window_name(window)
+                model_key = f"{self._output_base_path}/walk_forward/{name}/model.{ticker_symbol}.joblib"
+
+                try:
+                    train, test = self.split_train_test(data, **window)
+                except Exception as err:
+                    L.info(f"skip window: ticker_symbol={ticker_symbol}, window={name}, {err}")
+                    continue
+
+                if app_s3.exists(self._s3_bucket, model_key):
+                    clf = app_s3.read_sklearn_model(self._s3_bucket, model_key)
+                else:
+                    clf = self.model_fit(data["x"][train], data["y"][train])
+                    app_s3.write_sklearn_model(clf, self._s3_bucket, model_key)
+                    self.write_predictions(clf, data["x"], data, f"{self._output_base_path}/walk_forward/{name}", ticker_symbol)
+
+                result["windows"].append({"window": name, **self.model_score(clf, data["x"][test], data["y"][test])})
+        except Exception as err:
+            L.exception(f"ticker_symbol={ticker_symbol}, {err}")
+            result["exception"] = err
 
-            # Check data size
-            if len(df_preprocess.query(f"date < '{self._train_start_date}'")) == 0 or len(df_preprocess.query(f"date > '{self._test_end_date}'")) == 0:
-                raise Exception("little data")
+        return result
 
-            # Preprocess
-            df = df_preprocess[[
-                "date",
-                "open_price",
-                "high_price",
-                "low_price",
-                "close_price",
-                "adjusted_close_price",
-                "volume",
-                "sma_5_std",
-                "sma_10_std",
-                "sma_20_std",
-                "sma_40_std",
-                "sma_80_std",
-                "momentum_5_std",
-                "momentum_10_std",
-                "momentum_20_std",
-                "momentum_40_std",
-                "momentum_80_std",
-                "roc_5_std",
-                "roc_10_std",
-                "roc_20_std",
-                "roc_40_std",
-                "roc_80_std",
-                "rsi_5_std",
-                "rsi_10_std",
-                "rsi_14_std",
-                "rsi_20_std",
-                "rsi_40_std",
-                "stochastic_k_5_std",
-                "stochastic_d_5_std",
-                "stochastic_sd_5_std",
-                "stochastic_k_9_std",
-                "stochastic_d_9_std",
-                "stochastic_sd_9_std",
-                "stochastic_k_20_std",
-                "stochastic_d_20_std",
-                "stochastic_sd_20_std",
-                "stochastic_k_25_std",
-                "stochastic_d_25_std",
-                "stochastic_sd_25_std",
-                "stochastic_k_40_std",
-                "stochastic_d_40_std",
-                "stochastic_sd_40_std"
-            ]].copy()
-
-            df["predict_target"] = df_simulate["profit_rate"].shift(-1)
+    def train_pooled(self, ticker_feature=False, market_feature=False, batch_size=100, max_train_rows=1000000, random_state=0):
+        L = get_app_logger()
+        L.info("start")
 
-            df = df.dropna()
+        pooled_base_path = f"{self._output_base_path}/pooled"
 
-            # Save data
-            app_s3.write_dataframe(df, self._s3_bucket, f"{self._output_base_path}/stock_prices.{ticker_symbol}.csv")
+        df_companies = self.read_companies(self._train_start_date, self._test_end_date)
+
+        # Fetch feature matrices into the local cache, and split each ticker
+        results = app_parallel.imap_unordered(self.load_split_impl, [(ticker_symbol,) for ticker_symbol in df_companies.index], **self.train_schedule(df_companies))
+        splits = {record["ticker_symbol"]: record for record in app_parallel.collect_results(results)}
+
+        ticker_symbols = [ticker_symbol for ticker_symbol in df_companies.index if ticker_symbol in splits]
+        if len(ticker_symbols) == 0:
+            raise Exception("no train data")
+
+        # Train one model on stacked features of all tickers
+        markets = df_companies["market"].to_dict() if market_feature and "market" in df_companies.columns else None
+        model = PooledModel(ticker_symbols=ticker_symbols if ticker_feature else None, markets=markets)
+
+        train_rows = self.pooled_train_rows(ticker_symbols, splits, max_train_rows)
+        classes = np.unique(np.concatenate([splits[ticker_symbol].get("classes", []) for ticker_symbol in ticker_symbols]))
+        model.clf = self.model_fit_batches(self._pooled_batches(model, ticker_symbols, splits, train_rows, batch_size, random_state), sum(train_rows.values()), classes)
+
+        model_key = f"{pooled_base_path}/model.pooled.joblib"
+        app_s3.write_sklearn_model(model, self._s3_bucket, model_key)
+
+        # Score and write predictions of each ticker in the workers, as train does
+        df_companies = df_companies.loc[ticker_symbols]
+
+        results = app_parallel.imap_unordered(self.score_pooled_impl, [(ticker_symbol, model_key, splits[ticker_symbol], pooled_base_path) for ticker_symbol in df_companies.index], **self.train_schedule(df_companies))
+        records = app_parallel.collect_results(self._flatten_scores(results))
+
+        df_result = app_parallel.join_records(df_companies, records)
+
+        app_s3.write_dataframe(df_result, self._s3_bucket, f"{pooled_base_path}/report.csv")
+
+        L.info("finish")
+
+    def pooled_train_rows(self, ticker_symbols, splits, max_train_rows):
+        train_rows = {ticker_symbol: splits[ticker_symbol]["train_stop"] - splits[ticker_symbol]["train_start"] for ticker_symbol in ticker_symbols}
+        data_size = sum(train_rows.values())
+
+        # partial_fit sees every row one batch at a time, other estimators fit one matrix, whose rows are sampled from each ticker in proportion to its size
+        if hasattr(self.build_model(**self._model_params), "partial_fit") or max_train_rows is None or data_size <= max_train_rows:
+            return train_rows
+
+        return {ticker_symbol: rows * max_train_rows // data_size for ticker_symbol, rows in train_rows.items()}
+
+    def score_pooled_impl(self, ticker_symbol, model_key, split, pooled_base_path):
+        L = get_app_logger(ticker_symbol)
+        L.info(f"score_pooled: {ticker_symbol}")
+
+        result = {
+            "ticker_symbol": ticker_symbol,
+            "exception": None,
+            "scores": None
+        }
+
+        try:
+            model = _read_pooled_model(self._s3_bucket, model_key)
+
+            data = self.load_train_data(ticker_symbol)
+            train = slice(split["train_start"], split["train_stop"])
+            test = slice(split["test_start"], split["test_stop"])
+
+            result.update(self.split_boundaries(data, train, test))
+            result["scores"] = self.model_score(model.clf, model.transform(ticker_symbol, data["x"][test]), data["y"][test])
+
+            self.write_predictions(model.clf, model.transform(ticker_symbol, data["x"]), data, pooled_base_path, ticker_symbol)
         except Exception as err:
             L.exception(f"ticker_symbol={ticker_symbol}, {err}")
             result["exception"] = err
 
         return result
 
+    def load_split_impl(self, ticker_symbol):
+        L = get_app_logger(ticker_symbol)
+
+        result = {
+            "ticker_symbol": ticker_symbol,
+            "exception": None
+        }
+
+        try:
+            data = self.load_train_data(ticker_symbol)
+            train, test = self.split_train_test(data, self._train_start_date, self._train_end_date, self._test_start_date, self._test_end_date)
+
+            result.update({"train_start": train.start, "train_stop": train.stop, "test_start": test.start, "test_stop": test.stop})
+
+            # partial_fit of a classifier needs the classes of every ticker with the first batch
+            if is_classifier(self.build_model(**self._model_params)):
+                result["classes"] = np.unique(data["y"][train]).tolist()
+        except Exception as err:
+            L.info(f"skip: ticker_symbol={ticker_symbol}, {err}")
+            result["exception"] = err
+
+        return result
+
+    def _pooled_batches(self, model, ticker_symbols, splits, train_rows, batch_size, random_state):
+        rng = np.random.RandomState(random_state)
+
+        for i in range(0, len(ticker_symbols), batch_size):
+            x_batch = []
+            y_batch = []
+
+            for ticker_symbol in ticker_symbols[i:i + batch_size]:
+                data = self.load_train_data(ticker_symbol)
+                train = np.arange(splits[ticker_symbol]["train_start"], splits[ticker_symbol]["train_stop"])
+
+                if train_rows[ticker_symbol] < len(train):
+                    train = np.sort(rng.choice(train, train_rows[ticker_symbol], replace=False))
+
+                x_batch.append(model.transform(ticker_symbol, data["x"][train]))
+                y_batch.append(data["y"][train])
+
+            yield np.concatenate(x_batch), np.concatenate(y_batch)
+
+    def model_fit_batches(self, batches, data_size, classes=None):
+        clf = self.build_model(**self._model_params)
+
+        # Fit in the parent process on every core, the saved model keeps the n_jobs of the workers that load it
+        parallel = "n_jobs" in clf.get_params() and "n_jobs" not in self._model_params
+        if parallel:
+            n_jobs = clf.n_jobs
+            clf.set_params(n_jobs=-1)
+
+        # Estimators with partial_fit learn batch by batch, only one batch is in memory
+        if hasattr(clf, "partial_fit"):
+            for x, y in batches:
+                if is_classifier(clf):
+                    clf.partial_fit(x, y, classes=classes)
+                else:
+                    clf.partial_fit(x, y)
+        else:
+            # Other estimators are not streamed: batches are stacked into one preallocated matrix, of the rows sampled by pooled_train_rows
+            x_train = None
+            y_train = None
+            position = 0
+
+            for x, y in batches:
+                if x_train is None:
+                    x_train = np.empty((data_size, x.shape[1]), dtype=np.float64)
+                    y_train = np.empty(data_size, dtype=y.dtype)
+
+                x_train[position:position + len(x)] = x
+                y_train[position:position + len(y)] = y
+                position += len(x)
+
+            clf.fit(x_train[:position], y_train[:position])
+
+        if parallel:
+            clf.set_params(n_jobs=n_jobs)
+
+        return clf
+
+    def search(self, n_candidates=27, eta=3, n_tickers=81, random_state=0):
+        L = get_app_logger()
+        L.info("start")
+
+        search_base_path = f"{self._output_base_path}/search"
+
+        df_companies = self.read_companies(self._train_start_date, self._test_end_date)
+
+        # Sample tickers, and fetch their feature matrices into the local cache once for all candidates
+        ticker_symbols = np.random.RandomState(random_state).permutation(df_companies.index.values)[:n_tickers * 2]
+
+        results = app_parallel.imap_unordered(self.load_split_impl, [(ticker_symbol,) for ticker_symbol in ticker_symbols])
+        splits = {record["ticker_symbol"]: record for record in app_parallel.collect_results(results)}
+
+        ticker_symbols = [ticker_symbol for ticker_symbol in ticker_symbols if ticker_symbol in splits][:n_tickers]
+        if len(ticker_symbols) == 0:
+            raise Exception("no train data")
+
+        candidates = list(ParameterSampler(self.PARAM_DISTRIBUTIONS, n_candidates, random_state=random_state))
+
+        # Successive halving: keep the best 1/eta candidates, and give them eta times more tickers
+        rung_count = 1
+        while len(candidates) // eta ** rung_count >= 1:
+            rung_count += 1
+        candidate_ids = list(range(len(candidates)))
+        records = []
+
+        for rung in range(rung_count):
+            rung_ticker_symbols = ticker_symbols[:max(1, len(ticker_symbols) // eta ** (rung_count - 1 - rung))]
+            L.info(f"rung: {rung}, candidates={len(candidate_ids)}, tickers={len(rung_ticker_symbols)}")
+
+            results = app_parallel.imap_unordered(self.search_impl, [(candidate_id, candidates[candidate_id], ticker_symbol, splits[ticker_symbol]) for candidate_id in candidate_ids for ticker_symbol in rung_ticker_symbols], max_memory=self._max_memory, threads_per_task=self._train_threads)
+
+            metrics = {candidate_id: [] for candidate_id in candidate_ids}
+            for record in app_parallel.collect_results(results):
+                metrics[record["candidate_id"]].append(record["metric"])
+
+            means = {candidate_id: np.nanmean(values) if len(values) > 0 else np.nan for candidate_id, values in metrics.items()}
+
+            for candidate_id in candidate_ids:
+                records.append({
+                    "candidate_id": candidate_id,
+                    "rung": rung,
+                    "ticker_count": len(metrics[candidate_id]),
+                    "metric": means[candidate_id],
+                    "metric_std": np.nanstd(metrics[candidate_id]) if len(metrics[candidate_id]) > 0 else np.nan,
+                    "params": json.dumps(candidates[candidate_id], sort_keys=True, default=str)
+                })
+
+            ranked = sorted(candidate_ids, key=lambda candidate_id: -means[candidate_id] if not np.isnan(means[candidate_id]) else np.inf)
+            candidate_ids = ranked[:max(1, len(ranked) // eta)]
+
+        df_leaderboard = pd.DataFrame.from_records(records).sort_values(["rung", "metric"], ascending=False).reset_index(drop=True)
+        app_s3.write_dataframe(df_leaderboard, self._s3_bucket, f"{search_base_path}/leaderboard.csv")
+
+        best_params = candidates[candidate_ids[0]]
+        app_s3.write_dataframe(pd.DataFrame([best_params]), self._s3_bucket, f"{search_base_path}/best_params.csv")
+
+        L.info(f"best params: {json.dumps(best_params, sort_keys=True, default=str)}")
+        L.info("finish")
+
+    def search_impl(self, candidate_id, params, ticker_symbol, split):
+        L = get_app_logger(ticker_symbol)
+
+        result = {
+            "ticker_symbol": ticker_symbol,
+            "exception": None,
+            "candidate_id": candidate_id,
+            "metric": None
+        }
+
+        try:
+            data = self.load_train_data(ticker_symbol)
+            train = slice(split["train_start"], split["train_stop"])
+            test = slice(split["test_start"], split["test_stop"])
+
+            clf = self.build_model(**params).fit(data["x"][train], data["y"][train])
+
+            result["metric"] = self.search_metric(self.model_score(clf, data["x"][test], data["y"][test]))
+        except Exception as err:
+            L.exception(f"ticker_symbol={ticker_symbol}, candidate_id={candidate_id}, {err}")
+            result["exception"] = err
+
+        return result
+
+    def search_metric(self, scores):
+        # Balanced accuracy, higher is better
+        return np.mean([v for k, v in scores.items() if k.startswith("recall_")])
+
+    def build_model(self, **params):
+        raise Exception("Not implemented.")
+
+    def model_fit(self, x_train, y_train):
+        return self.build_model(**self._model_params).fit(x_train, y_train)
+
+    def write_predictions(self, clf, x, data, base_path, ticker_symbol):
+        # Prediction over the full history, so that backtests do not load the model
+        y_proba = predict_metrics.positive_proba(clf, x)
+
+        predictions = {
+            "id": np.asarray(data["id"], dtype=np.int64),
+            "date": np.asarray(data["date"]),
+            "predict": clf.predict(x),
+            "predict_proba": y_proba if y_proba is not None else np.full(len(x), np.nan)
+        }
+
+        # Same formats as the feature store, CSV for humans, joblib arrays for backtests
+        df = pd.DataFrame({k: v for k, v in predictions.items() if k != "id"}, index=pd.Index(predictions["id"], name="id"))
+        app_s3.write_dataframe(df, self._s3_bucket, f"{base_path}/predictions.{ticker_symbol}.csv")
+
+        feature_store.write_matrix(predictions, self._s3_bucket, f"{base_path}/predictions.{ticker_symbol}.joblib")
+
+    def model_score(self, clf, x, y):
+        y_pred = clf.predict(x)
+        y_proba = predict_metrics.positive_proba(clf, x)
+
+        return predict_metrics.classification_scores(y, y_pred, y_proba, clf.classes_[-1] if y_proba is not None else None)
+
+
+class PooledModel():
+    def __init__(self, ticker_symbols=None, markets=None):
+        self.clf = None
+
+        # Category codes, -1 for unknown
+        self.ticker_codes = {ticker_symbol: i for i, ticker_symbol in enumerate(ticker_symbols)} if ticker_symbols is not None else None
+        self.markets = markets
+        self.market_codes = {market: i for i, market in enumerate(sorted(set(markets.values()), key=str))} if markets is not None else None
+
+    def transform(self, ticker_symbol, x):
+        columns = [np.asarray(x, dtype=np.float64)]
+
+        if self.ticker_codes is not None:
+            columns.append(np.full((len(x), 1), self.ticker_codes.get(ticker_symbol, -1), dtype=np.float64))
+
+        if self.market_codes is not None:
+            columns.append(np.full((len(x), 1), self.market_codes.get(self.markets.get(ticker_symbol), -1), dtype=np.float64))
+
+        return np.hstack(columns)
+
+    def predict(self, ticker_symbol, x):
+        return self.clf.predict(self.transform(ticker_symbol, x))
+
+
+# Pooled model of the run, downloaded once per worker process
+_POOLED_MODELS = {}
+
+
+def _read_pooled_model(s3_bucket, model_key):
+    key = (s3_bucket, model_key, app_s3.get_etag(s3_bucket, model_key))
+
+    if key not in _POOLED_MODELS:
+        _POOLED_MODELS.clear()
+        _POOLED_MODELS[key] = app_s3.read_sklearn_model(s3_bucket, model_key)
+
+    return _POOLED_MODELS[key]
+
+
+class PredictRegressionBase(PredictClassificationBase):
+    PREDICT_TARGET = "profit_rate"
+
+    def predict_target(self, df_simulate):
+        return df_simulate["profit_rate"].shift(-1)
+
     def model_score(self, clf, x, y):
         y_pred = clf.predict(x)
 
@@ -306,3 +756,6 @@ class PredictRegressionBase(PredictClassificationBase):
             "rmse": rmse,
             "r2": r2
         }
+
+    def search_metric(self, scores):
+        return -scores["rmse"]
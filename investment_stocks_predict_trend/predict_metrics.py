@@ -0,0 +1,134 @@
+import numpy as np
+
+
+CALIBRATION_BINS = 5
+
+
+def confusion_matrices(groups, y, y_pred, labels, group_count):
+    # cm[g, true, pred], counted with one bincount over all groups
+    label_count = len(labels)
+
+    # labels must hold every label of y and y_pred
+    y_codes = np.searchsorted(labels, y)
+    y_pred_codes = np.searchsorted(labels, y_pred)
+
+    codes = (groups * label_count + y_codes) * label_count + y_pred_codes
+    cm = np.bincount(codes, minlength=group_count * label_count * label_count)
+
+    return cm.reshape(group_count, label_count, label_count)
+
+
+def roc_auc_scores(groups, y_true, y_score, group_count):
+    # Mann-Whitney U per group, with average rank for ties
+    y_true = np.asarray(y_true, dtype=bool)
+    y_score = np.asarray(y_score, dtype=np.float64)
+
+    order = np.lexsort((y_score, groups))
+    g = groups[order]
+    s = y_score[order]
+    t = y_true[order]
+
+    group_start = np.searchsorted(g, np.arange(group_count))
+    position = np.arange(len(g)) - group_start[g] + 1
+
+    tie_change = np.ones(len(g), dtype=bool)
+    tie_change[1:] = (g[1:] != g[:-1]) | (s[1:] != s[:-1])
+    tie_ids = np.cumsum(tie_change) - 1
+
+    rank = (np.bincount(tie_ids, weights=position) / np.bincount(tie_ids))[tie_ids]
+
+    pos_count = np.bincount(g, weights=t, minlength=group_count)
+    neg_count = np.bincount(g, weights=~t, minlength=group_count)
+    rank_sum = np.bincount(g, weights=rank * t, minlength=group_count)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        auc = (rank_sum - pos_count * (pos_count + 1) / 2) / (pos_count * neg_count)
+
+    return np.where((pos_count > 0) & (neg_count > 0), auc, np.nan)
+
+
+def calibration_bins(groups, y_true, y_score, group_count, n_bins=CALIBRATION_BINS):
+    # Mean predicted probability and observed positive rate per probability bin
+    bins = np.minimum((np.asarray(y_score, dtype=np.float64) * n_bins).astype(np.int64), n_bins - 1)
+    codes = groups * n_bins + bins
+
+    count = np.bincount(codes, minlength=group_count * n_bins).reshape(group_count, n_bins)
+    proba_total = np.bincount(codes, weights=y_score, minlength=group_count * n_bins).reshape(group_count, n_bins)
+    positive_total = np.bincount(codes, weights=np.asarray(y_true, dtype=np.float64), minlength=group_count * n_bins).reshape(group_count, n_bins)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return count, proba_total / count, positive_total / count
+
+
+def classification_scores_batch(ys, y_preds, y_probas=None, positive_label=None):
+    # Score many tickers in one call, returns one dict per ticker
+    group_count = len(ys)
+    if group_count == 0:
+        return []
+
+    sizes = np.array([len(y) for y in ys])
+    groups = np.repeat(np.arange(group_count), sizes)
+
+    y = np.concatenate(ys)
+    y_pred = np.concatenate(y_preds)
+
+    # Predicted labels absent from y still count against precision and recall
+    labels = np.unique(np.concatenate([y, y_pred]))
+    cm = confusion_matrices(groups, y, y_pred, labels, group_count)
+
+    totals = cm.sum(axis=2)
+    counts = np.diagonal(cm, axis1=1, axis2=2)
+    predicted = cm.sum(axis=1)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        recalls = counts / totals
+        precisions = counts / predicted
+
+    results = []
+    for i in range(group_count):
+        scores = {}
+
+        # Only labels in this ticker's test data, as before
+        for j, label in enumerate(labels):
+            if totals[i, j] == 0:
+                continue
+
+            scores[f"score_{label}_total"] = totals[i, j]
+            scores[f"score_{label}_count"] = counts[i, j]
+            scores[f"score_{label}"] = recalls[i, j]
+            scores[f"precision_{label}"] = precisions[i, j]
+            scores[f"recall_{label}"] = recalls[i, j]
+
+        results.append(scores)
+
+    if y_probas is None:
+        return results
+
+    # Probability of the positive label, binary only
+    y_true = y == (labels[-1] if positive_label is None else positive_label)
+    y_score = np.concatenate(y_probas)
+
+    auc = roc_auc_scores(groups, y_true, y_score, group_count)
+    bin_count, bin_proba, bin_rate = calibration_bins(groups, y_true, y_score, group_count)
+
+    for i in range(group_count):
+        results[i]["roc_auc"] = auc[i]
+
+        for b in range(bin_count.shape[1]):
+            results[i][f"calibration_{b}_count"] = bin_count[i, b]
+            results[i][f"calibration_{b}_proba"] = bin_proba[i, b]
+            results[i][f"calibration_{b}_rate"] = bin_rate[i, b]
+
+    return results
+
+
+def classification_scores(y, y_pred, y_proba=None, positive_label=None):
+    return classification_scores_batch([y], [y_pred], [y_proba] if y_proba is not None else None, positive_label)[0]
+
+
+def positive_proba(clf, x):
+    # None when the estimator has no probabilities, or the target is not binary
+    if not hasattr(clf, "predict_proba") or len(getattr(clf, "classes_", [])) != 2:
+        return None
+
+    return clf.predict_proba(x)[:, 1]
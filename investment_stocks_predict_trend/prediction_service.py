@@ -0,0 +1,123 @@
+import collections
+import os
+import time
+
+import joblib
+import numpy as np
+
+import app_s3
+from predict_base import PooledModel
+
+
+CACHE_DIR = "local/model_cache"
+MAX_MODELS = 32
+ETAG_TTL = 60
+
+# One service per worker process
+_SERVICES = {}
+
+
+def get_service(s3_bucket):
+    if s3_bucket not in _SERVICES:
+        _SERVICES[s3_bucket] = PredictionService(s3_bucket)
+
+    return _SERVICES[s3_bucket]
+
+
+class PredictionService():
+    def __init__(self, s3_bucket, max_models=MAX_MODELS, cache_dir=CACHE_DIR, etag_ttl=ETAG_TTL):
+        self._s3_bucket = s3_bucket
+        self._max_models = max_models
+        self._cache_dir = cache_dir
+        self._etag_ttl = etag_ttl
+        self._models = collections.OrderedDict()
+        self._etags = {}
+
+    def exists(self, s3_key):
+        return self._etag(s3_key) is not None
+
+    def load_model(self, s3_key):
+        return self._load(s3_key)
+
+    def load_predictions(self, s3_key):
+        # Prediction series of a ticker, kept in the LRU with the models
+        return self._load(s3_key)
+
+    def _load(self, s3_key):
+        # LRU of deserialized objects, one rewritten in place is loaded again once its ETag is checked
+        etag = self._etag(s3_key)
+
+        if s3_key in self._models and self._models[s3_key][0] == etag:
+            self._models.move_to_end(s3_key)
+            return self._models[s3_key][1]
+
+        value = joblib.load(self._fetch(s3_key))
+
+        self._models[s3_key] = (etag, value)
+        self._models.move_to_end(s3_key)
+        while len(self._models) > self._max_models:
+            self._models.popitem(last=False)
+
+        return value
+
+    def predict(self, s3_key, x, ticker_symbol=None):
+        model = self.load_model(s3_key)
+
+        if isinstance(model, PooledModel):
+            return model.predict(ticker_symbol, x)
+
+        return model.predict(x)
+
+    def predict_batch(self, requests):
+        # requests: list of (s3_key, ticker_symbol, x), returns predictions in the same order
+        predictions = [None] * len(requests)
+
+        groups = collections.defaultdict(list)
+        for i, (s3_key, ticker_symbol, x) in enumerate(requests):
+            groups[s3_key].append(i)
+
+        for s3_key, indexes in groups.items():
+            model = self.load_model(s3_key)
+
+            if isinstance(model, PooledModel):
+                # Stack every ticker for the pooled model, and predict once
+                xs = [model.transform(requests[i][1], requests[i][2]) for i in indexes]
+                y_pred = model.clf.predict(np.concatenate(xs))
+
+                for i, y in zip(indexes, np.split(y_pred, np.cumsum([len(x) for x in xs])[:-1])):
+                    predictions[i] = y
+            else:
+                for i in indexes:
+                    predictions[i] = model.predict(requests[i][2])
+
+        return predictions
+
+    def _etag(self, s3_key):
+        # Checked again after the TTL, so that a long-lived service picks up a retrained model
+        if s3_key not in self._etags or time.time() - self._etags[s3_key][1] >= self._etag_ttl:
+            self._etags[s3_key] = (app_s3.get_etag(self._s3_bucket, s3_key), time.time())
+
+        return self._etags[s3_key][0]
+
+    def _fetch(self, s3_key):
+        # Local copy is reused while its ETag matches S3
+        etag = self._etag(s3_key)
+        if etag is None:
+            raise Exception(f"model not found: {s3_key}")
+
+        path = os.path.join(self._cache_dir, self._s3_bucket, s3_key)
+        etag_path = f"{path}.etag"
+
+        if os.path.exists(path) and os.path.exists(etag_path):
+            with open(etag_path) as f:
+                if f.read() == etag:
+                    return path
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        app_s3.download_file(self._s3_bucket, s3_key, f"{path}.{os.getpid()}.tmp")
+        os.replace(f"{path}.{os.getpid()}.tmp", path)
+
+        with open(etag_path, "w") as f:
+            f.write(etag)
+
+        return path
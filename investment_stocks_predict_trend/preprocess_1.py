@@ -5,6 +5,7 @@ import pandas as pd
 
 from app_logging import get_app_logger
 import app_s3
+import manifest
 
 
 def execute(*, s3_bucket, input_prices_base_path, input_indexes_base_path, output_base_path, test_mode):
@@ -20,6 +21,7 @@ def execute(*, s3_bucket, input_prices_base_path, input_indexes_base_path, outpu
         .drop_duplicates() \
         .set_index("ticker_symbol")
     df_companies_result = pd.DataFrame(columns=df_companies.columns)
+    manifests = {}
 
     # Preprocess
     results = joblib.Parallel(n_jobs=-1)([joblib.delayed(preprocess)(ticker_symbol, s3_bucket, input_prices_base_path, output_base_path, test_mode) for ticker_symbol in df_companies.index])
@@ -31,6 +33,7 @@ def execute(*, s3_bucket, input_prices_base_path, input_indexes_base_path, outpu
 
         ticker_symbol = result["ticker_symbol"]
         df_companies_result.loc[ticker_symbol] = df_companies.loc[ticker_symbol]
+        manifests[ticker_symbol] = result["manifest"]
 
     # Indexes
     indexes = {
@@ -48,8 +51,10 @@ def execute(*, s3_bucket, input_prices_base_path, input_indexes_base_path, outpu
 
         # Total result
         df_companies_result.at[ticker_symbol, "name"] = indexes[ticker_symbol]
+        manifests[ticker_symbol] = result["manifest"]
 
     # Save data
+    df_companies_result = manifest.join_manifest(df_companies_result, manifests)
     app_s3.write_dataframe(df_companies_result, s3_bucket, f"{output_base_path}/companies.csv")
 
     L.info("finish")
@@ -61,7 +66,8 @@ def preprocess(ticker_symbol, s3_bucket, input_base_path, output_base_path, test
 
     result = {
         "ticker_symbol": ticker_symbol,
-        "exception": None
+        "exception": None,
+        "manifest": None
     }
 
     try:
@@ -87,6 +93,8 @@ def preprocess(ticker_symbol, s3_bucket, input_base_path, output_base_path, test
 
         # Save data
         app_s3.write_dataframe(df, s3_bucket, f"{output_base_path}/stock_prices.{ticker_symbol}.csv")
+
+        result["manifest"] = manifest.build_manifest(df)
     except Exception as err:
         L.exception(f"ticker_symbol={ticker_symbol}, {err}")
         result["exception"] = err
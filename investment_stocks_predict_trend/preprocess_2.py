@@ -6,6 +6,7 @@ from sklearn.preprocessing import StandardScaler, MinMaxScaler
 
 from app_logging import get_app_logger
 import app_s3
+import manifest
 
 
 def execute(*, s3_bucket, input_base_path, output_base_path):
@@ -14,6 +15,7 @@ def execute(*, s3_bucket, input_base_path, output_base_path):
 
     df_companies = app_s3.read_dataframe(s3_bucket, f"{input_base_path}/companies.csv", index_col=0)
     df_companies_result = pd.DataFrame(columns=df_companies.columns)
+    manifests = {}
 
     results = joblib.Parallel(n_jobs=-1)([joblib.delayed(preprocess)(ticker_symbol, s3_bucket, input_base_path, output_base_path) for ticker_symbol in df_companies.index])
 
@@ -23,7 +25,9 @@ def execute(*, s3_bucket, input_base_path, output_base_path):
 
         ticker_symbol = result["ticker_symbol"]
         df_companies_result.loc[ticker_symbol] = df_companies.loc[ticker_symbol]
+        manifests[ticker_symbol] = result["manifest"]
 
+    df_companies_result = manifest.join_manifest(df_companies_result, manifests)
     app_s3.write_dataframe(df_companies_result, s3_bucket, f"{output_base_path}/companies.csv")
 
     L.info("finish")
@@ -35,7 +39,8 @@ def preprocess(ticker_symbol, s3_bucket, input_base_path, output_base_path):
 
     result = {
         "ticker_symbol": ticker_symbol,
-        "exception": None
+        "exception": None,
+        "manifest": None
     }
 
     try:
@@ -215,6 +220,8 @@ def preprocess(ticker_symbol, s3_bucket, input_base_path, output_base_path):
 
         # Save
         app_s3.write_dataframe(df, s3_bucket, f"{output_base_path}/stock_prices.{ticker_symbol}.csv")
+
+        result["manifest"] = manifest.build_manifest(df)
     except Exception as err:
         L.exception(f"ticker_symbol={ticker_symbol}, {err}")
         result["exception"] = err
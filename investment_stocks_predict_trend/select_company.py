@@ -1,11 +1,21 @@
+import argparse
+import codecs
+import csv
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 import numpy as np
 import psycopg2
+import psycopg2.pool
 
+import app_parallel
+import app_s3
+import company_summary
 
-def export_stock_prices():
-    con_config = {
+
+def get_connection_config():
+    return {
         "host": os.environ["DB_HOST"],
         "port": os.environ["DB_PORT"],
         "database": os.environ["DB_DATABASE"],
@@ -13,7 +23,13 @@ def export_stock_prices():
         "password": os.environ["DB_PASSWORD"]
     }
 
-    con = psycopg2.connect(**con_config)
+
+def get_connection():
+    return psycopg2.connect(**get_connection_config())
+
+
+def export_stock_prices():
+    con = get_connection()
 
     df_companies = pd.read_sql(sql="select * from companies", con=con)
 
@@ -27,8 +43,9 @@ def export_stock_prices():
     for ticker_symbol in df_companies["ticker_symbol"].values:
         print(f"ticker_symbol: {ticker_symbol}")
 
-        df = pd.read_sql(sql=f"select * from stock_prices where ticker_symbol='{ticker_symbol}'",
-                         con=con)
+        df = pd.read_sql(sql="select * from stock_prices where ticker_symbol=%(ticker_symbol)s",
+                         con=con,
+                         params={"ticker_symbol": str(ticker_symbol)})
 
         df = df.sort_values("date")
         df = df.assign(id=np.arange(len(df)))
@@ -39,6 +56,303 @@ def export_stock_prices():
         df.to_csv(f"local/stock_prices/stock_prices.{ticker_symbol}.csv")
 
 
+def export_stock_prices_bulk(output_dir="local/stock_prices"):
+    # Stream the whole table once, ordered by ticker/date, and split it into per-ticker CSVs on the fly
+    con = get_connection()
+
+    os.makedirs(output_dir, exist_ok=True)
+
+    def open_output(ticker_symbol):
+        return open(f"{output_dir}/stock_prices.{ticker_symbol}.csv", "w", newline="")
+
+    with con.cursor() as cur, StockPricesSplitter(open_output) as splitter:
+        cur.copy_expert("COPY (select * from stock_prices order by ticker_symbol, date) TO STDOUT WITH CSV HEADER", splitter)
+
+    print(f"tickers: {splitter.ticker_count}, rows: {splitter.row_count}")
+
+    con.close()
+
+
+def export_stock_prices_parallel(output_dir="local/stock_prices", n_workers=4):
+    # Tickers are partitioned across workers, each worker holds one pooled connection
+    con = get_connection()
+    df_companies = pd.read_sql(sql="select ticker_symbol from companies order by ticker_symbol", con=con)
+    con.close()
+
+    ticker_symbols = [str(ticker_symbol) for ticker_symbol in df_companies["ticker_symbol"].values]
+    partitions = [ticker_symbols[i::n_workers] for i in range(n_workers)]
+
+    os.makedirs(output_dir, exist_ok=True)
+
+    pool = psycopg2.pool.ThreadedConnectionPool(1, n_workers, **get_connection_config())
+
+    try:
+        start_time = time.time()
+
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            stats = list(executor.map(lambda args: export_stock_prices_partition(pool, *args, output_dir), enumerate(partitions)))
+
+        elapsed = max(time.time() - start_time, 1e-6)
+    finally:
+        pool.closeall()
+
+    row_count = sum(stat["row_count"] for stat in stats)
+    byte_count = sum(stat["byte_count"] for stat in stats)
+
+    print(f"total: workers={n_workers}, tickers={len(ticker_symbols)}, rows={row_count}, bytes={byte_count}, elapsed={elapsed:.1f}s, rows/s={row_count / elapsed:.1f}, bytes/s={byte_count / elapsed:.1f}")
+
+
+def export_stock_prices_partition(pool, worker_id, ticker_symbols, output_dir):
+    stat = {
+        "worker_id": worker_id,
+        "ticker_count": 0,
+        "row_count": 0,
+        "byte_count": 0
+    }
+
+    def open_output(ticker_symbol):
+        return open(f"{output_dir}/stock_prices.{ticker_symbol}.csv", "w", newline="")
+
+    start_time = time.time()
+
+    con = pool.getconn()
+    try:
+        with con.cursor() as cur:
+            for ticker_symbol in ticker_symbols:
+                query = cur.mogrify("select * from stock_prices where ticker_symbol=%s order by date", (ticker_symbol,)).decode()
+
+                with StockPricesSplitter(open_output) as splitter:
+                    cur.copy_expert(f"COPY ({query}) TO STDOUT WITH CSV HEADER", splitter)
+
+                stat["ticker_count"] += 1
+                stat["row_count"] += splitter.row_count
+                stat["byte_count"] += splitter.byte_count
+    finally:
+        pool.putconn(con)
+
+    elapsed = max(time.time() - start_time, 1e-6)
+    stat["elapsed"] = elapsed
+
+    print(f"worker: {worker_id}, tickers={stat['ticker_count']}, rows={stat['row_count']}, bytes={stat['byte_count']}, elapsed={elapsed:.1f}s, rows/s={stat['row_count'] / elapsed:.1f}, bytes/s={stat['byte_count'] / elapsed:.1f}")
+
+    return stat
+
+
+def export_stock_prices_incremental(output_dir="local/stock_prices", s3_bucket=None, s3_base_path=None):
+    # Fetch only rows newer than the last exported date of each ticker, and append them
+    con = get_connection()
+
+    state_path = f"{s3_base_path}/export_state.csv" if s3_bucket is not None else f"{output_dir}/export_state.csv"
+    df_state = read_export_state(state_path, s3_bucket)
+
+    df_companies = pd.read_sql(sql="select ticker_symbol from companies", con=con)
+    ticker_symbols = [str(ticker_symbol) for ticker_symbol in df_companies["ticker_symbol"].values]
+
+    # One query per last date, so that a stale ticker fetches only its own rows, not every ticker's since its last date
+    exported = [ticker_symbol for ticker_symbol in ticker_symbols if ticker_symbol in df_state.index]
+
+    for last_date, df_exported in df_state.loc[exported].groupby("last_date"):
+        df_new = pd.read_sql(sql="select * from stock_prices where ticker_symbol in %(ticker_symbols)s and date > %(last_date)s order by ticker_symbol, date",
+                             con=con,
+                             params={"ticker_symbols": tuple(df_exported.index), "last_date": last_date})
+        df_new = df_new.assign(ticker_symbol=df_new["ticker_symbol"].astype(str))
+
+        for ticker_symbol, df in df_new.groupby("ticker_symbol"):
+            append_stock_prices(df, ticker_symbol, df_state, state_path, output_dir, s3_bucket, s3_base_path)
+
+    # Full history for new tickers
+    for ticker_symbol in ticker_symbols:
+        if ticker_symbol in exported:
+            continue
+
+        df = pd.read_sql(sql="select * from stock_prices where ticker_symbol=%(ticker_symbol)s order by date",
+                         con=con,
+                         params={"ticker_symbol": ticker_symbol})
+        append_stock_prices(df, ticker_symbol, df_state, state_path, output_dir, s3_bucket, s3_base_path)
+
+    con.close()
+
+
+def append_stock_prices(df, ticker_symbol, df_state, state_path, output_dir, s3_bucket, s3_base_path):
+    if len(df) == 0:
+        return
+
+    first_id = df_state.at[ticker_symbol, "last_id"] + 1 if ticker_symbol in df_state.index else 0
+
+    df = df.sort_values("date")
+    df = df.assign(id=np.arange(first_id, first_id + len(df)))
+    df = df.set_index("id")
+
+    print(f"ticker_symbol: {ticker_symbol}, rows: {len(df)}")
+
+    if s3_bucket is not None:
+        # S3 has no append, the object is rewritten
+        s3_key = f"{s3_base_path}/stock_prices.{ticker_symbol}.csv"
+        if first_id > 0:
+            # Rows past the saved state were written by a run that crashed before saving it
+            df_old = app_s3.read_dataframe(s3_bucket, s3_key, index_col=0)
+            df = pd.concat([df_old[df_old.index < first_id], df], sort=False)
+        app_s3.write_dataframe(df, s3_bucket, s3_key)
+    else:
+        path = f"{output_dir}/stock_prices.{ticker_symbol}.csv"
+        os.makedirs(output_dir, exist_ok=True)
+        if first_id > 0:
+            truncate_stock_prices(path, first_id)
+        df.to_csv(path, mode="a" if first_id > 0 else "w", header=first_id == 0)
+
+    # State is saved with every ticker, so that a crash does not append the same rows again on the next run
+    df_state.at[ticker_symbol, "last_date"] = str(df["date"].values[-1])
+    df_state.at[ticker_symbol, "last_id"] = df.index[-1]
+    write_export_state(df_state, state_path, s3_bucket)
+
+
+def truncate_stock_prices(path, first_id):
+    # Rows from first_id on were appended by a run that crashed before saving the state
+    with open(path, "rb") as f:
+        f.seek(max(0, os.path.getsize(path) - 4096))
+        last_line = f.read().rstrip(b"\n").split(b"\n")[-1]
+
+    # Usually the last row is the saved one, and the file is not read.
+    # A last line without quotes is a whole row, the last line of a multi-line row ends its quoted field.
+    if b'"' not in last_line and int(last_line.split(b",")[0]) < first_id:
+        return
+
+    with open(path, "r+b") as f:
+        row_count = -1
+        quote_count = 0
+        while row_count < first_id:
+            line = f.readline()
+            if line == b"":
+                return
+
+            quote_count += line.count(b'"')
+            if quote_count % 2 == 0:
+                row_count += 1
+                quote_count = 0
+        f.truncate()
+
+
+def read_export_state(state_path, s3_bucket=None):
+    if s3_bucket is not None:
+        exists = app_s3.exists(s3_bucket, state_path)
+    else:
+        exists = os.path.exists(state_path)
+
+    if not exists:
+        return pd.DataFrame({"last_date": pd.Series(dtype=object), "last_id": pd.Series(dtype=np.int64)}, index=pd.Index([], name="ticker_symbol", dtype=object))
+
+    if s3_bucket is not None:
+        df_state = app_s3.read_dataframe(s3_bucket, state_path, index_col=0, dtype={"ticker_symbol": str, "last_date": str})
+    else:
+        df_state = pd.read_csv(state_path, index_col=0, dtype={"ticker_symbol": str, "last_date": str})
+
+    return df_state
+
+
+def write_export_state(df_state, state_path, s3_bucket=None):
+    df_state = df_state.assign(last_id=df_state["last_id"].astype(np.int64))
+
+    if s3_bucket is not None:
+        app_s3.write_dataframe(df_state, s3_bucket, state_path)
+    else:
+        os.makedirs(os.path.dirname(state_path), exist_ok=True)
+        df_state.to_csv(state_path)
+
+
+class StockPricesSplitter():
+    # File-like target of COPY ... TO STDOUT. Rows must arrive ordered by ticker_symbol, date.
+    # Only the current ticker's output is open, and only one partial record is buffered.
+    def __init__(self, open_output):
+        self._open_output = open_output
+        self._buffer = ""
+        self._quote_count = 0
+        self._decoder = codecs.getincrementaldecoder("utf-8")()
+        self._header = None
+        self._ticker_column = None
+        self._ticker_symbol = None
+        self._output = None
+        self._writer = None
+        self._id = 0
+        self.ticker_count = 0
+        self.row_count = 0
+        self.byte_count = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, data):
+        self.byte_count += len(data)
+
+        if isinstance(data, bytes):
+            data = self._decoder.decode(data)
+
+        # A line ends a record only when its quotes are balanced, a quoted field may contain newlines
+        lines = data.split("\n")
+        records = []
+
+        for line in lines[:-1]:
+            self._buffer += line
+            self._quote_count += line.count('"')
+
+            if self._quote_count % 2 == 0:
+                records.append(self._buffer)
+                self._buffer = ""
+                self._quote_count = 0
+            else:
+                self._buffer += "\n"
+
+        self._buffer += lines[-1]
+        self._quote_count += lines[-1].count('"')
+
+        for row in csv.reader(records):
+            self._write_row(row)
+
+        return len(data)
+
+    def close(self):
+        if self._buffer != "":
+            for row in csv.reader([self._buffer]):
+                self._write_row(row)
+            self._buffer = ""
+            self._quote_count = 0
+
+        self._close_output()
+
+    def _write_row(self, row):
+        if len(row) == 0:
+            return
+
+        if self._header is None:
+            self._header = row
+            self._ticker_column = row.index("ticker_symbol")
+            return
+
+        ticker_symbol = row[self._ticker_column]
+
+        if ticker_symbol != self._ticker_symbol:
+            self._close_output()
+
+            self._ticker_symbol = ticker_symbol
+            self._output = self._open_output(ticker_symbol)
+            self._writer = csv.writer(self._output, lineterminator="\n")
+            self._writer.writerow(["id"] + self._header)
+            self._id = 0
+            self.ticker_count += 1
+
+        self._writer.writerow([self._id] + row)
+        self._id += 1
+        self.row_count += 1
+
+    def _close_output(self):
+        if self._output is not None:
+            self._output.close()
+            self._output = None
+            self._writer = None
+
+
 def analysis():
     df_companies = pd.read_csv("local/companies.csv")
 
@@ -52,12 +366,29 @@ def analysis():
     print(df_companies.head())
     print(df_companies.info())
 
+    results = app_parallel.imap_unordered(analysis_impl, [(id, df_companies.at[id, "ticker_symbol"]) for id in df_companies.index])
+    records = [result for result in app_parallel.collect_results(results) if result["data_size"] is not None]
+
+    # Write the analysed table once
     df_analysed = df_companies.copy()
+    if len(records) > 0:
+        df_analysed = df_analysed.join(pd.DataFrame.from_records(records, index="id").drop("ticker_symbol", axis=1))
+
+    df_analysed.to_csv("local/companies.analysed.csv")
+    company_summary.write_companies(df_analysed)
+
 
-    for id in df_analysed.index:
-        ticker_symbol = df_analysed.at[id, "ticker_symbol"]
-        print(f"id: {id}, ticker_symbol: {ticker_symbol}")
+def analysis_impl(id, ticker_symbol):
+    print(f"id: {id}, ticker_symbol: {ticker_symbol}")
 
+    result = {
+        "id": id,
+        "ticker_symbol": ticker_symbol,
+        "exception": None,
+        "data_size": None
+    }
+
+    try:
         df_prices = pd.read_csv(f"local/stock_prices/stock_prices.{ticker_symbol}.csv", index_col=0)
         df_prices = df_prices.sort_values("date")
         df_prices = df_prices.drop_duplicates()
@@ -65,55 +396,69 @@ def analysis():
         df_prices = df_prices.set_index("id")
 
         if len(df_prices) < 2500:
-            continue
-
-        for idx in df_prices.index:
-            open_price = df_prices.at[idx, "open_price"]
-            close_price = df_prices.at[idx, "close_price"]
-            day_trade_profit = close_price - open_price
+            return result
 
-            if day_trade_profit > 0:
-                df_prices.at[idx, "day_trade_profit"] = day_trade_profit
-            else:
-                df_prices.at[idx, "day_trade_profit"] = 0.0
+        df_prices["day_trade_profit"] = (df_prices["close_price"] - df_prices["open_price"]).clip(lower=0.0).fillna(0.0)
 
-        df_analysed.at[id, "data_size"] = len(df_prices)
+        result["data_size"] = len(df_prices)
 
-        df_analysed.at[id, "latest_open_price"] = df_prices.at[df_prices.index[-1], "open_price"]
-        df_analysed.at[id, "latest_high_price"] = df_prices.at[df_prices.index[-1], "high_price"]
-        df_analysed.at[id, "latest_low_price"] = df_prices.at[df_prices.index[-1], "low_price"]
-        df_analysed.at[id, "latest_close_price"] = df_prices.at[df_prices.index[-1], "close_price"]
-        df_analysed.at[id, "latest_volume"] = df_prices.at[df_prices.index[-1], "volume"]
-        df_analysed.at[id, "latest_adjusted_close_price"] = df_prices.at[df_prices.index[-1], "adjusted_close_price"]
+        latest = df_prices.iloc[-1]
+        for column in ["open_price", "high_price", "low_price", "close_price", "volume", "adjusted_close_price"]:
+            result[f"latest_{column}"] = latest[column]
 
         for window in [5, 10, 20, 40, 80]:
             df_prices[f"sma_{window}"] = df_prices["adjusted_close_price"].rolling(window).mean()
 
-            sma_latest = df_prices.at[df_prices.index[-1], f"sma_{window}"]
-            sma_start = df_prices.at[df_prices.index[-window], f"sma_{window}"]
-            diff_sma = sma_latest - sma_start
+            sma = df_prices[f"sma_{window}"].values
+            result[f"diff_sma_{window}"] = sma[-1] - sma[-window]
 
-            df_analysed.at[id, f"diff_sma_{window}"] = diff_sma
+            result[f"volume_{window}"] = df_prices["volume"].values[-window:].sum()
 
-            df_analysed.at[id, f"volume_{window}"] = df_prices["volume"][-window:].values.sum()
+            result[f"day_trade_profit_{window}"] = df_prices["day_trade_profit"].values[-window:].sum()
 
-            df_analysed.at[id, f"day_trade_profit_{window}"] = df_prices["day_trade_profit"][-window:].values.sum()
+        # First/last id of each year
+        years = df_prices["date"].astype(str).str[:4]
+        ids = pd.Series(df_prices.index, index=df_prices.index).groupby(years.values)
+        start_ids = ids.first()
+        end_ids = ids.last()
 
         for year in [2015, 2016, 2017, 2018, 2019]:
-            df_analysed.at[id, f"start_id_{year}"] = df_prices.query(f"'{year}-01-01' <= date <= '{year}-12-31'").index[0]
-            df_analysed.at[id, f"end_id_{year}"] = df_prices.query(f"'{year}-01-01' <= date <= '{year}-12-31'").index[-1]
+            result[f"start_id_{year}"] = start_ids.get(str(year), np.nan)
+            result[f"end_id_{year}"] = end_ids.get(str(year), np.nan)
 
         df_prices.to_csv(f"local/stock_prices/stock_prices.{ticker_symbol}.analysed.csv")
-        df_analysed.to_csv("local/companies.analysed.csv")
-
+    except Exception as err:
+        print(f"ticker_symbol={ticker_symbol}, {err}")
+        result["exception"] = err
 
-def analysis_2():
-    df = pd.read_csv("local/companies.analysed.csv", index_col=0)
+    return result
 
-    df = df[["ticker_symbol", "name", "data_size", "latest_open_price", "day_trade_profit_80"]]
 
-    df = df.query("data_size > 2500")
-    df = df.query("latest_open_price < 1000")
-    df = df.sort_values("day_trade_profit_80", ascending=False)
+def analysis_2(conditions=(("data_size", ">", 2500), ("latest_open_price", "<", 1000)), order_by=("day_trade_profit_80 desc",)):
+    df = company_summary.query(conditions,
+                               columns=["ticker_symbol", "name", "data_size", "latest_open_price", "day_trade_profit_80"],
+                               order_by=order_by)
 
     df.to_csv("local/companies.analysed.2.csv")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--task", help="export, export_bulk, export_incremental, export_parallel, analysis, or analysis_2")
+    parser.add_argument("--n-workers", help="export_parallel workers and connections (default: 4)", default=4, type=int)
+    args = parser.parse_args()
+
+    if args.task == "export":
+        export_stock_prices()
+    elif args.task == "export_bulk":
+        export_stock_prices_bulk()
+    elif args.task == "export_incremental":
+        export_stock_prices_incremental()
+    elif args.task == "export_parallel":
+        export_stock_prices_parallel(n_workers=args.n_workers)
+    elif args.task == "analysis":
+        analysis()
+    elif args.task == "analysis_2":
+        analysis_2()
+    else:
+        parser.print_help()
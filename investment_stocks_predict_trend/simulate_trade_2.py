@@ -2,6 +2,9 @@ import argparse
 
 from app_logging import get_app_logger
 import app_s3
+import feature_store
+import manifest
+import walk_forward
 from simulate_trade_base import SimulateTradeBase
 
 
@@ -47,6 +50,8 @@ class SimulateTrade2(SimulateTradeBase):
                     df.at[start_id, "profit_rate"] = df.at[end_id, "low_price"] / df.at[start_id, "open_price"]
 
             app_s3.write_dataframe(df, s3_bucket, f"{output_base_path}/stock_prices.{ticker_symbol}.csv")
+
+            result.update(manifest.build_manifest(df))
         except Exception as err:
             L.exception(f"ticker_symbol={ticker_symbol}, {err}")
             result["exception"] = err
@@ -64,7 +69,6 @@ class SimulateTrade2(SimulateTradeBase):
 
         try:
             # Load data
-            clf = app_s3.read_sklearn_model(s3_bucket, f"{input_model_base_path}/model.{ticker_symbol}.joblib")
             df = app_s3.read_dataframe(s3_bucket, f"{input_preprocess_base_path}/stock_prices.{ticker_symbol}.csv", index_col=0)
 
             df_prices = df[["date", "open_price", "high_price", "low_price", "close_price", "adjusted_close_price", "volume"]].copy()
@@ -74,7 +78,7 @@ class SimulateTrade2(SimulateTradeBase):
             target_period_ids = df_prices.query(f"'{start_date}' <= date <= '{end_date}'").index
             df_prices = df_prices.loc[target_period_ids[0]-1: target_period_ids[-1]+1]
             data = df_preprocessed.loc[target_period_ids[0]-1: target_period_ids[-1]+1].values
-            df_prices = df_prices.assign(predict=clf.predict(data))
+            df_prices = df_prices.assign(predict=self.predict(s3_bucket, input_model_base_path, ticker_symbol, data, df_prices.index))
 
             # Backtest
             losscut_rate = 0.95
@@ -120,8 +124,12 @@ class SimulateTrade2(SimulateTradeBase):
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument("--task", help="simulate, or backtest")
+    parser.add_argument("--task", help="simulate, backtest, backtest_walk_forward, or sync_strategy_stats")
     parser.add_argument("--suffix", help="folder name suffix (default: test)", default="test")
+    parser.add_argument("--pooled", help="backtest with the pooled model (default: False)", action="store_true")
+    parser.add_argument("--first-test-year", help="walk forward first test year (default: 2015)", default=2015, type=int)
+    parser.add_argument("--last-test-year", help="walk forward last test year (default: 2018)", default=2018, type=int)
+    parser.add_argument("--train-years", help="walk forward train years (default: 7)", default=7, type=int)
     args = parser.parse_args()
 
     if args.task == "simulate":
@@ -135,8 +143,8 @@ if __name__ == "__main__":
             start_date="2018-01-01",
             end_date="2018-12-31",
             s3_bucket="u6k",
-            input_preprocess_base_path=f"ml-data/stocks/predict_3.simulate_trade_2.{args.suffix}",
-            input_model_base_path=f"ml-data/stocks/predict_3.simulate_trade_2.{args.suffix}",
+            input_preprocess_base_path=feature_store.get_base_path("u6k", f"ml-data/stocks/preprocess_2.{args.suffix}", f"ml-data/stocks/simulate_trade_2.{args.suffix}", "updown"),
+            input_model_base_path=f"ml-data/stocks/predict_3.simulate_trade_2.{args.suffix}" + ("/pooled" if args.pooled else ""),
             output_base_path=f"ml-data/stocks/simulate_trade_2_backtest.{args.suffix}"
         )
 
@@ -144,5 +152,18 @@ if __name__ == "__main__":
             s3_bucket="u6k",
             base_path=f"ml-data/stocks/simulate_trade_2_backtest.{args.suffix}"
         )
+    elif args.task == "backtest_walk_forward":
+        SimulateTrade2().backtest_walk_forward(
+            windows=walk_forward.build_windows(args.first_test_year, args.last_test_year, args.train_years),
+            s3_bucket="u6k",
+            input_preprocess_base_path=feature_store.get_base_path("u6k", f"ml-data/stocks/preprocess_2.{args.suffix}", f"ml-data/stocks/simulate_trade_2.{args.suffix}", "updown"),
+            input_model_base_path=f"ml-data/stocks/predict_3.simulate_trade_2.{args.suffix}",
+            output_base_path=f"ml-data/stocks/simulate_trade_2_backtest.{args.suffix}"
+        )
+    elif args.task == "sync_strategy_stats":
+        SimulateTrade2().sync_strategy_stats(
+            s3_bucket="u6k",
+            base_path=f"ml-data/stocks/simulate_trade_2_backtest.{args.suffix}"
+        )
     else:
         parser.print_help()
@@ -1,13 +1,22 @@
 import argparse
-from datetime import datetime
-import pandas as pd
+import json
+import numpy as np
 
 from app_logging import get_app_logger
 import app_s3
-from simulate_trade_base import SimulateTradeBase
+import feature_store
+import manifest
+import walk_forward
+from simulate_trade_base import ACTION_BUY, BacktestAccount, SimulateTradeBase
 
 
 class SimulateTrade4(SimulateTradeBase):
+    BACKTEST_ALL_PARAMS = {
+        **SimulateTradeBase.BACKTEST_ALL_PARAMS,
+        "report_query": "expected_value>0.01 and trade_count>30",
+        "hold_period": 5
+    }
+
     def simulate_singles_impl(self, ticker_symbol, s3_bucket, input_base_path, output_base_path):
         L = get_app_logger(f"simulate_singles_impl.{ticker_symbol}")
         L.info(f"simulate_trade_4: {ticker_symbol}")
@@ -51,6 +60,8 @@ class SimulateTrade4(SimulateTradeBase):
 
             # Save data
             app_s3.write_dataframe(df, s3_bucket, f"{output_base_path}/stock_prices.{ticker_symbol}.csv")
+
+            result.update(manifest.build_manifest(df))
         except Exception as err:
             L.exception(f"ticker_symbol={ticker_symbol}, {err}")
             result["exception"] = err
@@ -70,7 +81,6 @@ class SimulateTrade4(SimulateTradeBase):
 
         try:
             # Load data
-            clf = app_s3.read_sklearn_model(s3_bucket, f"{input_model_base_path}/model.{ticker_symbol}.joblib")
             df = app_s3.read_dataframe(s3_bucket, f"{input_preprocess_base_path}/stock_prices.{ticker_symbol}.csv", index_col=0)
 
             df_prices = df[["date", "open_price", "high_price", "low_price", "close_price", "adjusted_close_price", "volume"]].copy()
@@ -80,7 +90,7 @@ class SimulateTrade4(SimulateTradeBase):
             target_period_ids = df_prices.query(f"'{start_date}' <= date <= '{end_date}'").index
             df_prices = df_prices.loc[target_period_ids[0]-1: target_period_ids[-1]]
             data = df_preprocessed.loc[target_period_ids[0]-1: target_period_ids[-1]].values
-            df_prices = df_prices.assign(predict=clf.predict(data))
+            df_prices = df_prices.assign(predict=self.predict(s3_bucket, input_model_base_path, ticker_symbol, data, df_prices.index))
 
             # Backtest
             buy_price = None
@@ -120,168 +130,53 @@ class SimulateTrade4(SimulateTradeBase):
 
         return result
 
-    def backtest_all(self, s3_bucket, base_path):
-        L = get_app_logger("backtest_all")
-        L.info("start")
-
-        start_date = datetime(2018, 1, 1)
-        end_date = datetime(2019, 1, 1)
-
-        df_action = pd.DataFrame(columns=["date", "ticker_symbol", "action", "price", "stocks", "profit", "profit_rate"])
-        df_stocks = pd.DataFrame(columns=["buy_price", "buy_stocks", "hold_days_remain", "open_price_latest"])
-        df_result = pd.DataFrame(columns=["fund", "asset"])
-
-        df_report = app_s3.read_dataframe(s3_bucket, f"{base_path}/report.csv", index_col=0)
+    def backtest_all_impl(self, market, ticker_ids, params, L=None):
+        account = BacktestAccount(market["ticker_symbols"], **params)
 
-        df_prices_dict = {}
-        for ticker_symbol in df_report.query("expected_value>0.01 and trade_count>30").sort_values("expected_value", ascending=False).index:
-            L.info(f"load data: {ticker_symbol}")
-            df_prices_dict[ticker_symbol] = app_s3.read_dataframe(s3_bucket, f"{base_path}/stock_prices.{ticker_symbol}.csv", index_col=0)
-
-        fund = 100000
-        asset = fund
-        available_rate = 0.05
-        total_available_rate = 0.5
-        fee_rate = 0.001
-        tax_rate = 0.21
-        hold_period = 5
-
-        for date in self.date_range(start_date, end_date):
-            date_str = date.strftime("%Y-%m-%d")
-            L.info(f"backtest_all: {date_str}")
+        open_price = market["open_price"]
+        action = market["action"]
 
+        for t, date_str in enumerate(market["dates"]):
             # Buy
-            for ticker_symbol in df_prices_dict.keys():
-                df_prices = df_prices_dict[ticker_symbol]
-
-                if len(df_prices.query(f"date=='{date_str}'")) == 0:
+            for ticker_id in ticker_ids:
+                if np.isnan(open_price[t, ticker_id]) or action[t, ticker_id] != ACTION_BUY:
                     continue
 
-                prices_id = df_prices.query(f"date=='{date_str}'").index[0]
-
-                if df_prices.at[prices_id, "action"] != "buy":
-                    continue
-
-                buy_price = df_prices.at[prices_id, "open_price"]
-                buy_stocks = asset * available_rate // buy_price
-                hold_days_remain = hold_period
-
-                if buy_stocks <= 0:
-                    continue
-
-                if (fund - buy_price * buy_stocks) < (asset * total_available_rate):
-                    continue
-
-                fund -= buy_price * buy_stocks
-
-                action_id = len(df_action)
-                df_action.at[action_id, "date"] = date_str
-                df_action.at[action_id, "ticker_symbol"] = ticker_symbol
-                df_action.at[action_id, "action"] = "buy"
-                df_action.at[action_id, "price"] = buy_price
-                df_action.at[action_id, "stocks"] = buy_stocks
-
-                fee_price = (buy_price * buy_stocks) * fee_rate
-                fund -= fee_price
-
-                action_id = len(df_action)
-                df_action.at[action_id, "date"] = date_str
-                df_action.at[action_id, "ticker_symbol"] = ticker_symbol
-                df_action.at[action_id, "action"] = "fee"
-                df_action.at[action_id, "price"] = fee_price
-                df_action.at[action_id, "stocks"] = 1
-                df_action.at[action_id, "profit"] = -1 * fee_price
-
-                df_stocks.at[ticker_symbol, "buy_price"] = buy_price
-                df_stocks.at[ticker_symbol, "buy_stocks"] = buy_stocks
-                df_stocks.at[ticker_symbol, "hold_days_remain"] = hold_days_remain
-                df_stocks.at[ticker_symbol, "open_price_latest"] = buy_price
+                account.buy(date_str, ticker_id, open_price[t, ticker_id], hold_days_remain=params["hold_period"])
 
             # Sell
-            for ticker_symbol in df_stocks.index:
-                if df_stocks.at[ticker_symbol, "hold_days_remain"] > 0:
+            for ticker_id in list(account.stocks.keys()):
+                if account.stocks[ticker_id]["hold_days_remain"] > 0:
                     continue
 
-                df_prices = df_prices_dict[ticker_symbol]
-
-                if len(df_prices.query(f"date=='{date_str}'")) == 0:
+                if np.isnan(open_price[t, ticker_id]):
                     continue
 
-                prices_id = df_prices.query(f"date=='{date_str}'").index[0]
-                sell_price = df_prices.at[prices_id, "open_price"]
-                buy_price = df_stocks.at[ticker_symbol, "buy_price"]
-                buy_stocks = df_stocks.at[ticker_symbol, "buy_stocks"]
-
-                profit = (sell_price - buy_price) * buy_stocks
-                profit_rate = profit / (sell_price * buy_stocks)
-
-                fund += sell_price * buy_stocks
-
-                action_id = len(df_action)
-                df_action.at[action_id, "date"] = date_str
-                df_action.at[action_id, "ticker_symbol"] = ticker_symbol
-                df_action.at[action_id, "action"] = "sell"
-                df_action.at[action_id, "price"] = sell_price
-                df_action.at[action_id, "stocks"] = buy_stocks
-                df_action.at[action_id, "profit"] = profit
-                df_action.at[action_id, "profit_rate"] = profit_rate
-
-                fee_price = (sell_price * buy_stocks) * fee_rate
-                fund -= fee_price
-
-                action_id = len(df_action)
-                df_action.at[action_id, "date"] = date_str
-                df_action.at[action_id, "ticker_symbol"] = ticker_symbol
-                df_action.at[action_id, "action"] = "fee"
-                df_action.at[action_id, "price"] = fee_price
-                df_action.at[action_id, "stocks"] = 1
-                df_action.at[action_id, "profit"] = -1 * fee_price
-
-                if profit > 0:
-                    tax_price = profit * tax_rate
-                    fund -= tax_price
-
-                    action_id = len(df_action)
-                    df_action.at[action_id, "date"] = date_str
-                    df_action.at[action_id, "ticker_symbol"] = ticker_symbol
-                    df_action.at[action_id, "action"] = "tax"
-                    df_action.at[action_id, "price"] = tax_price
-                    df_action.at[action_id, "stocks"] = 1
-                    df_action.at[action_id, "profit"] = -1 * tax_price
-
-                df_stocks = df_stocks.drop(ticker_symbol)
+                account.sell(date_str, ticker_id, open_price[t, ticker_id])
 
             # Turn end
-            for ticker_symbol in df_stocks.index:
-                df_prices = df_prices_dict[ticker_symbol]
-
-                if len(df_prices.query(f"date=='{date_str}'")) == 0:
-                    continue
-
-                prices_id = df_prices.query(f"date=='{date_str}'").index[0]
-
-                df_stocks.at[ticker_symbol, "hold_days_remain"] -= 1
-                df_stocks.at[ticker_symbol, "open_price_latest"] = df_prices.at[prices_id, "open_price"]
-
-            asset = fund
-            for ticker_symbol in df_stocks.index:
-                asset += df_stocks.at[ticker_symbol, "open_price_latest"] * df_stocks.at[ticker_symbol, "buy_stocks"]
-
-            df_result.at[date_str, "fund"] = fund
-            df_result.at[date_str, "asset"] = asset
+            for ticker_id, stock in account.stocks.items():
+                if not np.isnan(open_price[t, ticker_id]):
+                    stock["hold_days_remain"] -= 1
 
-            L.info(df_result.loc[date_str])
+            account.turn_end(date_str, open_price[t])
 
-        app_s3.write_dataframe(df_action, s3_bucket, f"{base_path}/backtest_all.action.csv")
-        app_s3.write_dataframe(df_result, s3_bucket, f"{base_path}/backtest_all.result.csv")
+            if L is not None:
+                L.info(f"backtest_all: {date_str}, fund={account.fund}, asset={account.asset}")
 
-        L.info("finish")
+        return account.to_dataframes()
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument("--task", help="simulate, backtest, or backtest_all")
+    parser.add_argument("--task", help="simulate, backtest, backtest_walk_forward, backtest_all, backtest_all_grid, or sync_strategy_stats")
     parser.add_argument("--suffix", help="folder name suffix (default: test)", default="test")
+    parser.add_argument("--pooled", help="backtest with the pooled model (default: False)", action="store_true")
+    parser.add_argument("--first-test-year", help="walk forward first test year (default: 2015)", default=2015, type=int)
+    parser.add_argument("--last-test-year", help="walk forward last test year (default: 2018)", default=2018, type=int)
+    parser.add_argument("--train-years", help="walk forward train years (default: 7)", default=7, type=int)
+    parser.add_argument("--param-grid", help="backtest_all_grid parameter grid (json)", default="{}")
+    parser.add_argument("--n-iter", help="backtest_all_grid random search iterations (default: full grid)", default=None, type=int)
     args = parser.parse_args()
 
     if args.task == "simulate":
@@ -295,8 +190,8 @@ if __name__ == "__main__":
             start_date="2018-01-01",
             end_date="2018-12-31",
             s3_bucket="u6k",
-            input_preprocess_base_path=f"ml-data/stocks/predict_3.simulate_trade_4.{args.suffix}",
-            input_model_base_path=f"ml-data/stocks/predict_3.simulate_trade_4.{args.suffix}",
+            input_preprocess_base_path=feature_store.get_base_path("u6k", f"ml-data/stocks/preprocess_2.{args.suffix}", f"ml-data/stocks/simulate_trade_4.{args.suffix}", "updown"),
+            input_model_base_path=f"ml-data/stocks/predict_3.simulate_trade_4.{args.suffix}" + ("/pooled" if args.pooled else ""),
             output_base_path=f"ml-data/stocks/simulate_trade_4_backtest.{args.suffix}"
         )
 
@@ -304,8 +199,30 @@ if __name__ == "__main__":
             s3_bucket="u6k",
             base_path=f"ml-data/stocks/simulate_trade_4_backtest.{args.suffix}"
         )
+    elif args.task == "backtest_walk_forward":
+        SimulateTrade4().backtest_walk_forward(
+            windows=walk_forward.build_windows(args.first_test_year, args.last_test_year, args.train_years),
+            s3_bucket="u6k",
+            input_preprocess_base_path=feature_store.get_base_path("u6k", f"ml-data/stocks/preprocess_2.{args.suffix}", f"ml-data/stocks/simulate_trade_4.{args.suffix}", "updown"),
+            input_model_base_path=f"ml-data/stocks/predict_3.simulate_trade_4.{args.suffix}",
+            output_base_path=f"ml-data/stocks/simulate_trade_4_backtest.{args.suffix}"
+        )
     elif args.task == "backtest_all":
         SimulateTrade4().backtest_all(
+            s3_bucket="u6k",
+            base_path=f"ml-data/stocks/simulate_trade_4_backtest.{args.suffix}",
+            index_base_path=f"ml-data/stocks/preprocess_1.{args.suffix}"
+        )
+    elif args.task == "backtest_all_grid":
+        SimulateTrade4().backtest_all_grid(
+            s3_bucket="u6k",
+            base_path=f"ml-data/stocks/simulate_trade_4_backtest.{args.suffix}",
+            param_grid=json.loads(args.param_grid),
+            index_base_path=f"ml-data/stocks/preprocess_1.{args.suffix}",
+            n_iter=args.n_iter
+        )
+    elif args.task == "sync_strategy_stats":
+        SimulateTrade4().sync_strategy_stats(
             s3_bucket="u6k",
             base_path=f"ml-data/stocks/simulate_trade_4_backtest.{args.suffix}"
         )
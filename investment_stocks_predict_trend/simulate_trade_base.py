@@ -1,29 +1,61 @@
-from datetime import timedelta
+import os
+import tempfile
 import joblib
+import numpy as np
 import pandas as pd
+from sklearn.model_selection import ParameterGrid, ParameterSampler
 
 from app_logging import get_app_logger
+import app_parallel
 import app_s3
+import company_summary
+import manifest
+import prediction_service
+from trade_metrics import calc_asset_metrics, calc_exposure, calc_trade_metrics
+import walk_forward
+
+
+ACTION_NONE = 0
+ACTION_BUY = 1
+ACTION_SELL = 2
+ACTION_TRADE = 3
+
+ACTION_CODES = {
+    "buy": ACTION_BUY,
+    "sell": ACTION_SELL,
+    "trade": ACTION_TRADE
+}
 
 
 class SimulateTradeBase():
+    BACKTEST_ALL_PARAMS = {
+        "start_date": "2018-01-01",
+        "end_date": "2019-01-01",
+        "fund": 100000,
+        "available_rate": 0.05,
+        "total_available_rate": 0.5,
+        "fee_rate": 0.001,
+        "tax_rate": 0.21,
+        "report_query": "expected_value>0.01 and trade_count>30"
+    }
+
     def simulate_singles(self, *, s3_bucket, input_base_path, output_base_path):
         L = get_app_logger("simulate_singles")
         L.info("start")
 
         df_companies = app_s3.read_dataframe(s3_bucket, f"{input_base_path}/companies.csv", index_col=0)
-        df_companies_result = pd.DataFrame(columns=df_companies.columns)
 
-        results = joblib.Parallel(n_jobs=-1)([joblib.delayed(self.simulate_singles_impl)(ticker_symbol, s3_bucket, input_base_path, output_base_path) for ticker_symbol in df_companies.index])
+        # Tickers of an interrupted run are not computed again
+        checkpoint = app_parallel.checkpoint_path(f"{output_base_path}/companies.csv")
+        checkpoint_records = app_parallel.read_checkpoint(checkpoint)
 
-        for result in results:
-            if result["exception"] is not None:
-                continue
+        results = app_parallel.imap_unordered(self.simulate_singles_impl, [(ticker_symbol, s3_bucket, input_base_path, output_base_path) for ticker_symbol in app_parallel.pending_keys(df_companies.index, checkpoint_records)])
+        records = app_parallel.collect_results(results, checkpoint, checkpoint_records)
 
-            ticker_symbol = result["ticker_symbol"]
-            df_companies_result.loc[ticker_symbol] = df_companies.loc[ticker_symbol]
+        df_companies_result = app_parallel.join_records(df_companies, records)
 
         app_s3.write_dataframe(df_companies_result, s3_bucket, f"{output_base_path}/companies.csv")
+        app_parallel.clear_checkpoint(checkpoint)
 
         L.info("finish")
 
@@ -35,46 +67,106 @@ class SimulateTradeBase():
         L.info("start")
 
         df_companies = app_s3.read_dataframe(s3_bucket, f"{input_preprocess_base_path}/companies.csv", index_col=0)
-        df_result = pd.DataFrame(columns=df_companies.columns)
+        df_companies = manifest.filter_covering(df_companies, start_date)
 
-        results = joblib.Parallel(n_jobs=-1)([joblib.delayed(self.backtest_singles_impl)(ticker_symbol, start_date, end_date, s3_bucket, input_preprocess_base_path, input_model_base_path, output_base_path) for ticker_symbol in df_companies.index])
+        # Tickers of an interrupted run are not computed again
+        checkpoint = app_parallel.checkpoint_path(f"{output_base_path}/companies.csv")
+        checkpoint_records = app_parallel.read_checkpoint(checkpoint)
 
-        for result in results:
-            if result["exception"] is not None:
-                continue
+        results = app_parallel.imap_unordered(self.backtest_singles_impl, [(ticker_symbol, start_date, end_date, s3_bucket, input_preprocess_base_path, input_model_base_path, output_base_path) for ticker_symbol in app_parallel.pending_keys(df_companies.index, checkpoint_records)])
+        records = app_parallel.collect_results(results, checkpoint, checkpoint_records)
 
-            ticker_symbol = result["ticker_symbol"]
-            df_result.loc[ticker_symbol] = df_companies.loc[ticker_symbol]
+        df_result = app_parallel.join_records(df_companies, records)
 
         app_s3.write_dataframe(df_result, s3_bucket, f"{output_base_path}/companies.csv")
+        app_parallel.clear_checkpoint(checkpoint)
         L.info("finish")
 
     def backtest_singles_impl(self, ticker_symbol, start_date, end_date, s3_bucket, input_preprocess_base_path, input_model_base_path, output_base_path):
         raise Exception("Not implemented.")
 
+    def model_key(self, s3_bucket, input_model_base_path, ticker_symbol):
+        pooled_key = f"{input_model_base_path}/model.pooled.joblib"
+
+        if prediction_service.get_service(s3_bucket).exists(pooled_key):
+            return pooled_key
+
+        return f"{input_model_base_path}/model.{ticker_symbol}.joblib"
+
+    def predict(self, s3_bucket, input_model_base_path, ticker_symbol, data, ids=None):
+        service = prediction_service.get_service(s3_bucket)
+
+        # Join the prediction series precomputed after training, when it covers every id
+        predictions_key = f"{input_model_base_path}/predictions.{ticker_symbol}.joblib"
+
+        if ids is not None and service.exists(predictions_key):
+            predictions = service.load_predictions(predictions_key)
+            positions = pd.Index(predictions["id"]).get_indexer(ids)
+
+            if (positions >= 0).all():
+                return predictions["predict"][positions]
+
+        return service.predict(self.model_key(s3_bucket, input_model_base_path, ticker_symbol), data, ticker_symbol)
+
+    def backtest_walk_forward(self, *, windows, s3_bucket, input_preprocess_base_path, input_model_base_path, output_base_path):
+        L = get_app_logger("backtest_walk_forward")
+        L.info("start")
+
+        df_reports = []
+
+        for window in windows:
+            name = walk_forward.window_name(window)
+            window_base_path = f"{output_base_path}/walk_forward/{name}"
+
+            # Only windows without a report are computed
+            if app_s3.exists(s3_bucket, f"{window_base_path}/report.csv"):
+                L.info(f"skip window: {name}")
+            else:
+                L.info(f"window: {name}")
+
+                self.backtest_singles(
+                    start_date=window["test_start_date"],
+                    end_date=window["test_end_date"],
+                    s3_bucket=s3_bucket,
+                    input_preprocess_base_path=input_preprocess_base_path,
+                    input_model_base_path=f"{input_model_base_path}/walk_forward/{name}",
+                    output_base_path=window_base_path
+                )
+
+                self.report_singles(s3_bucket=s3_bucket, base_path=window_base_path)
+
+            df_report = app_s3.read_dataframe(s3_bucket, f"{window_base_path}/report.csv", index_col=0)
+            df_reports.append(df_report.assign(window=name))
+
+        app_s3.write_dataframe(pd.concat(df_reports, sort=False), s3_bucket, f"{output_base_path}/walk_forward/report.csv")
+
+        L.info("finish")
+
     def report_singles(self, *, s3_bucket, base_path):
         L = get_app_logger("report_singles")
         L.info("start")
 
         df_companies = app_s3.read_dataframe(s3_bucket, f"{base_path}/companies.csv", index_col=0)
-        df_result = pd.DataFrame(columns=df_companies.columns)
-
-        results = joblib.Parallel(n_jobs=-1)([joblib.delayed(self.report_singles_impl)(ticker_symbol, s3_bucket, base_path) for ticker_symbol in df_companies.index])
 
-        for result in results:
-            if result["exception"] is not None:
-                continue
+        # Tickers of an interrupted run are not computed again
+        checkpoint = app_parallel.checkpoint_path(f"{base_path}/report.csv")
+        checkpoint_records = app_parallel.read_checkpoint(checkpoint)
 
-            ticker_symbol = result["ticker_symbol"]
-            df_result.loc[ticker_symbol] = df_companies.loc[ticker_symbol]
+        results = app_parallel.imap_unordered(self.report_singles_impl, [(ticker_symbol, s3_bucket, base_path) for ticker_symbol in app_parallel.pending_keys(df_companies.index, checkpoint_records)])
+        records = app_parallel.collect_results(results, checkpoint, checkpoint_records)
 
-            for k in result.keys():
-                if k != "ticker_symbol" and k != "exception":
-                    df_result.at[ticker_symbol, k] = result[k]
+        df_result = app_parallel.join_records(df_companies, records)
 
         app_s3.write_dataframe(df_result, s3_bucket, f"{base_path}/report.csv")
+        app_parallel.clear_checkpoint(checkpoint)
         L.info("finish")
 
+    def sync_strategy_stats(self, *, s3_bucket, base_path):
+        # Trade stats of a backtest report into the local company summary, the base path is the strategy
+        df_report = app_s3.read_dataframe(s3_bucket, f"{base_path}/report.csv", index_col=0)
+
+        company_summary.write_strategy_stats(df_report, base_path)
+
     def report_singles_impl(self, ticker_symbol, s3_bucket, base_path):
         L = get_app_logger(f"report_singles_impl.{ticker_symbol}")
         L.info(f"report_singles: {ticker_symbol}")
@@ -90,31 +182,260 @@ class SimulateTradeBase():
             if "profit" not in df.columns:
                 raise Exception("no trade")
 
-            result["trade_count"] = len(df.query("not profit.isnull()"))
-            result["win_count"] = len(df.query("profit>0"))
-            result["win_rate"] = result["win_count"] / result["trade_count"]
-            result["lose_count"] = len(df.query("profit<=0"))
-            result["lose_rate"] = result["lose_count"] / result["trade_count"]
+            if "action" in df.columns:
+                exposure = calc_exposure(df["action"].values)
+            else:
+                exposure = None
+
+            result.update(calc_trade_metrics(df["profit"].values, df["profit_rate"].values, exposure))
+
             result["open_price_latest"] = df["open_price"].values[-1]
             result["high_price_latest"] = df["high_price"].values[-1]
             result["low_price_latest"] = df["low_price"].values[-1]
             result["close_price_latest"] = df["close_price"].values[-1]
             result["volume_average"] = df["volume"].mean()
-            result["expected_value"] = df["profit_rate"].mean()
-            result["risk"] = df["profit_rate"].std()
-            result["profit_total"] = df.query("profit>0")["profit"].sum()
-            result["loss_total"] = df.query("profit<=0")["profit"].sum()
-            result["profit_factor"] = result["profit_total"] / abs(result["loss_total"])
-            result["profit_average"] = df.query("profit>0")["profit"].mean()
-            result["loss_average"] = df.query("profit<=0")["profit"].mean()
-            result["payoff_ratio"] = result["profit_average"] / abs(result["loss_average"])
-            result["sharpe_ratio"] = result["expected_value"] / result["risk"]
         except Exception as err:
             L.exception(f"ticker_symbol={ticker_symbol}, {err}")
             result["exception"] = err
 
         return result
 
-    def date_range(self, start, end):
-        for n in range((end - start).days):
-            yield start + timedelta(n)
+    def load_trading_calendar(self, df_prices_dict, start_date, end_date, s3_bucket=None, index_base_path=None, index_ticker_symbols=("ni225",)):
+        dates = [df_prices["date"].values for df_prices in df_prices_dict.values()]
+
+        if index_base_path is not None:
+            for ticker_symbol in index_ticker_symbols:
+                df_index = app_s3.read_dataframe(s3_bucket, f"{index_base_path}/stock_prices.{ticker_symbol}.csv", index_col=0)
+                dates.append(df_index["date"].values)
+
+        if len(dates) == 0:
+            return pd.Index([], name="date")
+
+        calendar = pd.Index(np.unique(np.concatenate(dates)), name="date")
+
+        return calendar[(calendar >= start_date) & (calendar < end_date)]
+
+    def build_market(self, df_prices_dict, calendar):
+        ticker_symbols = list(df_prices_dict.keys())
+        shape = (len(calendar), len(ticker_symbols))
+
+        market = {
+            "dates": np.asarray(calendar.values, dtype=str),
+            "ticker_symbols": np.asarray(ticker_symbols, dtype=object),
+            "open_price": np.full(shape, np.nan),
+            "close_price": np.full(shape, np.nan),
+            "action": np.zeros(shape, dtype=np.int8),
+            "prev_action": np.zeros(shape, dtype=np.int8)
+        }
+
+        for ticker_id, ticker_symbol in enumerate(ticker_symbols):
+            df_prices = df_prices_dict[ticker_symbol]
+
+            if "action" in df_prices.columns:
+                action = df_prices["action"].map(ACTION_CODES).fillna(0).values.astype(np.int8)
+            else:
+                action = np.zeros(len(df_prices), dtype=np.int8)
+            prev_action = np.concatenate([[0], action[:-1]]).astype(np.int8)
+
+            positions = calendar.get_indexer(df_prices["date"].values)
+            mask = (positions >= 0) & ~df_prices["date"].duplicated().values
+            positions = positions[mask]
+
+            market["open_price"][positions, ticker_id] = df_prices["open_price"].values[mask]
+            market["close_price"][positions, ticker_id] = df_prices["close_price"].values[mask]
+            market["action"][positions, ticker_id] = action[mask]
+            market["prev_action"][positions, ticker_id] = prev_action[mask]
+
+        return market
+
+    def slice_market(self, market, start_date, end_date):
+        start, end = np.searchsorted(market["dates"], [start_date, end_date])
+
+        return {k: (v if k == "ticker_symbols" else v[start:end]) for k, v in market.items()}
+
+    def select_backtest_ticker_symbols(self, df_report, report_query):
+        return list(df_report.query(report_query).sort_values("expected_value", ascending=False).index)
+
+    def backtest_all(self, s3_bucket, base_path, index_base_path=None, **params):
+        L = get_app_logger("backtest_all")
+        L.info("start")
+
+        params = {**self.BACKTEST_ALL_PARAMS, **params}
+
+        # Load data
+        df_report = app_s3.read_dataframe(s3_bucket, f"{base_path}/report.csv", index_col=0)
+
+        df_prices_dict = {}
+        for ticker_symbol in self.select_backtest_ticker_symbols(df_report, params["report_query"]):
+            L.info(f"load data: {ticker_symbol}")
+            df_prices_dict[ticker_symbol] = app_s3.read_dataframe(s3_bucket, f"{base_path}/stock_prices.{ticker_symbol}.csv", index_col=0)
+
+        calendar = self.load_trading_calendar(df_prices_dict, params["start_date"], params["end_date"], s3_bucket, index_base_path)
+        market = self.build_market(df_prices_dict, calendar)
+
+        # Backtest
+        df_action, df_result = self.backtest_all_impl(market, np.arange(len(market["ticker_symbols"])), params, L)
+
+        app_s3.write_dataframe(df_action, s3_bucket, f"{base_path}/backtest_all.action.csv")
+        app_s3.write_dataframe(df_result, s3_bucket, f"{base_path}/backtest_all.result.csv")
+
+        L.info("finish")
+
+    def backtest_all_impl(self, market, ticker_ids, params, L=None):
+        raise Exception("Not implemented.")
+
+    def backtest_all_grid(self, s3_bucket, base_path, param_grid, index_base_path=None, n_iter=None, random_state=None, n_jobs=-1, sort_key="return_rate"):
+        L = get_app_logger("backtest_all_grid")
+        L.info("start")
+
+        if n_iter is None:
+            configs = list(ParameterGrid(param_grid))
+        else:
+            configs = list(ParameterSampler(param_grid, n_iter, random_state=random_state))
+        configs = [{**self.BACKTEST_ALL_PARAMS, **config} for config in configs]
+
+        L.info(f"configs: {len(configs)}")
+
+        # Load data, once for the union of all configs
+        df_report = app_s3.read_dataframe(s3_bucket, f"{base_path}/report.csv", index_col=0)
+
+        df_prices_dict = {}
+        for report_query in sorted(set(config["report_query"] for config in configs)):
+            for ticker_symbol in self.select_backtest_ticker_symbols(df_report, report_query):
+                if ticker_symbol not in df_prices_dict:
+                    L.info(f"load data: {ticker_symbol}")
+                    df_prices_dict[ticker_symbol] = app_s3.read_dataframe(s3_bucket, f"{base_path}/stock_prices.{ticker_symbol}.csv", index_col=0)
+
+        start_date = min(config["start_date"] for config in configs)
+        end_date = max(config["end_date"] for config in configs)
+        calendar = self.load_trading_calendar(df_prices_dict, start_date, end_date, s3_bucket, index_base_path)
+        market = self.build_market(df_prices_dict, calendar)
+
+        # Backtest, sharing a read-only memory-mapped copy of the market arrays with all workers
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            market_path = os.path.join(tmp_dir, "market.joblib")
+            joblib.dump(market, market_path)
+            market = joblib.load(market_path, mmap_mode="r")
+
+            records = joblib.Parallel(n_jobs=n_jobs)([joblib.delayed(self.backtest_all_grid_impl)(market, df_report, config) for config in configs])
+
+        df_grid = pd.DataFrame.from_records(records)
+        df_grid = df_grid.sort_values(sort_key, ascending=False)
+        df_grid["rank"] = np.arange(1, len(df_grid) + 1)
+        df_grid = df_grid.set_index("rank")
+
+        app_s3.write_dataframe(df_grid, s3_bucket, f"{base_path}/backtest_all_grid.csv")
+
+        L.info("finish")
+
+        return df_grid
+
+    def backtest_all_grid_impl(self, market, df_report, params):
+        ticker_ids_dict = {ticker_symbol: ticker_id for ticker_id, ticker_symbol in enumerate(market["ticker_symbols"])}
+        ticker_ids = [ticker_ids_dict[ticker_symbol] for ticker_symbol in self.select_backtest_ticker_symbols(df_report, params["report_query"])]
+
+        df_action, df_result = self.backtest_all_impl(self.slice_market(market, params["start_date"], params["end_date"]), ticker_ids, params)
+
+        record = dict(params)
+        record["ticker_count"] = len(ticker_ids)
+
+        if len(df_result) > 0:
+            record.update(calc_asset_metrics(df_result["asset"].values))
+
+        df_sell = df_action.query("action=='sell'")
+        record["trade_count"] = len(df_sell)
+        if len(df_sell) > 0:
+            trade_metrics = calc_trade_metrics(df_sell["profit"].values, df_sell["profit_rate"].values)
+            record["win_rate"] = trade_metrics["win_rate"]
+            record["profit_factor"] = trade_metrics["profit_factor"]
+
+        return record
+
+
+class BacktestAccount():
+    def __init__(self, ticker_symbols, *, fund, available_rate, total_available_rate, fee_rate, tax_rate, **kwargs):
+        self.ticker_symbols = ticker_symbols
+        self.fund = fund
+        self.asset = fund
+        self.available_rate = available_rate
+        self.total_available_rate = total_available_rate
+        self.fee_rate = fee_rate
+        self.tax_rate = tax_rate
+
+        self.stocks = {}
+        self.actions = []
+        self.results = []
+
+    def buy(self, date_str, ticker_id, buy_price, **kwargs):
+        buy_stocks = self.asset * self.available_rate // buy_price
+
+        if buy_stocks <= 0:
+            return False
+
+        if (self.fund - buy_price * buy_stocks) < (self.asset * self.total_available_rate):
+            return False
+
+        self.fund -= buy_price * buy_stocks
+        self._append_action(date_str, ticker_id, "buy", buy_price, buy_stocks)
+
+        fee_price = (buy_price * buy_stocks) * self.fee_rate
+        self.fund -= fee_price
+        self._append_action(date_str, ticker_id, "fee", fee_price, 1, profit=-1 * fee_price)
+
+        self.stocks[ticker_id] = {
+            "buy_price": buy_price,
+            "buy_stocks": buy_stocks,
+            "open_price_latest": buy_price,
+            **kwargs
+        }
+
+        return True
+
+    def sell(self, date_str, ticker_id, sell_price):
+        buy_price = self.stocks[ticker_id]["buy_price"]
+        buy_stocks = self.stocks[ticker_id]["buy_stocks"]
+
+        profit = (sell_price - buy_price) * buy_stocks
+        profit_rate = profit / (sell_price * buy_stocks)
+
+        self.fund += sell_price * buy_stocks
+        self._append_action(date_str, ticker_id, "sell", sell_price, buy_stocks, profit=profit, profit_rate=profit_rate)
+
+        fee_price = (sell_price * buy_stocks) * self.fee_rate
+        self.fund -= fee_price
+        self._append_action(date_str, ticker_id, "fee", fee_price, 1, profit=-1 * fee_price)
+
+        if profit > 0:
+            tax_price = profit * self.tax_rate
+            self.fund -= tax_price
+            self._append_action(date_str, ticker_id, "tax", tax_price, 1, profit=-1 * tax_price)
+
+        del self.stocks[ticker_id]
+
+    def turn_end(self, date_str, open_prices):
+        for ticker_id, stock in self.stocks.items():
+            if not np.isnan(open_prices[ticker_id]):
+                stock["open_price_latest"] = open_prices[ticker_id]
+
+        self.asset = self.fund
+        for stock in self.stocks.values():
+            self.asset += stock["open_price_latest"] * stock["buy_stocks"]
+
+        self.results.append({"date": date_str, "fund": self.fund, "asset": self.asset})
+
+    def to_dataframes(self):
+        df_action = pd.DataFrame(self.actions, columns=["date", "ticker_symbol", "action", "price", "stocks", "profit", "profit_rate"])
+        df_result = pd.DataFrame(self.results, columns=["date", "fund", "asset"]).set_index("date")
+
+        return df_action, df_result
+
+    def _append_action(self, date_str, ticker_id, action, price, stocks, profit=np.nan, profit_rate=np.nan):
+        self.actions.append({
+            "date": date_str,
+            "ticker_symbol": self.ticker_symbols[ticker_id],
+            "action": action,
+            "price": price,
+            "stocks": stocks,
+            "profit": profit,
+            "profit_rate": profit_rate
+        })
@@ -0,0 +1,134 @@
+import numpy as np
+
+
+def calc_trade_metrics(profit, profit_rate=None, exposure=None):
+    profit = np.asarray(profit, dtype=np.float64)
+    profit = profit[~np.isnan(profit)]
+
+    if profit_rate is None:
+        profit_rate = np.full(len(profit), np.nan)
+    else:
+        profit_rate = np.asarray(profit_rate, dtype=np.float64)
+        profit_rate = profit_rate[~np.isnan(profit_rate)]
+
+    trade_count = len(profit)
+    if trade_count == 0:
+        raise Exception("no trade")
+
+    win = profit > 0
+    win_count = int(np.count_nonzero(win))
+    lose_count = trade_count - win_count
+
+    profit_total = profit[win].sum()
+    loss_total = profit[~win].sum()
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        profit_average = profit_total / win_count if win_count > 0 else np.nan
+        loss_average = loss_total / lose_count if lose_count > 0 else np.nan
+
+        expected_value = profit_rate.mean() if len(profit_rate) > 0 else np.nan
+        risk = profit_rate.std(ddof=1) if len(profit_rate) > 1 else np.nan
+
+        metrics = {
+            "trade_count": trade_count,
+            "win_count": win_count,
+            "win_rate": win_count / trade_count,
+            "lose_count": lose_count,
+            "lose_rate": lose_count / trade_count,
+            "expected_value": expected_value,
+            "risk": risk,
+            "profit_total": profit_total,
+            "loss_total": loss_total,
+            "profit_factor": np.float64(profit_total) / abs(loss_total),
+            "profit_average": profit_average,
+            "loss_average": loss_average,
+            "payoff_ratio": np.float64(profit_average) / abs(loss_average),
+            "sharpe_ratio": np.float64(expected_value) / risk,
+        }
+
+    metrics["max_drawdown"] = calc_max_drawdown(np.cumsum(profit), initial_value=0.0)[0]
+    metrics["max_consecutive_loss"] = calc_max_consecutive(~win)
+
+    if exposure is not None:
+        exposure = np.asarray(exposure, dtype=bool)
+        metrics["exposure_count"] = int(np.count_nonzero(exposure))
+        metrics["exposure_rate"] = metrics["exposure_count"] / len(exposure) if len(exposure) > 0 else np.nan
+
+    return metrics
+
+
+def calc_asset_metrics(assets):
+    assets = np.asarray(assets, dtype=np.float64)
+    assets = assets[~np.isnan(assets)]
+
+    if len(assets) == 0:
+        raise Exception("no asset")
+
+    max_drawdown, max_drawdown_rate = calc_max_drawdown(assets)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        returns = np.diff(assets) / assets[:-1]
+        return_rate = assets[-1] / assets[0] - 1.0 if assets[0] != 0 else np.nan
+
+        metrics = {
+            "asset_first": assets[0],
+            "asset_last": assets[-1],
+            "return_rate": return_rate,
+            "max_drawdown": max_drawdown,
+            "max_drawdown_rate": max_drawdown_rate,
+            "daily_return_average": returns.mean() if len(returns) > 0 else np.nan,
+            "daily_return_risk": returns.std(ddof=1) if len(returns) > 1 else np.nan,
+        }
+        metrics["daily_sharpe_ratio"] = np.float64(metrics["daily_return_average"]) / metrics["daily_return_risk"]
+
+    return metrics
+
+
+def calc_max_drawdown(values, initial_value=None):
+    values = np.asarray(values, dtype=np.float64)
+
+    if initial_value is not None:
+        values = np.concatenate([[initial_value], values])
+
+    if len(values) == 0:
+        return np.nan, np.nan
+
+    peak = np.maximum.accumulate(values)
+    drawdown = peak - values
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        drawdown_rate = np.where(peak > 0, drawdown / peak, np.nan)
+
+    max_drawdown_rate = np.nanmax(drawdown_rate) if not np.all(np.isnan(drawdown_rate)) else np.nan
+
+    return drawdown.max(), max_drawdown_rate
+
+
+def calc_max_consecutive(flags):
+    flags = np.asarray(flags, dtype=np.int8)
+
+    if len(flags) == 0 or not flags.any():
+        return 0
+
+    # Length of each run of 1s, from the positions where the runs start and stop
+    edges = np.diff(np.concatenate([[0], flags, [0]]))
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1)
+
+    return int((ends - starts).max())
+
+
+def calc_exposure(actions):
+    # 1 while a position is held (from "buy" through "sell"), including intraday "trade"
+    actions = np.asarray(actions, dtype=object)
+
+    state = np.full(len(actions), np.nan)
+    state[actions == "buy"] = 1.0
+    state[actions == "sell"] = 0.0
+
+    # Forward fill position state
+    idx = np.where(~np.isnan(state), np.arange(len(state)), 0)
+    np.maximum.accumulate(idx, out=idx)
+    state = np.nan_to_num(state[idx])
+
+    return (state == 1.0) | (actions == "sell") | (actions == "trade")
@@ -0,0 +1,18 @@
+def build_windows(first_test_year, last_test_year, train_years, test_years=1):
+    windows = []
+
+    for test_start_year in range(first_test_year, last_test_year + 1, test_years):
+        test_end_year = min(test_start_year + test_years - 1, last_test_year)
+
+        windows.append({
+            "train_start_date": f"{test_start_year - train_years}-01-01",
+            "train_end_date": f"{test_start_year - 1}-12-31",
+            "test_start_date": f"{test_start_year}-01-01",
+            "test_end_date": f"{test_end_year}-12-31"
+        })
+
+    return windows
+
+
+def window_name(window):
+    return f"{window['train_start_date']}_{window['train_end_date']}_{window['test_start_date']}_{window['test_end_date']}"
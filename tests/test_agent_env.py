@@ -0,0 +1,238 @@
+from .context import investment_stocks_predict_trend
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(investment_stocks_predict_trend.__file__))
+
+import numpy as np  # noqa
+import pandas as pd  # noqa
+import agent_env  # noqa
+
+
+def build_prices(size=60, seed=0):
+    rng = np.random.RandomState(seed)
+
+    return pd.DataFrame({"close_price": rng.rand(size) * 100 + 50}, index=pd.Index(np.arange(size), name="id"))
+
+
+class HoldEnv():
+    # Buys on action 1 and sells on the next action 1, like the agents' envs
+    INITIAL_STATE = {"total_reward": 0.0, "buy_price": 0.0, "win": 0}
+    PRICE_COLUMNS = ["close_price"]
+
+    def __init__(self, df, start_id, end_id):
+        self.DF = df
+        self.START_ID = start_id
+        self.END_ID = end_id
+        self.OBSERVATIONS = agent_env.build_observations(self.DF, self.START_ID, self.END_ID, [("close_price", -i) for i in range(1, 4)])
+        self.episode = agent_env.EpisodeLog(self.DF, self.START_ID, self.END_ID, {"total_reward": np.nan, "win": 0})
+
+        self.reset()
+
+        self.data_len = self.END_ID - self.START_ID
+        self.action_size = 2
+        self.observation_size = len(self.observe())
+
+    def reset(self):
+        for name, value in self.INITIAL_STATE.items():
+            setattr(self, name, value)
+        self.current_id = self.START_ID
+        self.done = False
+
+        self.episode.reset()
+
+        return self.observe()
+
+    def step(self, action):
+        price = self.DF.at[self.current_id, "close_price"]
+        reward = 0.0
+
+        if action == 1 and self.buy_price == 0.0:
+            self.buy_price = price
+        elif action == 1:
+            reward = price - self.buy_price
+            self.total_reward += reward
+            self.buy_price = 0.0
+            self.win += int(reward > 0)
+
+        self.episode.record(self.current_id, total_reward=self.total_reward, win=self.win)
+
+        self.current_id += 1
+        self.done = self.current_id >= self.END_ID
+
+        return self.observe(), reward, self.done, {}
+
+    @staticmethod
+    def batch_step(state, prices, actions):
+        buy = (actions == 1) & (state["buy_price"] == 0.0)
+        sell = (actions == 1) & (state["buy_price"] != 0.0)
+
+        rewards = np.where(sell, prices["close_price"] - state["buy_price"], 0.0)
+
+        state["total_reward"] += rewards
+        state["buy_price"] = np.where(buy, prices["close_price"], np.where(sell, 0.0, state["buy_price"]))
+        state["win"] += sell & (rewards > 0)
+
+        return rewards, {"total_reward": state["total_reward"], "win": state["win"]}
+
+    def observe(self):
+        return self.OBSERVATIONS[self.current_id - self.START_ID]
+
+    def random_action(self):
+        return np.random.randint(0, 2)
+
+
+class TestBuildObservations(unittest.TestCase):
+    def setUp(self):
+        self.df = pd.DataFrame({
+            "open_price": np.arange(100, 130, dtype=np.float64),
+            "close_price": np.arange(200, 230, dtype=np.float64)
+        }, index=pd.Index(np.arange(10, 40), name="id"))
+
+    def test_window(self):
+        terms = [("open_price", -i) for i in range(1, 4)] + [("close_price", i) for i in range(-1, 2)]
+
+        observations = agent_env.build_observations(self.df, 15, 25, terms)
+
+        self.assertEqual((11, 6), observations.shape)
+        self.assertEqual(np.float32, observations.dtype)
+
+        # Row i is the observation at id 15 + i
+        for i, id in enumerate(range(15, 26)):
+            expected = [self.df.at[id + offset, column] for column, offset in terms]
+            np.testing.assert_array_equal(expected, observations[i])
+
+    def test_same_as_per_step(self):
+        # What the envs built on every step before
+        terms = [("close_price", -i) for i in range(1, 6)]
+
+        observations = agent_env.build_observations(self.df, 20, 30, terms)
+
+        for id in range(20, 31):
+            expected = np.array([self.df.at[id - i, "close_price"] for i in range(1, 6)], dtype=np.float32)
+            np.testing.assert_array_equal(expected, observations[id - 20])
+
+    def test_read_only(self):
+        observations = agent_env.build_observations(self.df, 15, 25, [("open_price", 0)])
+
+        with self.assertRaises(ValueError):
+            observations[0, 0] = 0.0
+
+    def test_out_of_range(self):
+        with self.assertRaises(Exception):
+            agent_env.build_observations(self.df, 12, 20, [("open_price", -3)])
+
+        with self.assertRaises(Exception):
+            agent_env.build_observations(self.df, 30, 39, [("close_price", 1)])
+
+        # The first and last ids of the data
+        self.assertEqual((8, 2), agent_env.build_observations(self.df, 12, 19, [("open_price", -2), ("close_price", 20)]).shape)
+
+    def test_gaps_in_ids(self):
+        df = self.df.drop(index=22)
+
+        with self.assertRaises(Exception):
+            agent_env.build_observations(df, 15, 25, [("open_price", -1)])
+
+
+class TestEpisodeLog(unittest.TestCase):
+    def setUp(self):
+        self.df = pd.DataFrame({"close_price": np.arange(100, 120, dtype=np.float64)}, index=pd.Index(np.arange(20), name="id"))
+        self.episode = agent_env.EpisodeLog(self.df, 5, 10, {"funds": np.nan, "buy": 0})
+
+    def test_record(self):
+        self.episode.record(5, funds=100.0, buy=1)
+        self.episode.record(7, funds=90.0)
+
+        np.testing.assert_array_equal([100.0, np.nan, 90.0, np.nan, np.nan, np.nan], self.episode.values["funds"])
+        np.testing.assert_array_equal([1, 0, 0, 0, 0, 0], self.episode.values["buy"])
+
+    def test_to_dataframe(self):
+        self.episode.record(6, funds=100.0, buy=1)
+
+        df = self.episode.to_dataframe()
+
+        self.assertEqual(list(range(5, 11)), list(df.index))
+        self.assertEqual(list(np.arange(105, 111, dtype=np.float64)), list(df["close_price"]))
+        np.testing.assert_array_equal([np.nan, 100.0, np.nan, np.nan, np.nan, np.nan], df["funds"].values)
+        self.assertEqual([0, 1, 0, 0, 0, 0], list(df["buy"]))
+        self.assertEqual(np.int64, df["buy"].dtype)
+
+        # The prices are not copied into, nor changed by the log
+        self.assertNotIn("funds", self.df.columns)
+
+    def test_rows_outside_the_episode(self):
+        self.episode.record(10, funds=50.0, buy=1)
+
+        df = self.episode.to_dataframe(slice(8, 12))
+
+        self.assertEqual(list(range(8, 13)), list(df.index))
+        np.testing.assert_array_equal([np.nan, np.nan, 50.0, np.nan, np.nan], df["funds"].values)
+        self.assertEqual([0, 0, 1, 0, 0], list(df["buy"]))
+
+    def test_row(self):
+        self.episode.record(8, funds=70.0, buy=1)
+
+        row = self.episode.row(8)
+
+        self.assertEqual(108.0, row["close_price"])
+        self.assertEqual(70.0, row["funds"])
+        self.assertEqual(1, row["buy"])
+
+    def test_reset(self):
+        self.episode.record(5, funds=100.0, buy=1)
+        self.episode.reset()
+
+        self.assertTrue(np.isnan(self.episode.values["funds"]).all())
+        self.assertFalse(self.episode.values["buy"].any())
+
+
+class TestBatchEnv(unittest.TestCase):
+    def test_same_as_envs(self):
+        df = build_prices()
+        windows = [(3, 20), (10, 18), (25, 59)]
+
+        batch_env = agent_env.BatchEnv([HoldEnv(df, start_id, end_id) for start_id, end_id in windows])
+        envs = [HoldEnv(df, start_id, end_id) for start_id, end_id in windows]
+
+        rng = np.random.RandomState(1)
+        obs = batch_env.reset()
+        episode_count = 0
+
+        for _ in range(200):
+            np.testing.assert_array_equal(np.stack([env.observe() for env in envs]), obs)
+
+            actions = rng.randint(0, 2, len(envs))
+            obs, rewards, dones = batch_env.step(actions)
+            results = [env.step(action) for env, action in zip(envs, actions)]
+
+            np.testing.assert_allclose([result[1] for result in results], rewards)
+            self.assertEqual([result[2] for result in results], list(dones))
+
+            for i in np.flatnonzero(dones):
+                self.assertAlmostEqual(envs[i].total_reward, batch_env.envs[i].total_reward)
+                self.assertEqual(envs[i].win, batch_env.envs[i].win)
+                pd.testing.assert_frame_equal(envs[i].episode.to_dataframe(), batch_env.envs[i].episode.to_dataframe(), check_dtype=False)
+
+                envs[i].reset()
+                episode_count += 1
+
+            obs = batch_env.reset_done(obs, dones)
+
+        self.assertGreater(episode_count, 10)
+
+    def test_observations_are_copies(self):
+        batch_env = agent_env.BatchEnv([HoldEnv(build_prices(), 3, 20)])
+
+        obs = batch_env.reset()
+        next_obs, _, _ = batch_env.step(np.array([1]))
+        obs[0] = -1
+
+        self.assertFalse((next_obs == -1).any())
+        self.assertFalse((batch_env.step(np.array([0]))[0] == -1).any())
+
+
+if __name__ == "__main__":
+    unittest.main()
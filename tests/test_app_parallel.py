@@ -0,0 +1,120 @@
+from .context import investment_stocks_predict_trend
+
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(investment_stocks_predict_trend.__file__))
+
+import numpy as np  # noqa
+import pandas as pd  # noqa
+import app_parallel  # noqa
+
+
+def run(path, ticker_symbols, crash_after=None):
+    # One orchestrator run: skip the finished tickers, and die after crash_after new results
+    checkpoint_records = app_parallel.read_checkpoint(path)
+
+    def results():
+        for i, ticker_symbol in enumerate(app_parallel.pending_keys(ticker_symbols, checkpoint_records)):
+            if crash_after is not None and i >= crash_after:
+                raise KeyboardInterrupt()
+
+            yield {"ticker_symbol": ticker_symbol, "exception": None, "score": np.float64(ticker_symbol / 10)}
+
+    return app_parallel.collect_results(results(), path, checkpoint_records)
+
+
+class TestCheckpoint(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+        self.path = f"{self._dir.name}/checkpoint/model.jsonl"
+
+    def tearDown(self):
+        self._dir.cleanup()
+
+    def test_checkpoint_path(self):
+        self.assertEqual("local/checkpoint/out/model.csv.jsonl", app_parallel.checkpoint_path("out/model.csv"))
+
+    def test_read_missing(self):
+        self.assertEqual([], app_parallel.read_checkpoint(self.path))
+        self.assertEqual([], app_parallel.read_checkpoint(None))
+
+    def test_pending_keys(self):
+        records = [{"ticker_symbol": 1002}, {"ticker_symbol": 1003}]
+
+        self.assertEqual([1001, 1004], app_parallel.pending_keys([1001, 1002, 1003, 1004], records))
+        self.assertEqual([0, 2], app_parallel.pending_keys([0, 1, 2], [{"seed": 1}], name="seed"))
+
+    def test_resume(self):
+        ticker_symbols = [1001, 1002, 1003, 1004, 1005]
+
+        with self.assertRaises(KeyboardInterrupt):
+            run(self.path, ticker_symbols, crash_after=2)
+
+        self.assertEqual([1001, 1002], [record["ticker_symbol"] for record in app_parallel.read_checkpoint(self.path)])
+
+        records = run(self.path, ticker_symbols)
+
+        self.assertEqual(ticker_symbols, [record["ticker_symbol"] for record in records])
+        self.assertEqual(records, app_parallel.read_checkpoint(self.path))
+        self.assertEqual(100.3, records[2]["score"])
+
+    def test_resume_after_partial_line(self):
+        ticker_symbols = [1001, 1002, 1003]
+
+        run(self.path, ticker_symbols[:1])
+
+        # The crash cut the second record in the middle of its line
+        with open(self.path, "a") as f:
+            f.write('{"ticker_symbol": 1002, "sco')
+
+        self.assertEqual([1001], [record["ticker_symbol"] for record in app_parallel.read_checkpoint(self.path)])
+
+        records = run(self.path, ticker_symbols)
+
+        self.assertEqual(ticker_symbols, [record["ticker_symbol"] for record in records])
+        self.assertEqual(ticker_symbols, [record["ticker_symbol"] for record in app_parallel.read_checkpoint(self.path)])
+
+    def test_finished_run(self):
+        ticker_symbols = [1001, 1002]
+
+        run(self.path, ticker_symbols)
+        records = run(self.path, ticker_symbols)
+
+        self.assertEqual(ticker_symbols, [record["ticker_symbol"] for record in records])
+        self.assertEqual(2, len(app_parallel.read_checkpoint(self.path)))
+
+        app_parallel.clear_checkpoint(self.path)
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_exceptions_are_not_recorded(self):
+        results = [
+            {"ticker_symbol": 1001, "exception": None, "score": 1.0},
+            {"ticker_symbol": 1002, "exception": Exception("error"), "score": None}
+        ]
+
+        records = app_parallel.collect_results(results, self.path)
+
+        self.assertEqual([{"ticker_symbol": 1001, "score": 1.0}], records)
+        self.assertEqual(records, app_parallel.read_checkpoint(self.path))
+        self.assertEqual([1002], app_parallel.pending_keys([1001, 1002], records))
+
+    def test_without_path(self):
+        records = app_parallel.collect_results([{"ticker_symbol": 1001, "exception": None}])
+
+        self.assertEqual([{"ticker_symbol": 1001}], records)
+
+    def test_join_records(self):
+        df_companies = pd.DataFrame({"name": ["a", "b", "c"], "score": [0.0, 0.0, 0.0]}, index=pd.Index([1001, 1002, 1003], name="ticker_symbol"))
+
+        df_result = app_parallel.join_records(df_companies, [{"ticker_symbol": 1003, "score": 0.5}, {"ticker_symbol": 1001, "score": 0.25}])
+
+        self.assertEqual([1001, 1003], list(df_result.index))
+        self.assertEqual([0.25, 0.5], list(df_result["score"]))
+        self.assertEqual(["a", "c"], list(df_result["name"]))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,73 @@
+from .context import investment_stocks_predict_trend
+
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(investment_stocks_predict_trend.__file__))
+
+import pandas as pd  # noqa
+import company_summary  # noqa
+
+
+class TestQuery(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+        self.path = f"{self._dir.name}/company_summary.sqlite"
+
+        df_companies = pd.DataFrame({
+            "ticker_symbol": [1001, 1002, 1003],
+            "name": ["a", "b", "c"],
+            "data_size": [3000, 2000, 4000],
+            "latest_open_price": [500.0, 800.0, 1500.0]
+        })
+        company_summary.write_companies(df_companies, self.path)
+
+        df_report = pd.DataFrame({"trade_count": [10, 20], "win_rate": [0.6, 0.4]}, index=pd.Index([1001, 1003], name="ticker_symbol"))
+        company_summary.write_strategy_stats(df_report, "s1", self.path)
+
+    def tearDown(self):
+        self._dir.cleanup()
+
+    def test_conditions(self):
+        df = company_summary.query([("data_size", ">", 2500), ("latest_open_price", "<", 1000)], columns=["ticker_symbol", "name"], path=self.path)
+
+        self.assertEqual([1001], list(df["ticker_symbol"]))
+        self.assertEqual(["ticker_symbol", "name"], list(df.columns))
+
+    def test_order_by_and_limit(self):
+        df = company_summary.query(order_by=["data_size desc"], limit=2, path=self.path)
+
+        self.assertEqual([1003, 1001], list(df["ticker_symbol"]))
+
+    def test_strategy(self):
+        df = company_summary.query([("win_rate", ">=", 0.5)], columns=["ticker_symbol", "trade_count"], strategy="s1", path=self.path)
+
+        self.assertEqual([1001], list(df["ticker_symbol"]))
+        self.assertEqual([10], list(df["trade_count"]))
+
+    def test_values_are_parameters(self):
+        df = company_summary.query([("name", "=", "a' or '1'='1")], path=self.path)
+
+        self.assertEqual(0, len(df))
+
+    def test_unknown_names(self):
+        with self.assertRaises(Exception):
+            company_summary.query(columns=["ticker_symbol; drop table companies"], path=self.path)
+
+        with self.assertRaises(Exception):
+            company_summary.query(order_by=["data_size; drop table companies"], path=self.path)
+
+        with self.assertRaises(Exception):
+            company_summary.query([("data_size", "> 0 or 1 =", 1)], path=self.path)
+
+        # Stats columns are known only when joined
+        with self.assertRaises(Exception):
+            company_summary.query(columns=["win_rate"], path=self.path)
+
+        self.assertEqual(3, len(company_summary.query(path=self.path)))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,70 @@
+from .context import investment_stocks_predict_trend
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(investment_stocks_predict_trend.__file__))
+
+import numpy as np  # noqa
+import pandas as pd  # noqa
+import manifest  # noqa
+
+
+class TestManifest(unittest.TestCase):
+    def setUp(self):
+        self.df_companies = pd.DataFrame({
+            "name": ["a", "b", "c", "d", "e"],
+            "first_date": ["2007-01-04", "2008-01-04", "2007-01-04", "2007-01-04", None],
+            "last_date": ["2019-03-01", "2019-03-01", "2018-12-31", "2018-06-29", None]
+        }, index=pd.Index([1001, 1002, 1003, 1004, 1005], name="ticker_symbol"))
+
+    def test_build_manifest(self):
+        df = pd.DataFrame({"date": ["2018-01-05", "2018-01-04", "2018-01-09"], "open_price": [1.0, np.nan, 2.0]})
+
+        self.assertEqual({"data_size": 3, "first_date": "2018-01-04", "last_date": "2018-01-09", "null_count": 1}, manifest.build_manifest(df))
+        self.assertEqual({"data_size": 0, "first_date": None, "last_date": None, "null_count": 0}, manifest.build_manifest(df.iloc[:0]))
+
+    def test_join_manifest(self):
+        df_companies = self.df_companies.assign(data_size=0)
+
+        df = manifest.join_manifest(df_companies, {1001: {"data_size": 10, "first_date": "2000-01-04", "last_date": "2000-02-01", "null_count": 0}})
+
+        self.assertEqual(["name", "data_size", "first_date", "last_date", "null_count"], list(df.columns))
+        self.assertEqual(10, df.at[1001, "data_size"])
+        self.assertEqual("2000-01-04", df.at[1001, "first_date"])
+        self.assertTrue(np.isnan(df.at[1002, "data_size"]))
+
+    def test_filter_covering(self):
+        df = manifest.filter_covering(self.df_companies, "2008-01-01", "2018-12-31")
+
+        # 1002 starts after the start date, 1003 ends on the end date, 1004 before it, 1005 has no data
+        self.assertEqual([1001], list(df.index))
+
+    def test_filter_covering_boundaries(self):
+        self.assertEqual([1001, 1003, 1004], list(manifest.filter_covering(self.df_companies, "2008-01-04", "2018-06-28").index))
+        self.assertEqual([1001, 1003], list(manifest.filter_covering(self.df_companies, "2008-01-04", "2018-06-29").index))
+
+    def test_filter_covering_without_end_date(self):
+        # Data up to at least the start date is enough
+        self.assertEqual([1001, 1002, 1003, 1004], list(manifest.filter_covering(self.df_companies, "2018-06-29").index))
+        self.assertEqual([1001, 1002, 1003], list(manifest.filter_covering(self.df_companies, "2018-06-30").index))
+        self.assertEqual([1001, 1003, 1004], list(manifest.filter_covering(self.df_companies, "2008-01-04").index))
+
+    def test_filter_covering_read_from_csv(self):
+        # Missing dates are NaN after a round trip through companies.csv
+        df_companies = self.df_companies.replace({None: np.nan})
+
+        self.assertEqual([1001], list(manifest.filter_covering(df_companies, "2008-01-01", "2018-12-31").index))
+
+    def test_without_manifest(self):
+        df_companies = self.df_companies.drop(columns=["last_date"])
+
+        self.assertIs(df_companies, manifest.filter_covering(df_companies, "2008-01-01", "2018-12-31"))
+
+    def test_empty(self):
+        self.assertEqual(0, len(manifest.filter_covering(self.df_companies.iloc[:0], "2008-01-01", "2018-12-31")))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,94 @@
+from .context import investment_stocks_predict_trend
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(investment_stocks_predict_trend.__file__))
+
+import numpy as np  # noqa
+from sklearn.metrics import confusion_matrix, precision_score, recall_score, roc_auc_score  # noqa
+import predict_metrics  # noqa
+
+
+class TestClassificationScores(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+
+        self.ys = [rng.randint(0, 3, size) for size in [50, 1, 30]]
+        self.y_preds = [rng.randint(0, 3, len(y)) for y in self.ys]
+
+        # Ticker 2 never has label 2 but predicts it, ticker 1 has one row
+        self.ys[2][self.ys[2] == 2] = 0
+
+    def test_same_as_sklearn(self):
+        results = predict_metrics.classification_scores_batch(self.ys, self.y_preds)
+
+        self.assertEqual(3, len(results))
+
+        for y, y_pred, scores in zip(self.ys, self.y_preds, results):
+            labels = np.unique(y)
+
+            precisions = precision_score(y, y_pred, labels=labels, average=None, zero_division=np.nan)
+            recalls = recall_score(y, y_pred, labels=labels, average=None, zero_division=np.nan)
+
+            self.assertEqual(set(labels), set(int(key.split("_")[1]) for key in scores if key.startswith("recall_")))
+
+            for label, precision, recall in zip(labels, precisions, recalls):
+                np.testing.assert_allclose(precision, scores[f"precision_{label}"])
+                self.assertAlmostEqual(recall, scores[f"recall_{label}"])
+                self.assertEqual(recall, scores[f"score_{label}"])
+                self.assertEqual(np.count_nonzero(y == label), scores[f"score_{label}_total"])
+                self.assertEqual(np.count_nonzero((y == label) & (y_pred == label)), scores[f"score_{label}_count"])
+
+    def test_confusion_matrices(self):
+        y = np.concatenate(self.ys)
+        y_pred = np.concatenate(self.y_preds)
+        groups = np.repeat(np.arange(3), [len(y) for y in self.ys])
+
+        cm = predict_metrics.confusion_matrices(groups, y, y_pred, np.array([0, 1, 2]), 3)
+
+        for i in range(3):
+            np.testing.assert_array_equal(confusion_matrix(self.ys[i], self.y_preds[i], labels=[0, 1, 2]), cm[i])
+
+    def test_single(self):
+        self.assertEqual(predict_metrics.classification_scores_batch(self.ys[:1], self.y_preds[:1])[0], predict_metrics.classification_scores(self.ys[0], self.y_preds[0]))
+
+    def test_empty(self):
+        self.assertEqual([], predict_metrics.classification_scores_batch([], []))
+
+
+class TestProbabilityScores(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(1)
+
+        self.ys = [rng.randint(0, 2, size) for size in [40, 25]]
+        # Rounded, so that there are ties
+        self.y_probas = [np.round(rng.rand(len(y)) * 0.5 + y * 0.3, 1) for y in self.ys]
+        self.y_preds = [(y_proba > 0.5).astype(np.int64) for y_proba in self.y_probas]
+
+    def test_roc_auc_same_as_sklearn(self):
+        results = predict_metrics.classification_scores_batch(self.ys, self.y_preds, self.y_probas)
+
+        for y, y_proba, scores in zip(self.ys, self.y_probas, results):
+            self.assertAlmostEqual(roc_auc_score(y, y_proba), scores["roc_auc"])
+
+    def test_roc_auc_one_class(self):
+        groups = np.zeros(3, dtype=np.int64)
+
+        self.assertTrue(np.isnan(predict_metrics.roc_auc_scores(groups, [True, True, True], [0.1, 0.5, 0.9], 1)[0]))
+
+    def test_calibration_bins(self):
+        groups = np.zeros(5, dtype=np.int64)
+        y_true = [False, True, True, False, True]
+        y_score = np.array([0.1, 0.15, 0.5, 0.95, 1.0])
+
+        count, proba, rate = predict_metrics.calibration_bins(groups, y_true, y_score, 1)
+
+        np.testing.assert_array_equal([[2, 0, 1, 0, 2]], count)
+        np.testing.assert_allclose([[0.125, np.nan, 0.5, np.nan, 0.975]], proba)
+        np.testing.assert_allclose([[0.5, np.nan, 1.0, np.nan, 0.5]], rate)
+
+
+if __name__ == "__main__":
+    unittest.main()
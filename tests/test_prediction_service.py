@@ -0,0 +1,129 @@
+from .context import investment_stocks_predict_trend
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(investment_stocks_predict_trend.__file__))
+
+import joblib  # noqa
+import numpy as np  # noqa
+from sklearn.linear_model import LinearRegression  # noqa
+import prediction_service  # noqa
+from predict_base import PooledModel  # noqa
+
+
+class TestPredictionService(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+        self.s3_dir = f"{self._dir.name}/s3"
+        self.etags = {}
+        self.downloads = []
+
+        rng = np.random.RandomState(0)
+        self.x = rng.rand(30, 3)
+
+        self.write_model(LinearRegression().fit(self.x, self.x @ [1.0, 2.0, 3.0]), "m/model.1001.joblib")
+
+        pooled = PooledModel(ticker_symbols=[1001, 1002])
+        pooled.clf = LinearRegression().fit(np.hstack([self.x, rng.randint(0, 2, (30, 1))]), rng.rand(30))
+        self.pooled = pooled
+        self.write_model(pooled, "m/model.pooled.joblib")
+
+        patches = [
+            mock.patch.object(prediction_service.app_s3, "get_etag", side_effect=lambda s3_bucket, s3_key: self.etags.get(s3_key)),
+            mock.patch.object(prediction_service.app_s3, "download_file", side_effect=self.download_file)
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def tearDown(self):
+        self._dir.cleanup()
+
+    def write_model(self, model, s3_key):
+        os.makedirs(os.path.dirname(f"{self.s3_dir}/{s3_key}"), exist_ok=True)
+        joblib.dump(model, f"{self.s3_dir}/{s3_key}")
+        self.etags[s3_key] = str(len(self.etags) + len(self.downloads) + 1) + s3_key
+
+    def download_file(self, s3_bucket, s3_key, path):
+        self.downloads.append(s3_key)
+        shutil.copyfile(f"{self.s3_dir}/{s3_key}", path)
+
+    def build_service(self, **kwargs):
+        return prediction_service.PredictionService("u", cache_dir=f"{self._dir.name}/cache", **kwargs)
+
+    def test_predict_batch(self):
+        service = self.build_service()
+
+        requests = [
+            ("m/model.pooled.joblib", 1001, self.x[:10]),
+            ("m/model.1001.joblib", 1001, self.x[10:15]),
+            ("m/model.pooled.joblib", 1002, self.x[15:18]),
+            ("m/model.pooled.joblib", 9999, self.x[18:30])
+        ]
+
+        predictions = service.predict_batch(requests)
+
+        self.assertEqual([10, 5, 3, 12], [len(y) for y in predictions])
+        for (s3_key, ticker_symbol, x), y in zip(requests, predictions):
+            np.testing.assert_allclose(service.predict(s3_key, x, ticker_symbol), y)
+
+        np.testing.assert_allclose(self.pooled.predict(1002, self.x[15:18]), predictions[2])
+
+    def test_cache(self):
+        service = self.build_service()
+
+        for _ in range(3):
+            service.predict("m/model.1001.joblib", self.x)
+        self.assertEqual(["m/model.1001.joblib"], self.downloads)
+
+        # Another process reuses the local copy while its ETag matches
+        self.build_service().predict("m/model.1001.joblib", self.x)
+        self.assertEqual(["m/model.1001.joblib"], self.downloads)
+
+    def test_rewritten_model(self):
+        service = self.build_service(etag_ttl=0)
+        y = service.predict("m/model.1001.joblib", self.x)
+
+        self.write_model(LinearRegression().fit(self.x, self.x @ [-1.0, 0.0, 1.0]), "m/model.1001.joblib")
+
+        np.testing.assert_allclose(self.x @ [-1.0, 0.0, 1.0], service.predict("m/model.1001.joblib", self.x))
+        self.assertFalse(np.allclose(y, service.predict("m/model.1001.joblib", self.x)))
+        self.assertEqual(2, len(self.downloads))
+
+    def test_etag_ttl(self):
+        service = self.build_service(etag_ttl=60)
+        y = service.predict("m/model.1001.joblib", self.x)
+
+        self.write_model(LinearRegression().fit(self.x, self.x @ [-1.0, 0.0, 1.0]), "m/model.1001.joblib")
+
+        # Within the TTL the ETag is not checked again
+        np.testing.assert_allclose(y, service.predict("m/model.1001.joblib", self.x))
+
+        with mock.patch.object(prediction_service.time, "time", return_value=prediction_service.time.time() + 60):
+            np.testing.assert_allclose(self.x @ [-1.0, 0.0, 1.0], service.predict("m/model.1001.joblib", self.x))
+
+    def test_predictions(self):
+        predictions = {"id": np.arange(5, 10), "predict": np.array([0, 1, 1, 0, 1])}
+        self.write_model(predictions, "m/predictions.1001.joblib")
+
+        service = self.build_service()
+        for _ in range(3):
+            np.testing.assert_array_equal(predictions["predict"], service.load_predictions("m/predictions.1001.joblib")["predict"])
+
+        self.assertEqual(["m/predictions.1001.joblib"], self.downloads)
+
+    def test_not_found(self):
+        service = self.build_service()
+
+        self.assertFalse(service.exists("m/model.1002.joblib"))
+        with self.assertRaises(Exception):
+            service.predict("m/model.1002.joblib", self.x)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,162 @@
+from .context import investment_stocks_predict_trend
+
+import io
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(investment_stocks_predict_trend.__file__))
+
+import numpy as np  # noqa
+import pandas as pd  # noqa
+import select_company  # noqa
+
+
+COPY_OUTPUT = ("ticker_symbol,date,close_price,memo\n"
+               "1001,2019-01-04,100.0,\"x\ny\"\n"
+               "1001,2019-01-07,101.5,\"a,b\"\n"
+               "1002,2019-01-04,2000.0,株価\n"
+               "1002,2019-01-07,2010.0,\n"
+               "1002,2019-01-08,1990.0,\n").encode("utf-8")
+
+EXPECTED = {
+    "1001": ("id,ticker_symbol,date,close_price,memo\n"
+             "0,1001,2019-01-04,100.0,\"x\ny\"\n"
+             "1,1001,2019-01-07,101.5,\"a,b\"\n"),
+    "1002": ("id,ticker_symbol,date,close_price,memo\n"
+             "0,1002,2019-01-04,2000.0,株価\n"
+             "1,1002,2019-01-07,2010.0,\n"
+             "2,1002,2019-01-08,1990.0,\n")
+}
+
+
+class StringOutput(io.StringIO):
+    def __init__(self, outputs, ticker_symbol):
+        super().__init__()
+        self._outputs = outputs
+        self._ticker_symbol = ticker_symbol
+
+    def close(self):
+        self._outputs[self._ticker_symbol] = self.getvalue()
+        super().close()
+
+
+class TestStockPricesSplitter(unittest.TestCase):
+    def split(self, chunks):
+        outputs = {}
+
+        def open_output(ticker_symbol):
+            if ticker_symbol in outputs:
+                raise Exception(f"opened twice: {ticker_symbol}")
+
+            outputs[ticker_symbol] = None
+            return StringOutput(outputs, ticker_symbol)
+
+        with select_company.StockPricesSplitter(open_output) as splitter:
+            for chunk in chunks:
+                splitter.write(chunk)
+
+        return splitter, outputs
+
+    def test_chunks(self):
+        # Every chunk size, so that rows, fields and multibyte characters are split across chunk boundaries
+        for chunk_size in range(1, len(COPY_OUTPUT) + 1):
+            chunks = [COPY_OUTPUT[i:i + chunk_size] for i in range(0, len(COPY_OUTPUT), chunk_size)]
+
+            splitter, outputs = self.split(chunks)
+
+            self.assertEqual(EXPECTED, outputs, f"chunk_size={chunk_size}")
+            self.assertEqual(2, splitter.ticker_count)
+            self.assertEqual(5, splitter.row_count)
+            self.assertEqual(len(COPY_OUTPUT), splitter.byte_count)
+
+    def test_last_line_without_newline(self):
+        splitter, outputs = self.split([COPY_OUTPUT[:-1]])
+
+        self.assertEqual(EXPECTED, outputs)
+        self.assertEqual(5, splitter.row_count)
+
+    def test_quoted_newlines(self):
+        text = ("ticker_symbol,memo\n"
+                "1001,\"a\n\"\"b\"\"\n\nc\"\n"
+                "1001,\"\"\n"
+                "1002,\"d\nfoo\"\n")
+
+        for chunk_size in range(1, len(text) + 1):
+            splitter, outputs = self.split([text[i:i + chunk_size] for i in range(0, len(text), chunk_size)])
+
+            self.assertEqual({
+                "1001": "id,ticker_symbol,memo\n0,1001,\"a\n\"\"b\"\"\n\nc\"\n1,1001,\n",
+                "1002": "id,ticker_symbol,memo\n0,1002,\"d\nfoo\"\n"
+            }, outputs, f"chunk_size={chunk_size}")
+            self.assertEqual(3, splitter.row_count)
+
+    def test_str_chunks(self):
+        text = COPY_OUTPUT.decode("utf-8")
+
+        splitter, outputs = self.split([text[i:i + 7] for i in range(0, len(text), 7)])
+
+        self.assertEqual(EXPECTED, outputs)
+
+
+class TestAppendStockPrices(unittest.TestCase):
+    def prices(self, dates):
+        return pd.DataFrame({"ticker_symbol": "1001", "date": dates, "close_price": np.arange(len(dates), dtype=np.float64)})
+
+    def test_resume_after_crash(self):
+        with tempfile.TemporaryDirectory() as output_dir:
+            state_path = f"{output_dir}/export_state.csv"
+            df_state = select_company.read_export_state(state_path)
+
+            select_company.append_stock_prices(self.prices(["2019-01-04", "2019-01-07"]), "1001", df_state, state_path, output_dir, None, None)
+
+            # The rows are appended, and the process dies before the state is saved
+            with mock.patch.object(select_company, "write_export_state", side_effect=KeyboardInterrupt()):
+                with self.assertRaises(KeyboardInterrupt):
+                    select_company.append_stock_prices(self.prices(["2019-01-08", "2019-01-09"]), "1001", select_company.read_export_state(state_path), state_path, output_dir, None, None)
+
+            df_state = select_company.read_export_state(state_path)
+            self.assertEqual("2019-01-07", df_state.at["1001", "last_date"])
+
+            select_company.append_stock_prices(self.prices(["2019-01-08", "2019-01-09", "2019-01-10"]), "1001", df_state, state_path, output_dir, None, None)
+
+            df = pd.read_csv(f"{output_dir}/stock_prices.1001.csv", index_col=0)
+            self.assertEqual(list(range(5)), list(df.index))
+            self.assertEqual(["2019-01-04", "2019-01-07", "2019-01-08", "2019-01-09", "2019-01-10"], list(df["date"]))
+            self.assertEqual(4, select_company.read_export_state(state_path).at["1001", "last_id"])
+
+    def test_resume_after_crash_with_quoted_newlines(self):
+        with tempfile.TemporaryDirectory() as output_dir:
+            state_path = f"{output_dir}/export_state.csv"
+
+            df = self.prices(["2019-01-04", "2019-01-07"]).assign(memo=["a\n1,b", "c"])
+            select_company.append_stock_prices(df, "1001", select_company.read_export_state(state_path), state_path, output_dir, None, None)
+
+            df = self.prices(["2019-01-08"]).assign(memo=["d\n2,e"])
+            with mock.patch.object(select_company, "write_export_state", side_effect=KeyboardInterrupt()):
+                with self.assertRaises(KeyboardInterrupt):
+                    select_company.append_stock_prices(df, "1001", select_company.read_export_state(state_path), state_path, output_dir, None, None)
+
+            df = self.prices(["2019-01-08", "2019-01-09"]).assign(memo=["d\n2,e", "f"])
+            select_company.append_stock_prices(df, "1001", select_company.read_export_state(state_path), state_path, output_dir, None, None)
+
+            df = pd.read_csv(f"{output_dir}/stock_prices.1001.csv", index_col=0)
+            self.assertEqual(list(range(4)), list(df.index))
+            self.assertEqual(["a\n1,b", "c", "d\n2,e", "f"], list(df["memo"]))
+
+    def test_append_without_crash(self):
+        with tempfile.TemporaryDirectory() as output_dir:
+            state_path = f"{output_dir}/export_state.csv"
+
+            for dates in [["2019-01-04"], ["2019-01-07", "2019-01-08"], ["2019-01-09"]]:
+                select_company.append_stock_prices(self.prices(dates), "1001", select_company.read_export_state(state_path), state_path, output_dir, None, None)
+
+            df = pd.read_csv(f"{output_dir}/stock_prices.1001.csv", index_col=0)
+            self.assertEqual(list(range(4)), list(df.index))
+            self.assertEqual(["2019-01-04", "2019-01-07", "2019-01-08", "2019-01-09"], list(df["date"]))
+
+
+if __name__ == "__main__":
+    unittest.main()
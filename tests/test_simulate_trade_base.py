@@ -0,0 +1,208 @@
+from .context import investment_stocks_predict_trend
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(investment_stocks_predict_trend.__file__))
+
+import numpy as np  # noqa
+import pandas as pd  # noqa
+from simulate_trade_3 import SimulateTrade3  # noqa
+from simulate_trade_4 import SimulateTrade4  # noqa
+
+
+PARAMS = {
+    "fund": 100000,
+    "available_rate": 0.2,
+    "total_available_rate": 0.5,
+    "fee_rate": 0.001,
+    "tax_rate": 0.21,
+    "hold_period": 2
+}
+
+
+def build_prices_dict(seed=0, ticker_count=4, date_count=20):
+    rng = np.random.RandomState(seed)
+    dates = pd.bdate_range("2018-01-01", periods=date_count).strftime("%Y-%m-%d")
+
+    df_prices_dict = {}
+    for i in range(ticker_count):
+        # Each ticker misses a few dates
+        mask = rng.rand(date_count) > 0.15
+        size = mask.sum()
+
+        df_prices_dict[f"{1001 + i}"] = pd.DataFrame({
+            "date": dates[mask],
+            "open_price": np.round(rng.rand(size) * 900 + 100),
+            "close_price": np.round(rng.rand(size) * 900 + 100),
+            "action": rng.choice(["", "buy", "sell", "trade"], size, p=[0.4, 0.2, 0.2, 0.2])
+        })
+
+    return df_prices_dict
+
+
+def append_action(actions, date_str, ticker_symbol, action, price, stocks, profit=np.nan, profit_rate=np.nan):
+    actions.append({"date": date_str, "ticker_symbol": ticker_symbol, "action": action, "price": price, "stocks": stocks, "profit": profit, "profit_rate": profit_rate})
+
+
+def sell(actions, date_str, ticker_symbol, sell_price, buy_price, buy_stocks, fund):
+    profit = (sell_price - buy_price) * buy_stocks
+    profit_rate = profit / (sell_price * buy_stocks)
+
+    fund += sell_price * buy_stocks
+    append_action(actions, date_str, ticker_symbol, "sell", sell_price, buy_stocks, profit, profit_rate)
+
+    fee_price = (sell_price * buy_stocks) * PARAMS["fee_rate"]
+    fund -= fee_price
+    append_action(actions, date_str, ticker_symbol, "fee", fee_price, 1, -1 * fee_price)
+
+    if profit > 0:
+        tax_price = profit * PARAMS["tax_rate"]
+        fund -= tax_price
+        append_action(actions, date_str, ticker_symbol, "tax", tax_price, 1, -1 * tax_price)
+
+    return fund
+
+
+def buy(actions, date_str, ticker_symbol, buy_price, fund, asset):
+    # The new fund, or None when the trade is skipped
+    buy_stocks = asset * PARAMS["available_rate"] // buy_price
+
+    if buy_stocks <= 0 or (fund - buy_price * buy_stocks) < (asset * PARAMS["total_available_rate"]):
+        return None, buy_stocks
+
+    fund -= buy_price * buy_stocks
+    append_action(actions, date_str, ticker_symbol, "buy", buy_price, buy_stocks)
+
+    fee_price = (buy_price * buy_stocks) * PARAMS["fee_rate"]
+    fund -= fee_price
+    append_action(actions, date_str, ticker_symbol, "fee", fee_price, 1, -1 * fee_price)
+
+    return fund, buy_stocks
+
+
+def to_dataframes(actions, results):
+    df_action = pd.DataFrame(actions, columns=["date", "ticker_symbol", "action", "price", "stocks", "profit", "profit_rate"])
+    df_result = pd.DataFrame(results, columns=["date", "fund", "asset"]).set_index("date")
+
+    return df_action, df_result
+
+
+def backtest_all_trade(df_prices_dict, calendar):
+    # The per-date loop of simulate_trade_3 before the market arrays, looking rows up by date
+    prices_ids = {ticker_symbol: dict(zip(df_prices["date"].values, df_prices.index.values)) for ticker_symbol, df_prices in df_prices_dict.items()}
+    fund = asset = PARAMS["fund"]
+    actions, results = [], []
+
+    for date_str in calendar:
+        for ticker_symbol, df_prices in df_prices_dict.items():
+            prices_id = prices_ids[ticker_symbol].get(date_str)
+            if prices_id is None or df_prices.at[prices_id, "action"] != "trade":
+                continue
+
+            buy_price = df_prices.at[prices_id, "open_price"]
+            new_fund, buy_stocks = buy(actions, date_str, ticker_symbol, buy_price, fund, asset)
+            if new_fund is None:
+                continue
+
+            fund = sell(actions, date_str, ticker_symbol, df_prices.at[prices_id, "close_price"], buy_price, buy_stocks, new_fund)
+
+        asset = fund
+        results.append({"date": date_str, "fund": fund, "asset": asset})
+
+    return to_dataframes(actions, results)
+
+
+def backtest_all_hold(df_prices_dict, calendar):
+    # The per-date loop of simulate_trade_4 before the market arrays
+    prices_ids = {ticker_symbol: dict(zip(df_prices["date"].values, df_prices.index.values)) for ticker_symbol, df_prices in df_prices_dict.items()}
+    fund = asset = PARAMS["fund"]
+    stocks = {}
+    actions, results = [], []
+
+    for date_str in calendar:
+        # Buy
+        for ticker_symbol, df_prices in df_prices_dict.items():
+            prices_id = prices_ids[ticker_symbol].get(date_str)
+            if prices_id is None or df_prices.at[prices_id, "action"] != "buy":
+                continue
+
+            buy_price = df_prices.at[prices_id, "open_price"]
+            new_fund, buy_stocks = buy(actions, date_str, ticker_symbol, buy_price, fund, asset)
+            if new_fund is None:
+                continue
+
+            fund = new_fund
+            stocks[ticker_symbol] = {"buy_price": buy_price, "buy_stocks": buy_stocks, "hold_days_remain": PARAMS["hold_period"], "open_price_latest": buy_price}
+
+        # Sell
+        for ticker_symbol in list(stocks.keys()):
+            prices_id = prices_ids[ticker_symbol].get(date_str)
+            if stocks[ticker_symbol]["hold_days_remain"] > 0 or prices_id is None:
+                continue
+
+            stock = stocks.pop(ticker_symbol)
+            fund = sell(actions, date_str, ticker_symbol, df_prices_dict[ticker_symbol].at[prices_id, "open_price"], stock["buy_price"], stock["buy_stocks"], fund)
+
+        # Turn end
+        for ticker_symbol, stock in stocks.items():
+            prices_id = prices_ids[ticker_symbol].get(date_str)
+            if prices_id is None:
+                continue
+
+            stock["hold_days_remain"] -= 1
+            stock["open_price_latest"] = df_prices_dict[ticker_symbol].at[prices_id, "open_price"]
+
+        asset = fund + sum(stock["open_price_latest"] * stock["buy_stocks"] for stock in stocks.values())
+        results.append({"date": date_str, "fund": fund, "asset": asset})
+
+    return to_dataframes(actions, results)
+
+
+class TestBacktestAll(unittest.TestCase):
+    def backtest(self, simulator, df_prices_dict):
+        calendar = simulator.load_trading_calendar(df_prices_dict, "2018-01-01", "2019-01-01")
+        market = simulator.build_market(df_prices_dict, calendar)
+
+        df_action, df_result = simulator.backtest_all_impl(market, np.arange(len(df_prices_dict)), {**simulator.BACKTEST_ALL_PARAMS, **PARAMS})
+
+        return calendar, df_action, df_result
+
+    def assert_same(self, expected, actual):
+        df_action, df_result = actual
+        df_expected_action, df_expected_result = expected
+
+        self.assertGreater(len(df_expected_action.query("action=='sell'")), 3)
+        pd.testing.assert_frame_equal(df_expected_action, df_action, check_dtype=False)
+        pd.testing.assert_frame_equal(df_expected_result, df_result, check_dtype=False, check_index_type=False)
+
+    def test_trade(self):
+        for seed in range(3):
+            df_prices_dict = build_prices_dict(seed)
+            calendar, df_action, df_result = self.backtest(SimulateTrade3(), df_prices_dict)
+
+            self.assert_same(backtest_all_trade(df_prices_dict, calendar), (df_action, df_result))
+
+    def test_hold(self):
+        for seed in range(3):
+            df_prices_dict = build_prices_dict(seed)
+            calendar, df_action, df_result = self.backtest(SimulateTrade4(), df_prices_dict)
+
+            self.assert_same(backtest_all_hold(df_prices_dict, calendar), (df_action, df_result))
+
+    def test_total_available_rate(self):
+        # Every ticker buys on the first date, only the fund above half of the asset is spent
+        dates = ["2018-01-04", "2018-01-05", "2018-01-09", "2018-01-10"]
+        df_prices_dict = {str(1001 + i): pd.DataFrame({"date": dates, "open_price": 100.0, "close_price": 100.0, "action": ["buy", "", "", ""]}) for i in range(4)}
+
+        _, df_action, df_result = self.backtest(SimulateTrade4(), df_prices_dict)
+
+        self.assertEqual(["1001", "1002"], list(df_action.query("action=='buy'")["ticker_symbol"]))
+        self.assertEqual(["1001", "1002"], list(df_action.query("action=='sell'")["ticker_symbol"]))
+        self.assertEqual(["2018-01-09", "2018-01-09"], list(df_action.query("action=='sell'")["date"]))
+        self.assertAlmostEqual(100000 - 4 * 20000 * 0.001, df_result["asset"].iloc[-1])
+
+
+if __name__ == "__main__":
+    unittest.main()
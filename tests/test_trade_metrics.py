@@ -0,0 +1,99 @@
+from .context import investment_stocks_predict_trend
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(investment_stocks_predict_trend.__file__))
+
+import numpy as np  # noqa
+import trade_metrics  # noqa
+
+
+class TestTradeMetrics(unittest.TestCase):
+    def test_trade_metrics(self):
+        profit = [100.0, -50.0, np.nan, -30.0, -20.0, 200.0]
+        profit_rate = [0.1, -0.05, np.nan, -0.03, -0.02, 0.2]
+
+        metrics = trade_metrics.calc_trade_metrics(profit, profit_rate)
+
+        self.assertEqual(5, metrics["trade_count"])
+        self.assertEqual(2, metrics["win_count"])
+        self.assertEqual(3, metrics["lose_count"])
+        self.assertAlmostEqual(0.4, metrics["win_rate"])
+        self.assertAlmostEqual(300.0, metrics["profit_total"])
+        self.assertAlmostEqual(-100.0, metrics["loss_total"])
+        self.assertAlmostEqual(3.0, metrics["profit_factor"])
+        self.assertAlmostEqual(150.0, metrics["profit_average"])
+        self.assertAlmostEqual(-100.0 / 3, metrics["loss_average"])
+        self.assertAlmostEqual(4.5, metrics["payoff_ratio"])
+        self.assertAlmostEqual(np.mean([0.1, -0.05, -0.03, -0.02, 0.2]), metrics["expected_value"])
+        self.assertAlmostEqual(np.std([0.1, -0.05, -0.03, -0.02, 0.2], ddof=1), metrics["risk"])
+        self.assertAlmostEqual(metrics["expected_value"] / metrics["risk"], metrics["sharpe_ratio"])
+
+        # Cumulative profit 100, 50, 20, 0, 200
+        self.assertAlmostEqual(100.0, metrics["max_drawdown"])
+        self.assertEqual(3, metrics["max_consecutive_loss"])
+        self.assertNotIn("exposure_count", metrics)
+
+    def test_all_wins(self):
+        metrics = trade_metrics.calc_trade_metrics([10.0, 20.0])
+
+        self.assertEqual(0, metrics["lose_count"])
+        self.assertTrue(np.isnan(metrics["loss_average"]))
+        self.assertTrue(np.isinf(metrics["profit_factor"]))
+        self.assertTrue(np.isnan(metrics["expected_value"]))
+        self.assertEqual(0, metrics["max_consecutive_loss"])
+        self.assertEqual(0.0, metrics["max_drawdown"])
+
+    def test_no_trade(self):
+        with self.assertRaises(Exception):
+            trade_metrics.calc_trade_metrics([np.nan])
+
+    def test_exposure(self):
+        metrics = trade_metrics.calc_trade_metrics([1.0], exposure=[True, False, True, True])
+
+        self.assertEqual(3, metrics["exposure_count"])
+        self.assertAlmostEqual(0.75, metrics["exposure_rate"])
+
+    def test_asset_metrics(self):
+        metrics = trade_metrics.calc_asset_metrics([100.0, 110.0, np.nan, 99.0, 121.0])
+
+        self.assertEqual(100.0, metrics["asset_first"])
+        self.assertEqual(121.0, metrics["asset_last"])
+        self.assertAlmostEqual(0.21, metrics["return_rate"])
+        self.assertAlmostEqual(11.0, metrics["max_drawdown"])
+        self.assertAlmostEqual(0.1, metrics["max_drawdown_rate"])
+
+        returns = [0.1, -0.1, 22.0 / 99.0]
+        self.assertAlmostEqual(np.mean(returns), metrics["daily_return_average"])
+        self.assertAlmostEqual(np.std(returns, ddof=1), metrics["daily_return_risk"])
+
+        with self.assertRaises(Exception):
+            trade_metrics.calc_asset_metrics([np.nan])
+
+    def test_max_drawdown(self):
+        self.assertEqual((30.0, 0.25), trade_metrics.calc_max_drawdown([100.0, 120.0, 90.0, 130.0, 110.0]))
+
+        max_drawdown, max_drawdown_rate = trade_metrics.calc_max_drawdown([-10.0, -20.0], initial_value=0.0)
+        self.assertEqual(20.0, max_drawdown)
+        self.assertTrue(np.isnan(max_drawdown_rate))
+
+        self.assertTrue(np.isnan(trade_metrics.calc_max_drawdown([])[0]))
+
+    def test_max_consecutive(self):
+        self.assertEqual(0, trade_metrics.calc_max_consecutive([]))
+        self.assertEqual(0, trade_metrics.calc_max_consecutive([False, False]))
+        self.assertEqual(3, trade_metrics.calc_max_consecutive([True, False, True, True, True, False, True, True]))
+        self.assertEqual(2, trade_metrics.calc_max_consecutive([False, True, True]))
+
+    def test_exposure_from_actions(self):
+        actions = ["", "buy", "", "", "sell", "", "trade", "", "buy", "sell"]
+
+        exposure = trade_metrics.calc_exposure(actions)
+
+        self.assertEqual([False, True, True, True, True, False, True, False, True, True], list(exposure))
+
+
+if __name__ == "__main__":
+    unittest.main()